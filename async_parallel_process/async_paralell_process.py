@@ -4,10 +4,12 @@
 #  the average of the sim runs is computed for each variable (row)
 
 
+import argparse
+import json
 import numpy
 import multiprocessing
 from datetime import datetime
-from matplotlib import pyplot
+from multiprocessing import resource_tracker, shared_memory
 
 
 def take_average(row):
@@ -39,55 +41,162 @@ def run_brute_force(array):
     return brute_force_avgs, brute_force_runtime
 
 
-def run_parallel(array):
+def _apply_to_row_block(task):
+    """
+    worker task, attaches to the shared array and applies a function to each row of one block of rows
+    only the shared memory name and the row range are pickled, never the rows themselves
+    :param task: tuple of (function, shared memory name, array shape, array dtype, first row, stop before row)
+    :return: list of the function outputs for the block
+    """
+    func, shm_name, shape, dtype, row_start, row_stop = task
+    # the workers share the parent's resource tracker (see RowBlockExecutor), so attaching only repeats the parent's
+    # registration of the block and the parent's unlink clears it
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        array = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        output = [func(row) for row in array[row_start:row_stop]]
+        del array  # release the view before closing the buffer
+    finally:
+        shm.close()
+
+    return output
+
+
+class RowBlockExecutor:
+    """
+    persistent process pool that applies a function to every row of an array in blocks of rows
+    the array is copied once into shared memory and each task only carries a row range, so the cost of pickling
+    and sending rows to the workers does not grow with the array
+    :param processes: number of worker processes
+    :param rows_per_chunk: rows per task, None to split each array into about 4 tasks per worker
+    """
+
+    def __init__(self, processes=6, rows_per_chunk=None):
+        self.processes = processes
+        self.rows_per_chunk = rows_per_chunk
+        # start the resource tracker before the workers, so they use it instead of each starting their own tracker
+        # that would report the parent's shared memory blocks as leaked and unlink them when the worker exits
+        resource_tracker.ensure_running()
+        self.proc_pool = multiprocessing.Pool(processes)
+
+    def map_rows(self, func, array, rows_per_chunk=None):
+        """
+        applies func to each row of array in the worker processes
+        :param func: picklable (module level) function taking one row
+        :param array: 2-D array, rows are passed to func
+        :param rows_per_chunk: rows per task, overrides the executor default
+        :return: list of func outputs in row order
+        """
+        array = numpy.ascontiguousarray(array)
+        num_rows = array.shape[0]
+        if rows_per_chunk is None:
+            rows_per_chunk = self.rows_per_chunk
+        if rows_per_chunk is None:
+            rows_per_chunk = max(1, -(-num_rows // (self.processes * 4)))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        try:
+            shared_array = numpy.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared_array[:] = array
+            tasks = [(func, shm.name, array.shape, array.dtype.str, row_start, min(row_start + rows_per_chunk, num_rows))
+                     for row_start in range(0, num_rows, rows_per_chunk)]
+            output = list()
+            for block_output in self.proc_pool.imap(_apply_to_row_block, tasks):
+                output.extend(block_output)
+            del shared_array
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return output
+
+    def close(self):
+        """
+        stops the worker processes once the submitted work is done
+        """
+        self.proc_pool.close()
+        self.proc_pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_parallel(array, executor=None):
     # function to apply take_average() to each row of an array using parallel processing
+    # pass an executor to reuse its worker pool across calls, otherwise one is made and closed for this call
     parallel_start = datetime.now()
-    proc_pool = multiprocessing.Pool(6)
-    output = [proc_pool.apply_async(take_average, args=(row,)) for row in array]
-    parallel_avgs = [result.get() for result in output]
-    proc_pool.close()
+    if executor is None:
+        with RowBlockExecutor(6) as executor:
+            parallel_avgs = executor.map_rows(take_average, array)
+    else:
+        parallel_avgs = executor.map_rows(take_average, array)
     parallel_end = datetime.now()
     parallel_runtime = parallel_end - parallel_start
 
     return parallel_avgs, parallel_runtime
 
 
-def main():
+def run_timings(min_num=100, max_num=6000, step=100, processes=6, verbose=True):
+    """
+    times brute force against parallel averaging while the rows, then the columns, of the matrix grow
+    :param min_num: smallest number of rows/columns
+    :param max_num: number of rows and columns of the full matrix
+    :param step: increase of rows/columns between timings
+    :param processes: number of worker processes
+    :param verbose: print progress
+    :return: list of row/column counts, dict of runtimes in seconds
+    """
     # make variables from random numbers
     mean = 0.0  # standard normal mean
     std_dev = 1.0  # standard normal standard deviation
-    min_num = 100
-    max_num = 6000
     num_rows = max_num  # number of rows; each row represents 1 standard normal variable
     sim_runs = max_num  # number of columns to have; each column is a simulation run with a random draw
     rands = numpy.random.normal(mean, std_dev, size=(num_rows, sim_runs))
 
-    increments = list(range(min_num, max_num, 100))
+    increments = list(range(min_num, max_num, step))
     results = {"rows": {"brute": [], "parallel": []},
                "columns": {"brute": [], "parallel": []}
                }
 
+    # one worker pool for the whole benchmark, so pool start-up is not timed on every call
+    executor = RowBlockExecutor(processes)
+
     for row_slice in increments:
         # run loop with rows increasing and columns held constant
-        print("Running with rows up to " + str(row_slice) + " and all columns")
         rands_slice = rands[0:row_slice, :]
-        print(rands_slice.shape)
+        if verbose:
+            print("Running with rows up to " + str(row_slice) + " and all columns")
+            print(rands_slice.shape)
         brute_force_avgs, brute_force_time = run_brute_force(rands_slice)
-        parallel_avgs, parallel_time = run_parallel(rands_slice)
+        parallel_avgs, parallel_time = run_parallel(rands_slice, executor)
         results["rows"]["brute"].append(brute_force_time.total_seconds())
         results["rows"]["parallel"].append(parallel_time.total_seconds())
 
     for col_slice in increments:
         # run loop with rows held constant and columns increasing
-        print("Running with columns up to " + str(col_slice) + " and all rows")
         rands_slice = rands[:, 0:col_slice]
-        print(rands_slice.shape)
+        if verbose:
+            print("Running with columns up to " + str(col_slice) + " and all rows")
+            print(rands_slice.shape)
         brute_force_avgs, brute_force_time = run_brute_force(rands_slice)
-        parallel_avgs, parallel_time = run_parallel(rands_slice)
+        parallel_avgs, parallel_time = run_parallel(rands_slice, executor)
         results["columns"]["brute"].append(brute_force_time.total_seconds())
         results["columns"]["parallel"].append(parallel_time.total_seconds())
 
-    print(results)
+    executor.close()
+
+    return increments, results
+
+
+def plot_timings(increments, results, save_path=None):
+    """
+    plots the runtimes from run_timings
+    matplotlib is only imported here, so headless runs never load it
+    """
+    from matplotlib import pyplot
 
     pyplot.subplot(1, 1, 1)
     pyplot.plot(increments, results["rows"]["brute"])
@@ -98,7 +207,36 @@ def main():
     pyplot.xlabel("Num of Rows/Columns")
     pyplot.ylabel("Runtime(s)")
     pyplot.legend(["more-rows-brute", "more-rows-parallel", "more-cols-brute", "more-cols-parallel"])
-    pyplot.show()
+    if save_path is None:
+        pyplot.show()
+    else:
+        pyplot.savefig(save_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="brute force against parallel row averages of a random matrix")
+    parser.add_argument("--min", type=int, default=100, help="smallest number of rows/columns")
+    parser.add_argument("--max", type=int, default=6000, help="number of rows and columns of the full matrix")
+    parser.add_argument("--step", type=int, default=100, help="increase of rows/columns between timings")
+    parser.add_argument("--processes", type=int, default=6, help="number of worker processes")
+    parser.add_argument("--headless", action="store_true", help="no plots or progress, print the runtimes as JSON")
+    parser.add_argument("--output", default=None, help="also write the runtimes as JSON to this file")
+    parser.add_argument("--save", default=None, help="save the plot to this file instead of showing it")
+    args = parser.parse_args(argv)
+
+    increments, results = run_timings(args.min, args.max, args.step, args.processes, verbose=not args.headless)
+
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump({"increments": increments, "runtimes": results}, json_file, indent=2)
+    if args.headless:
+        if args.output is None:
+            print(json.dumps({"increments": increments, "runtimes": results}))
+    else:
+        print(results)
+        plot_timings(increments, results, save_path=args.save)
+
+    return increments, results
 
 """
     print("-------------------")
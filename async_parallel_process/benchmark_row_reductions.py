@@ -0,0 +1,201 @@
+#  benchmark of strategies for averaging each row of a matrix, the calculation in async_paralell_process.py
+
+#  each strategy is timed with time.perf_counter over repeated trials after warmup runs, and the median and spread
+#  are reported for each data shape, so the right strategy can be picked by shape rather than by a single sample
+#  peak memory is measured in a separate untimed run under tracemalloc, it covers allocations in this process only
+#  (worker processes of the process pool are not included)
+#  results are written to CSV and JSON together with the machine details to track regressions across machines
+
+
+import argparse
+import csv
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from async_paralell_process import RowBlockExecutor, take_average
+
+
+def reduce_pure_python(array, pools):
+    # pure python loop over the values of each row
+    return numpy.array([take_average(row) for row in array])
+
+
+def reduce_numpy(array, pools):
+    # single vectorised numpy reduction
+    return array.mean(axis=1)
+
+
+def reduce_process_pool(array, pools):
+    # pure python loop per row in worker processes, rows shared through shared memory in blocks
+    return numpy.array(pools["process"].map_rows(take_average, array))
+
+
+def reduce_thread_pool(array, pools):
+    # numpy reduction over row slices in threads, numpy releases the GIL inside the reduction loop
+    thread_pool, num_threads = pools["thread"]
+    averages = numpy.empty(array.shape[0])
+    row_bounds = numpy.linspace(0, array.shape[0], num_threads + 1).astype(int)
+    tasks = [thread_pool.submit(numpy.mean, array[row_start:row_stop], axis=1, out=averages[row_start:row_stop])
+             for row_start, row_stop in zip(row_bounds[:-1], row_bounds[1:]) if row_stop > row_start]
+    for task in tasks:
+        task.result()
+    return averages
+
+
+STRATEGIES = {"pure_python": reduce_pure_python,
+              "numpy": reduce_numpy,
+              "process_pool": reduce_process_pool,
+              "thread_pool": reduce_thread_pool}
+
+
+def time_strategy(strategy, array, pools, repeats=5, warmup=1):
+    """
+    times one strategy on one array
+    :param strategy: function taking (array, pools) and returning the row averages
+    :param array: 2-D array to average by row
+    :param pools: dict of the shared process and thread pools
+    :param repeats: number of timed trials
+    :param warmup: number of untimed runs before the trials
+    :return: list of trial runtimes in seconds, row averages of the last trial
+    """
+    for warmup_run in range(warmup):
+        strategy(array, pools)
+
+    runtimes = list()
+    for trial in range(repeats):
+        trial_start = time.perf_counter()
+        averages = strategy(array, pools)
+        runtimes.append(time.perf_counter() - trial_start)
+
+    return runtimes, averages
+
+
+def peak_memory(strategy, array, pools):
+    """
+    peak memory allocated by one run of a strategy, measured with tracemalloc
+    :return: peak bytes allocated above the memory in use at the start of the run
+    """
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        strategy(array, pools)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return peak_bytes - start_bytes
+
+
+def run_benchmark(shapes, strategies=None, repeats=5, warmup=1, workers=4, rows_per_chunk=None,
+                  measure_memory=True, seed=0, verbose=True):
+    """
+    times each strategy on standard normal matrices of each shape
+    :param shapes: list of (rows, columns) shapes
+    :param strategies: list of strategy names from STRATEGIES, None for all
+    :param repeats: number of timed trials per strategy and shape
+    :param warmup: number of untimed runs before the trials
+    :param workers: number of worker processes and threads
+    :param rows_per_chunk: rows per process pool task, None for the executor default
+    :param measure_memory: also measure peak memory in an untimed run
+    :param seed: seed of the random matrices
+    :param verbose: print progress
+    :return: list of dicts, one per strategy and shape
+    """
+    if strategies is None:
+        strategies = list(STRATEGIES)
+    random_state = numpy.random.default_rng(seed)
+    results = list()
+
+    pools = {"process": RowBlockExecutor(workers, rows_per_chunk=rows_per_chunk),
+             "thread": (ThreadPoolExecutor(workers), workers)}
+    try:
+        for num_rows, num_columns in shapes:
+            array = random_state.standard_normal((num_rows, num_columns))
+            expected = array.mean(axis=1)
+            for name in strategies:
+                if verbose:
+                    print("Running " + name + " with shape " + str((num_rows, num_columns)))
+                runtimes, averages = time_strategy(STRATEGIES[name], array, pools, repeats=repeats, warmup=warmup)
+                quartiles = statistics.quantiles(runtimes, n=4) if len(runtimes) > 1 else [runtimes[0]] * 3
+                results.append({"strategy": name, "rows": num_rows, "columns": num_columns,
+                                "repeats": repeats, "warmup": warmup, "workers": workers,
+                                "median_s": statistics.median(runtimes), "min_s": min(runtimes),
+                                "max_s": max(runtimes), "iqr_s": quartiles[2] - quartiles[0],
+                                "peak_mem_bytes": peak_memory(STRATEGIES[name], array, pools) if measure_memory
+                                else None,
+                                "max_abs_error": float(numpy.abs(averages - expected).max())})
+    finally:
+        pools["process"].close()
+        pools["thread"][0].shutdown()
+
+    return results
+
+
+def machine_info():
+    """
+    details of the machine and library versions the benchmark ran with
+    """
+    return {"platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "python": platform.python_version(), "numpy": numpy.__version__}
+
+
+def write_results_csv(results, path):
+    """
+    writes benchmark results to a CSV file, one row per strategy and shape
+    """
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def write_results_json(results, path):
+    """
+    writes benchmark results to a JSON file together with the machine details
+    """
+    with open(path, "w") as json_file:
+        json.dump({"machine": machine_info(), "results": results}, json_file, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark of row average strategies by data shape")
+    # mix of square, tall and wide matrices, the best strategy changes with the shape
+    parser.add_argument("--shapes", nargs="+", default=["1000x1000", "100000x100", "100x100000", "3000x3000"],
+                        help="matrix shapes as ROWSxCOLUMNS")
+    parser.add_argument("--strategies", nargs="+", default=None, choices=list(STRATEGIES),
+                        help="strategies to run, default all")
+    parser.add_argument("--repeats", type=int, default=5, help="timed trials per strategy and shape")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs before the trials")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes and threads")
+    parser.add_argument("--output-prefix", default="benchmark_row_reductions",
+                        help="results are written to PREFIX.csv and PREFIX.json")
+    parser.add_argument("--headless", action="store_true", help="no progress or table, print the results as JSON")
+    args = parser.parse_args(argv)
+
+    shapes = [tuple(int(size) for size in shape.lower().split("x")) for shape in args.shapes]
+    results = run_benchmark(shapes, strategies=args.strategies, repeats=args.repeats, warmup=args.warmup,
+                            workers=args.workers, verbose=not args.headless)
+
+    write_results_csv(results, args.output_prefix + ".csv")
+    write_results_json(results, args.output_prefix + ".json")
+
+    if args.headless:
+        print(json.dumps({"machine": machine_info(), "results": results}))
+        return results
+
+    for result in results:
+        print(result["strategy"].ljust(14) + str((result["rows"], result["columns"])).ljust(16) +
+              " median " + format(result["median_s"], ".4f") + "s  iqr " + format(result["iqr_s"], ".4f") +
+              "s  peak " + format(result["peak_mem_bytes"] / 1e6, ".1f") + "MB")
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
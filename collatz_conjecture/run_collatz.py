@@ -4,8 +4,16 @@
 # mathematics researchers have run 15 quintillion numbers and yet to find an exception
 # no proof yet exists for the conjecture
 
+import argparse
 import json
-from matplotlib import pyplot
+import multiprocessing
+import os
+import time
+import numpy
+from numpy.lib.format import open_memmap
+
+# largest odd uint64 value whose 3n + 1 step does not overflow
+_uint64_max_odd_input = (2 ** 64 - 2) // 3
 
 
 def collatz_recursive(sequence):
@@ -20,9 +28,9 @@ def collatz_recursive(sequence):
     curr_num = int(seq_in_list[-1])
 
     if curr_num % 2 == 0:
-        next_num = int(curr_num / 2)
+        next_num = curr_num // 2  # integer division stays exact above 2^53
     else:
-        next_num = int((curr_num * 3) + 1)
+        next_num = (curr_num * 3) + 1
 
     seq_in_str += "," + str(next_num)
 
@@ -45,53 +53,397 @@ def collatz_whileloop(start_num):
     collatz_series.append(curr_num)
     while curr_num != 1:
         if curr_num % 2 == 0:
-            next_num = int(curr_num / 2)
+            next_num = curr_num // 2  # integer division stays exact above 2^53
         else:
-            next_num = int((curr_num * 3) + 1)
+            next_num = (curr_num * 3) + 1
         collatz_series.append(next_num)
         curr_num = next_num
 
     return collatz_series
 
 
-if __name__ == "__main__":
+def collatz_exact_batch(start_num, stop_num, memo=None, memo_limit=10000000):
+    """
+    stopping time (steps to reach 1) and peak value for every start number in a range, with exact integer arithmetic
+    every value visited below memo_limit is stored with its stopping time and peak, so a sequence stops as soon as it
+    merges into one already seen and the shared tail is never walked again
+    :param start_num: first start number (>= 1)
+    :param stop_num: stop before this start number
+    :param memo: dict of value -> (stopping time, peak) to reuse across calls, updated in place
+    :param memo_limit: only values below this are stored in the memo, bounding its memory
+    :return: list of stopping times, list of peak values, in start number order
+    """
+    if memo is None:
+        memo = dict()
+    memo[1] = (0, 1)
+
+    stopping_times = list()
+    peaks = list()
+    for num in range(start_num, stop_num):
+        path = list()
+        curr_num = num
+        while curr_num not in memo:
+            path.append(curr_num)
+            if curr_num % 2 == 0:
+                curr_num = curr_num // 2
+            else:
+                curr_num = (curr_num * 3) + 1
+
+        # walk back along the new part of the sequence, filling in the memo
+        steps, peak = memo[curr_num]
+        for value in reversed(path):
+            steps += 1
+            peak = max(peak, value)
+            if value < memo_limit:
+                memo[value] = (steps, peak)
+
+        stopping_times.append(steps)
+        peaks.append(peak)
+
+    return stopping_times, peaks
+
+
+def collatz_vectorised(start_num, stop_num, block_size=65536, memo_limit=10000000, memo_table=None):
+    """
+    stopping times and peak values for a range of start numbers, stepping a whole block of numbers in lock-step
+    with numpy uint64 arrays. numbers still running are compacted every step so finished ones cost nothing
+    results for start numbers below memo_limit are kept in a table, and a sequence stops once it drops below the
+    numbers already done. a sequence that would overflow uint64 is finished with collatz_exact_batch
+    :param start_num: first start number (>= 1)
+    :param stop_num: stop before this start number
+    :param block_size: number of start numbers stepped together, smaller blocks stop earlier on the table but pay
+        more numpy call overhead
+    :param memo_limit: size of the stopping time / peak table
+    :param memo_table: (stopping times, peaks) arrays for the numbers 0 .. len - 1 (entry 0 unused), e.g. from an
+        earlier scan, used read-only in place of the table built here
+    :return: array of start numbers, array of stopping times, array of peak values (uint64)
+    """
+    start_nums = numpy.arange(start_num, stop_num, dtype=numpy.uint64)
+    stopping_times = numpy.zeros(len(start_nums), dtype=numpy.int64)
+    peaks = start_nums.copy()
+
+    if memo_table is not None:
+        memo_steps = numpy.asarray(memo_table[0], dtype=numpy.int64)
+        memo_peaks = numpy.asarray(memo_table[1], dtype=numpy.uint64)  # peaks above 2^53 must stay exact
+        memo_size = len(memo_steps)
+        known_below = memo_size
+    else:
+        # table of results for every number below memo_limit, filled as blocks below the limit are done
+        # a range that does not start at 1 or 2 cannot fill it, so only 1 is kept
+        memo_size = min(memo_limit, stop_num) if start_num <= 2 else 2
+        memo_steps = numpy.zeros(memo_size, dtype=numpy.int64)
+        memo_peaks = numpy.zeros(memo_size, dtype=numpy.uint64)
+        memo_peaks[1] = 1
+        # numbers below known_below are in the table, 1 always is. blocks extend it while the range is contiguous
+        known_below = 2
+
+    overflowed = list()
+    for block_start in range(0, len(start_nums), block_size):
+        block_end = min(block_start + block_size, len(start_nums))
+        index = numpy.arange(block_start, block_end)
+        values = start_nums[block_start:block_end].copy()
+        steps = numpy.zeros(len(index), dtype=numpy.int64)
+        block_peaks = values.copy()
+
+        while len(index) > 0:
+            # finished: reached a number whose result is already in the table
+            is_done = values < known_below
+            if numpy.any(is_done):
+                done_values = values[is_done].astype(numpy.int64)
+                done_index = index[is_done]
+                stopping_times[done_index] = steps[is_done] + memo_steps[done_values]
+                peaks[done_index] = numpy.maximum(block_peaks[is_done], memo_peaks[done_values])
+                index, values, steps, block_peaks = index[~is_done], values[~is_done], steps[~is_done], \
+                    block_peaks[~is_done]
+
+            is_odd = (values & numpy.uint64(1)).astype(bool)
+            is_overflow = is_odd & (values > numpy.uint64(_uint64_max_odd_input))
+            if numpy.any(is_overflow):
+                overflowed.extend(index[is_overflow].tolist())
+                keep = ~is_overflow
+                index, values, steps, block_peaks, is_odd = index[keep], values[keep], steps[keep], \
+                    block_peaks[keep], is_odd[keep]
+
+            values = numpy.where(is_odd, values * numpy.uint64(3) + numpy.uint64(1), values >> numpy.uint64(1))
+            steps += 1
+            numpy.maximum(block_peaks, values, out=block_peaks)
+
+        # the whole block is done, its numbers can now stop other sequences
+        block_last_num = int(start_nums[block_end - 1])
+        if memo_table is None and known_below >= int(start_nums[block_start]) and block_last_num < memo_size:
+            memo_start = int(start_nums[block_start])
+            memo_steps[memo_start:block_last_num + 1] = stopping_times[block_start:block_end]
+            memo_peaks[memo_start:block_last_num + 1] = peaks[block_start:block_end]
+            known_below = block_last_num + 1
+
+    for overflow_index in overflowed:
+        # finish the rare overflowing sequences with python integers, the peak no longer fits in uint64
+        num = int(start_nums[overflow_index])
+        exact_steps, exact_peaks = collatz_exact_batch(num, num + 1)
+        stopping_times[overflow_index] = exact_steps[0]
+        peaks[overflow_index] = min(exact_peaks[0], 2 ** 64 - 1)
+
+    return start_nums, stopping_times, peaks
+
+
+def write_collatz_store(save_dir, start_num, stop_num, with_trajectories=True, block_size=65536):
+    """
+    computes a range of start numbers and saves the results as typed .npy arrays instead of a JSON dict of strings
+    stopping_times.npy (int32) and peaks.npy (uint64) are indexed by start number - start_num
+    with trajectories, every sequence is stored back to back in one flat uint64 array, trajectories.npy, and
+    sequence i runs from offsets[i] to offsets[i + 1] in trajectory_offsets.npy (int64)
+    the trajectories are written through a memory map in lock-step blocks, so they never have to fit in memory
+    :param save_dir: directory to write the store to
+    :param start_num: first start number (>= 1)
+    :param stop_num: stop before this start number
+    :param with_trajectories: also store the full sequences
+    :param block_size: number of start numbers stepped together
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    start_nums, stopping_times, peaks = collatz_vectorised(start_num, stop_num, block_size=block_size)
+    numpy.save(os.path.join(save_dir, "stopping_times.npy"), stopping_times.astype(numpy.int32))
+    numpy.save(os.path.join(save_dir, "peaks.npy"), peaks)
+
+    if with_trajectories:
+        if numpy.any(peaks == numpy.uint64(2 ** 64 - 1)):
+            raise ValueError("a sequence in the range goes above the uint64 range and cannot be stored")
+
+        offsets = numpy.zeros(len(start_nums) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(stopping_times + 1)  # each sequence holds its start number and every step
+        numpy.save(os.path.join(save_dir, "trajectory_offsets.npy"), offsets)
+        trajectories = open_memmap(os.path.join(save_dir, "trajectories.npy"), mode="w+", dtype=numpy.uint64,
+                                   shape=(int(offsets[-1]),))
+        for block_start in range(0, len(start_nums), block_size):
+            block_end = min(block_start + block_size, len(start_nums))
+            values = start_nums[block_start:block_end].copy()
+            positions = offsets[block_start:block_end].copy()
+            while len(values) > 0:
+                trajectories[positions] = values
+                is_running = values != 1
+                values, positions = values[is_running], positions[is_running] + 1
+                is_odd = (values & numpy.uint64(1)).astype(bool)
+                values = numpy.where(is_odd, values * numpy.uint64(3) + numpy.uint64(1), values >> numpy.uint64(1))
+        trajectories.flush()
+        del trajectories
+
+    f = open(os.path.join(save_dir, "store.json"), "w")
+    json.dump({"start_num": start_num, "stop_num": stop_num, "with_trajectories": with_trajectories}, f, indent=4)
+    f.close()
+
+
+def load_collatz_store(save_dir):
+    """
+    opens a store written by write_collatz_store, the arrays are memory-mapped so nothing is read until it is used
+    :param save_dir: directory of the store
+    :return: dict with start_num, stop_num, stopping_times, peaks and, if stored, offsets and trajectories
+    """
+    f = open(os.path.join(save_dir, "store.json"))
+    store = json.load(f)
+    f.close()
+
+    store["stopping_times"] = numpy.load(os.path.join(save_dir, "stopping_times.npy"), mmap_mode="r")
+    store["peaks"] = numpy.load(os.path.join(save_dir, "peaks.npy"), mmap_mode="r")
+    if store["with_trajectories"]:
+        store["offsets"] = numpy.load(os.path.join(save_dir, "trajectory_offsets.npy"), mmap_mode="r")
+        store["trajectories"] = numpy.load(os.path.join(save_dir, "trajectories.npy"), mmap_mode="r")
+
+    return store
+
+
+def load_trajectory(store, num):
+    """
+    sequence for one start number from an opened store, read in O(1) from the offsets index
+    :param store: dict returned by load_collatz_store
+    :param num: start number
+    :return: uint64 array of the sequence from num down to 1
+    """
+    if not store["start_num"] <= num < store["stop_num"]:
+        raise KeyError("start number " + str(num) + " is not in the store")
+    if not store["with_trajectories"]:
+        raise KeyError("the store was written without trajectories")
+
+    index = num - store["start_num"]
+    return store["trajectories"][store["offsets"][index]:store["offsets"][index + 1]]
 
-    arg = "plot"
-    save_file = "collatz_series.json"
 
-    if arg == "run":
+# stopping time / peak table of small numbers held by each scan worker process, built once by _init_scan_worker
+_scan_memo_table = dict()
+
+
+def _init_scan_worker(memo_table_size):
+    """
+    process pool initializer, builds the shared table of small numbers that lets sequences in every block stop early
+    """
+    start_nums, stopping_times, peaks = collatz_vectorised(1, memo_table_size)
+    # typed zeros keep the table int64 / uint64, a python 0 would promote the peaks to float64 and round them
+    _scan_memo_table["table"] = (numpy.concatenate((numpy.zeros(1, numpy.int64), stopping_times)),
+                                 numpy.concatenate((numpy.zeros(1, numpy.uint64), peaks)))
+
+
+def _scan_block(block):
+    """
+    worker task, scans one block of start numbers and returns only its record holders
+    :param block: tuple of (first start number, stop before start number)
+    :return: block start, block stop, dict of record holders
+    """
+    block_start, block_stop = block
+    start_nums, stopping_times, peaks = collatz_vectorised(block_start, block_stop,
+                                                           memo_table=_scan_memo_table["table"])
+    longest, highest = numpy.argmax(stopping_times), numpy.argmax(peaks)
+    highest_peak = int(peaks[highest])
+    if highest_peak == 2 ** 64 - 1:
+        # sequences that went above the uint64 range hold a capped peak, their exact peaks decide the record
+        for capped in numpy.flatnonzero(peaks == numpy.uint64(2 ** 64 - 1)):
+            exact_peak = collatz_exact_batch(int(start_nums[capped]), int(start_nums[capped]) + 1)[1][0]
+            if exact_peak > highest_peak:
+                highest, highest_peak = capped, exact_peak
+    records = {"longest": [int(start_nums[longest]), int(stopping_times[longest])],
+               "highest": [int(start_nums[highest]), highest_peak]}
+    return block_start, block_stop, records
+
+
+def _save_scan_checkpoint(checkpoint_file, checkpoint):
+    """
+    writes the checkpoint to a temporary file and renames it, so an interrupted write never corrupts the last one
+    """
+    tmp_file = checkpoint_file + ".tmp"
+    f = open(tmp_file, "w")
+    json.dump(checkpoint, f, indent=4)
+    f.close()
+    os.replace(tmp_file, checkpoint_file)
+
+
+def scan_collatz_range(start_num, stop_num, block_size=1000000, workers=None, checkpoint_file=None,
+                       memo_table_size=1000000, verbose=True):
+    """
+    scans a large range of start numbers for the record holders (longest stopping time, highest peak)
+    the range is cut into blocks run by a process pool, and every finished block is recorded in a JSON checkpoint
+    with its record holders. run again with the same checkpoint file and range to resume after an interruption
+    :param start_num: first start number (>= 1)
+    :param stop_num: stop before this start number
+    :param block_size: number of start numbers per task and per checkpoint entry
+    :param workers: number of worker processes, None for all cores
+    :param checkpoint_file: path of the JSON checkpoint, None to not checkpoint
+    :param memo_table_size: each worker precomputes stopping times below this so sequences stop early
+    :param verbose: print progress after each block
+    :return: dict with the overall records, the numbers scanned in this call, seconds and numbers per second
+    """
+    checkpoint = {"start_num": start_num, "stop_num": stop_num, "block_size": block_size, "completed": dict()}
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        f = open(checkpoint_file)
+        saved = json.load(f)
+        f.close()
+        if [saved["start_num"], saved["stop_num"], saved["block_size"]] != [start_num, stop_num, block_size]:
+            raise ValueError("checkpoint " + checkpoint_file + " is for a different range or block size")
+        checkpoint = saved
+
+    blocks = [(block_start, min(block_start + block_size, stop_num))
+              for block_start in range(start_num, stop_num, block_size)
+              if str(block_start) not in checkpoint["completed"]]
+
+    scan_start = time.perf_counter()
+    numbers_scanned = 0
+    with multiprocessing.Pool(workers, initializer=_init_scan_worker, initargs=(memo_table_size,)) as proc_pool:
+        for block_start, block_stop, records in proc_pool.imap_unordered(_scan_block, blocks):
+            checkpoint["completed"][str(block_start)] = records
+            numbers_scanned += block_stop - block_start
+            if checkpoint_file is not None:
+                _save_scan_checkpoint(checkpoint_file, checkpoint)
+            if verbose:
+                print("Scanned block " + str(block_start) + "-" + str(block_stop) + ", " + str(len(checkpoint["completed"])) +
+                      " blocks done")
+    scan_seconds = time.perf_counter() - scan_start
+
+    # records over every block, including those done before a resume
+    all_records = list(checkpoint["completed"].values())
+    return {"longest": max((records["longest"] for records in all_records), key=lambda record: record[1]),
+            "highest": max((records["highest"] for records in all_records), key=lambda record: record[1]),
+            "numbers_scanned": numbers_scanned, "seconds": scan_seconds,
+            "numbers_per_second": numbers_scanned / scan_seconds if scan_seconds > 0 else 0.0}
+
+
+def plot_trajectories(store, numbers, save_path=None):
+    """
+    plots the stored sequences of the given start numbers
+    matplotlib is only imported here, so headless runs never load it
+    :param store: dict from load_collatz_store
+    :param numbers: list of start numbers to plot
+    :param save_path: file to save the figure to, None to show it
+    """
+    from matplotlib import pyplot
+
+    pyplot.subplot(1, 1, 1)
+    for data_index in numbers:
+        data = load_trajectory(store, data_index)
+        pyplot.plot(data)
+    pyplot.grid()
+    pyplot.xlabel("Iteration")
+    pyplot.ylabel("Value After Iteration")
+    if save_path is None:
+        pyplot.show()
+    else:
+        pyplot.savefig(save_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collatz conjecture stopping times, range scans and plots")
+    parser.add_argument("mode", nargs="?", default="plot", choices=["run", "scan", "plot"],
+                        help="run: store the sequences of a range, scan: find the record holders of a large range, "
+                             "plot: plot stored sequences")
+    parser.add_argument("--start", type=int, default=None, help="first start number")
+    parser.add_argument("--stop", type=int, default=None, help="stop before this start number")
+    parser.add_argument("--save-dir", default="collatz_series", help="directory of the stored sequences")
+    parser.add_argument("--checkpoint", default="collatz_scan_checkpoint.json", help="checkpoint file of a scan")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes of a scan, default all cores")
+    parser.add_argument("--numbers", type=int, nargs="+", default=[97], help="start numbers to plot")
+    parser.add_argument("--headless", action="store_true", help="no plots or progress, print the results as JSON")
+    parser.add_argument("--output", default=None, help="also write the results as JSON to this file")
+    parser.add_argument("--save", default=None, help="save the plot to this file instead of showing it")
+    args = parser.parse_args(argv)
+
+    results = dict()
+    if args.mode == "run":
 
         # ##################
         # make a list of numbers to run and store the results
         # ##################
-        start_num_list = list(range(2, 100))
-        results = dict()
-        for num in start_num_list:
-            # series = collatz_whileloop(num)
-            series = collatz_recursive(num)
-            print(series)
-
-            results[str(num)] = series
-
-        # save to json
-        f = open(save_file, "w")
-        json.dump(results, f, indent=4)
-        f.close()
+        # stopping times, peaks and full sequences saved as memory-mappable arrays
+        start_num = 2 if args.start is None else args.start
+        stop_num = 100 if args.stop is None else args.stop
+        write_collatz_store(args.save_dir, start_num, stop_num)
+        results = {"save_dir": args.save_dir, "start_num": start_num, "stop_num": stop_num}
 
-    if arg == "plot":
-        f = open(save_file)
-        series = json.load(f)
-        f.close()
+    if args.mode == "scan":
 
-        data_series = list(range(97, 98))
-        pyplot.subplot(1, 1, 1)
-        for data_index in data_series:
-            data = series[str(data_index)].split(",")
-            data = [int(x) for x in data]
-            pyplot.plot(data)
-        pyplot.grid()
-        pyplot.xlabel("Iteration")
-        pyplot.ylabel("Value After Iteration")
-        pyplot.show()
+        # ##################
+        # record holders for a large range, in parallel blocks with a checkpoint to resume from
+        # ##################
+        start_num = 1 if args.start is None else args.start
+        stop_num = 100000001 if args.stop is None else args.stop
+        results = scan_collatz_range(start_num, stop_num, workers=args.workers, checkpoint_file=args.checkpoint,
+                                     verbose=not args.headless)
+        if not args.headless:
+            print("Scanned " + str(results["numbers_scanned"]) + " numbers in " +
+                  str(round(results["seconds"], 2)) + "s (" + str(int(results["numbers_per_second"])) +
+                  " numbers/s)")
+            print("Longest stopping time: " + str(results["longest"][0]) + " with " +
+                  str(results["longest"][1]) + " steps")
+            print("Highest peak: " + str(results["highest"][0]) + " reaching " + str(results["highest"][1]))
 
+    if args.mode == "plot":
+        store = load_collatz_store(args.save_dir)
+        results = {"trajectories": {str(num): load_trajectory(store, num).tolist() for num in args.numbers}}
+        if not args.headless:
+            plot_trajectories(store, args.numbers, save_path=args.save)
 
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.headless and args.output is None:
+        print(json.dumps(results))
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# Reusable generator of correlated standard normal random variables
+# Same technique as correlated_randoms_with_cholesky.py: with L the Cholesky factor of the correlation matrix,
+# L @ (independent standard normals) gives standard normals with that correlation
+# The correlation matrix can be any size N x N. Matrices that are not positive definite (e.g. hand-edited or
+# estimated from incomplete data) are repaired to the nearest correlation matrix first
+# Cholesky factors are cached by the content of the matrix with decorator/caching.py, and draws are made in
+# fixed-size blocks from a seeded numpy.random.Generator, optionally as float32 and into a caller-provided buffer,
+# so nothing is materialised in full
+
+# imports
+import os
+import sys
+import numpy
+
+# the content-keyed memoisation decorator of this repo caches the Cholesky factors
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decorator"))
+import caching  # noqa: E402
+
+
+def nearest_positive_definite(correlation_matrix, min_eigenvalue=1e-8, max_iter=100, tol=1e-10):
+    """
+    nearest correlation matrix (symmetric, unit diagonal, positive definite) by Higham's alternating projections
+    :param correlation_matrix: N x N matrix, symmetrised first
+    :param min_eigenvalue: smallest eigenvalue allowed in the result
+    :param max_iter: maximum number of projection rounds
+    :param tol: stop when the matrix changes by less than this between rounds
+    :return: N x N positive definite correlation matrix
+    """
+    matrix = numpy.array(correlation_matrix, dtype=numpy.float64)
+    matrix = (matrix + matrix.T) / 2.0
+    correction = numpy.zeros_like(matrix)  # Dykstra's correction keeps the projections converging to the nearest
+
+    for iteration in range(max_iter):
+        previous = matrix
+        # project onto the positive definite matrices
+        shifted = matrix - correction
+        eigenvalues, eigenvectors = numpy.linalg.eigh(shifted)
+        projected = (eigenvectors * numpy.maximum(eigenvalues, min_eigenvalue)) @ eigenvectors.T
+        correction = projected - shifted
+        # project onto the unit diagonal matrices
+        matrix = projected.copy()
+        numpy.fill_diagonal(matrix, 1.0)
+        if numpy.abs(matrix - previous).max() < tol:
+            break
+
+    # unit diagonal step can leave a tiny negative eigenvalue, a final floor and rescale keeps it factorable
+    eigenvalues, eigenvectors = numpy.linalg.eigh((matrix + matrix.T) / 2.0)
+    matrix = (eigenvectors * numpy.maximum(eigenvalues, min_eigenvalue)) @ eigenvectors.T
+    scale = 1.0 / numpy.sqrt(numpy.diag(matrix))
+    return matrix * numpy.outer(scale, scale)
+
+
+@caching.memoize(max_entries=16)
+def _cholesky_factor(matrix, repair, dtype_str):
+    # factor of a float64 matrix, memoize keys it by the matrix content, repair and dtype and makes it read-only
+    try:
+        factor = numpy.linalg.cholesky(matrix)
+    except numpy.linalg.LinAlgError:
+        if not repair:
+            raise
+        factor = numpy.linalg.cholesky(nearest_positive_definite(matrix))
+    return factor.astype(dtype_str)
+
+
+def cached_cholesky(correlation_matrix, repair=True, dtype=numpy.float64):
+    """
+    lower triangular Cholesky factor of a correlation matrix, cached by the content of the matrix
+    :param correlation_matrix: N x N correlation matrix
+    :param repair: replace a matrix that is not positive definite by the nearest one instead of raising
+    :param dtype: numpy float type of the returned factor
+    :return: read-only N x N lower triangular factor L with L @ L.T == correlation matrix
+    """
+    matrix = numpy.ascontiguousarray(correlation_matrix, dtype=numpy.float64)
+    return _cholesky_factor(matrix, bool(repair), numpy.dtype(dtype).str)
+
+
+class CorrelatedNormalGenerator:
+    """
+    draws correlated standard normals for a correlation matrix, rows are variables and columns are draws
+    :param correlation_matrix: N x N correlation matrix, repaired if it is not positive definite
+    :param seed: seed (or numpy.random.SeedSequence) for the numpy.random.Generator
+    :param dtype: numpy.float64 or numpy.float32 output
+    :param repair: repair a matrix that is not positive definite instead of raising
+    """
+
+    def __init__(self, correlation_matrix, seed=None, dtype=numpy.float64, repair=True):
+        self.dtype = numpy.dtype(dtype)
+        self.cholesky = cached_cholesky(correlation_matrix, repair=repair, dtype=self.dtype)
+        self.num_vars = self.cholesky.shape[0]
+        self.random_state = numpy.random.default_rng(seed)
+        self._independent = numpy.empty(0, dtype=self.dtype)  # flat scratch buffer, grown on demand
+
+    def draw(self, num_draws, out=None):
+        """
+        one block of correlated draws
+        :param num_draws: number of draws (columns)
+        :param out: optional (N x num_draws) C-contiguous array of the generator's dtype to write into
+        :return: (N x num_draws) array of correlated standard normals, out if it was given
+        """
+        if len(self._independent) < self.num_vars * num_draws:
+            self._independent = numpy.empty(self.num_vars * num_draws, dtype=self.dtype)
+        # contiguous view of the front of the scratch buffer, standard_normal needs a contiguous out
+        independent = self._independent[:self.num_vars * num_draws].reshape((self.num_vars, num_draws))
+        self.random_state.standard_normal(out=independent, dtype=self.dtype)
+
+        if out is None:
+            out = numpy.empty((self.num_vars, num_draws), dtype=self.dtype)
+        return numpy.matmul(self.cholesky, independent, out=out)
+
+    def blocks(self, total_draws, block_size, out=None):
+        """
+        yields correlated draws in fixed-size blocks until total_draws have been made, the last block may be smaller
+        with out the blocks are written into that buffer, so each block is only valid until the next one is drawn
+        :param total_draws: total number of draws (columns) over all blocks
+        :param block_size: number of draws per block
+        :param out: optional (N x block_size) C-contiguous array of the generator's dtype to reuse for every block
+        :return: generator of (N x draws) arrays
+        """
+        for block_start in range(0, total_draws, block_size):
+            block_draws = min(block_size, total_draws - block_start)
+            block_out = None
+            if out is not None:
+                block_out = out if block_draws == block_size else out[:, :block_draws]
+            yield self.draw(block_draws, out=block_out)
+
+
+class StreamingCorrelation:
+    """
+    empirical correlation matrix of streamed blocks of draws from running sums, the draws are never held together
+    one matrix product per block replaces a pearsonr call per pair of variables
+    sums are kept around the mean of the first block to avoid cancellation in the float64 running sums
+    :param num_vars: number of variables N (rows of each block)
+    """
+
+    def __init__(self, num_vars):
+        self.num_vars = num_vars
+        self.count = 0
+        self.shift = None
+        self.sums = numpy.zeros(num_vars)
+        self.cross_products = numpy.zeros((num_vars, num_vars))
+
+    def update(self, block):
+        """
+        adds a block of draws
+        :param block: (N x draws) array, rows are variables
+        """
+        block = numpy.asarray(block, dtype=numpy.float64)
+        if self.shift is None:
+            self.shift = block.mean(axis=1)
+        centred = block - self.shift.reshape((-1, 1))
+        self.count += block.shape[1]
+        self.sums += centred.sum(axis=1)
+        self.cross_products += centred @ centred.T
+
+    def correlation(self):
+        """
+        empirical N x N correlation matrix of everything added so far
+        """
+        if self.count < 2:
+            raise ValueError("need at least 2 draws for a correlation")
+        covariance = (self.cross_products - numpy.outer(self.sums, self.sums) / self.count) / (self.count - 1)
+        std_devs = numpy.sqrt(numpy.diag(covariance))
+        return covariance / numpy.outer(std_devs, std_devs)
+
+    def max_abs_deviation(self, target_matrix):
+        """
+        largest absolute difference between the empirical and the target correlation matrix
+        :param target_matrix: N x N target correlation matrix
+        :return: max absolute deviation, (row, column) where it occurs
+        """
+        deviation = numpy.abs(self.correlation() - numpy.asarray(target_matrix))
+        worst = numpy.unravel_index(numpy.argmax(deviation), deviation.shape)
+        return deviation[worst], (int(worst[0]), int(worst[1]))
+
+
+def sample_correlation(draws):
+    """
+    empirical correlation matrix of a set of draws that is already in memory
+    :param draws: (N x draws) array, rows are variables
+    :return: N x N correlation matrix
+    """
+    validator = StreamingCorrelation(len(draws))
+    validator.update(draws)
+    return validator.correlation()
+
+
+def validate_generator(generator, target_matrix, total_draws, block_size=100000):
+    """
+    streams draws from a CorrelatedNormalGenerator and checks their correlation against a target matrix
+    :param generator: CorrelatedNormalGenerator
+    :param target_matrix: N x N target correlation matrix
+    :param total_draws: number of draws to check
+    :param block_size: number of draws per block
+    :return: max absolute deviation, (row, column) where it occurs
+    """
+    validator = StreamingCorrelation(generator.num_vars)
+    for block in generator.blocks(total_draws, block_size):
+        validator.update(block)
+    return validator.max_abs_deviation(target_matrix)
@@ -1,52 +1,118 @@
-
+import argparse
+import json
 import numpy
 from numpy.linalg import cholesky
-from matplotlib import pyplot
-from scipy.stats import pearsonr
-
-# constants
-vars = 2  # will make 2 variables comprised of random numbers
-rand_draws = 10000  # number of random draws
-mean = 0.0  # standard normal gauss mean
-std_dev = 1.0  # standard normal gauss std.dev
-
-# make high and low correlation matrices
-correlation_matrix_low = numpy.array([[1.0, 0.3], [0.3, 1.0]])
-correlation_matrix_high = numpy.array([[1.0, 0.95], [0.95, 1.0]])
-
-# make variables from random numbers
-rands = numpy.random.normal(mean, std_dev, size=(vars, rand_draws))  # this is a 2 x 10000
-
-# apply cholesky decomposition to get upper triangular
-upper_cholesky_low_corr = cholesky(correlation_matrix_low)
-upper_cholesky_high_corr = cholesky(correlation_matrix_high)
-
-# the product of rands and upper cholesky generates correlated variables
-correlated_rands_low_corr = upper_cholesky_low_corr @ rands
-correlated_rands_high_corr = upper_cholesky_high_corr @ rands
-
-# numerical result for the correlation. approximately equal to specified correlation
-rands_corr_coeff, p_0 = pearsonr(rands[0, :], rands[1, :])
-correlated_rands_corr_coeff_low, p_low = pearsonr(correlated_rands_low_corr[0, :],
-                                                  correlated_rands_low_corr[1, :])
-correlated_rands_corr_coeff_high, p_high = pearsonr(correlated_rands_high_corr[0, :],
-                                                    correlated_rands_high_corr[1, :])
-
-# plots
-pyplot.subplot(2, 2, 1)
-pyplot.scatter(rands[0, :], rands[1, :], s=1, marker="o")
-pyplot.xlabel("Corr=0, actual=" + str(round(rands_corr_coeff, 4)))
-
-pyplot.subplot(2, 2, 2)
-pyplot.scatter(correlated_rands_low_corr[0, :], correlated_rands_low_corr[1, :],s=1, marker="o")
-pyplot.xlabel("Corr=0.3, actual=" + str(round(correlated_rands_corr_coeff_low, 4)))
-
-pyplot.subplot(2, 2, 3)
-pyplot.scatter(rands[0, :], rands[1, :], s=1, marker="o")
-pyplot.xlabel("Corr=0, actual=" + str(round(rands_corr_coeff, 4)))
-
-pyplot.subplot(2, 2, 4)
-pyplot.scatter(correlated_rands_high_corr[0, :], correlated_rands_high_corr[1, :], s=1, marker="o")
-pyplot.xlabel("Corr=0.95, actual=" + str(round(correlated_rands_corr_coeff_high, 4)))
-
-pyplot.show()
+
+from correlated_generator import sample_correlation
+
+
+def correlated_pairs(target_correlations=(0.3, 0.95), rand_draws=10000, mean=0.0, std_dev=1.0, seed=None):
+    """
+    makes 2 variables of random numbers and correlates them with the Cholesky factor of each target correlation
+    :param target_correlations: list of correlations to apply to the same random numbers
+    :param rand_draws: number of random draws
+    :param mean: standard normal gauss mean
+    :param std_dev: standard normal gauss std.dev
+    :param seed: seed of the random numbers
+    :return: dict of the 2 x draws arrays and their actual correlations
+    """
+    # make variables from random numbers
+    rands = numpy.random.default_rng(seed).normal(mean, std_dev, size=(2, rand_draws))  # this is a 2 x draws
+
+    results = {"rands": rands, "rands_corr_coeff": sample_correlation(rands)[0, 1],
+               "correlated": dict(), "correlated_corr_coeff": dict()}
+    for target_correlation in target_correlations:
+        # apply cholesky decomposition to get the lower triangular factor
+        correlation_matrix = numpy.array([[1.0, target_correlation], [target_correlation, 1.0]])
+        lower_cholesky = cholesky(correlation_matrix)
+
+        # the product of rands and the cholesky factor generates correlated variables
+        correlated_rands = lower_cholesky @ rands
+
+        # numerical result for the correlation. approximately equal to specified correlation
+        # whole empirical correlation matrix at once instead of one pearsonr call per pair of rows
+        results["correlated"][target_correlation] = correlated_rands
+        results["correlated_corr_coeff"][target_correlation] = sample_correlation(correlated_rands)[0, 1]
+
+    return results
+
+
+def density_image(axes, draws, bins=100):
+    """
+    draws a 2 x draws array as one image of the number of draws per grid cell instead of one marker per draw
+    the cost of drawing does not depend on the number of draws
+    :param axes: matplotlib axes to draw on
+    :param draws: 2 x draws array, row 0 on x and row 1 on y
+    :param bins: number of grid cells along each axis
+    """
+    counts, x_edges, y_edges = numpy.histogram2d(draws[0, :], draws[1, :], bins=bins)
+    counts[counts == 0] = numpy.nan  # empty cells are left blank
+    axes.imshow(counts.T, origin="lower", aspect="auto", cmap="viridis", interpolation="nearest",
+                extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]))
+
+
+def plot_correlated_pairs(results, save_path=None, density=True, bins=100):
+    """
+    one row per target correlation: the uncorrelated draws next to the correlated draws
+    by default each panel is one binned image of the draws (see density_image), so plot time and file size do not
+    grow with the number of draws
+    matplotlib is only imported here, so headless runs never load it
+    :param results: dict from correlated_pairs
+    :param save_path: file to save the figure to, None to show it
+    :param density: draw binned images, False for one scatter marker per draw
+    :param bins: number of grid cells along each axis of the binned images
+    """
+    from matplotlib import pyplot
+
+    rands = results["rands"]
+    num_rows = len(results["correlated"])
+    for row, (target_correlation, correlated_rands) in enumerate(results["correlated"].items()):
+        labels = ["Corr=0, actual=" + str(round(results["rands_corr_coeff"], 4)),
+                  "Corr=" + str(target_correlation) + ", actual=" +
+                  str(round(results["correlated_corr_coeff"][target_correlation], 4))]
+        for column, (draws, label) in enumerate(zip([rands, correlated_rands], labels)):
+            axes = pyplot.subplot(num_rows, 2, 2 * row + column + 1)
+            if density:
+                density_image(axes, draws, bins=bins)
+            else:
+                axes.scatter(draws[0, :], draws[1, :], s=1, marker="o")
+            axes.set_xlabel(label)
+
+    pyplot.tight_layout()  # keeps the x labels of one row clear of the plots below
+    if save_path is None:
+        pyplot.show()
+    else:
+        pyplot.savefig(save_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="correlate 2 random variables with a Cholesky factor")
+    parser.add_argument("--correlations", type=float, nargs="+", default=[0.3, 0.95], help="target correlations")
+    parser.add_argument("--draws", type=int, default=10000, help="number of random draws")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random numbers")
+    parser.add_argument("--headless", action="store_true", help="no plots, print the actual correlations as JSON")
+    parser.add_argument("--output", default=None, help="also write the actual correlations as JSON to this file")
+    parser.add_argument("--save", default=None, help="save the plot to this file instead of showing it")
+    parser.add_argument("--scatter", action="store_true", help="plot one marker per draw instead of binned images")
+    parser.add_argument("--bins", type=int, default=100, help="grid cells along each axis of the binned images")
+    args = parser.parse_args(argv)
+
+    results = correlated_pairs(args.correlations, rand_draws=args.draws, seed=args.seed)
+    summary = {"draws": args.draws, "uncorrelated": float(results["rands_corr_coeff"]),
+               "correlated": {str(target_correlation): float(actual)
+                              for target_correlation, actual in results["correlated_corr_coeff"].items()}}
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump(summary, json_file, indent=2)
+
+    if args.headless:
+        if args.output is None:
+            print(json.dumps(summary))
+    else:
+        plot_correlated_pairs(results, save_path=args.save, density=not args.scatter, bins=args.bins)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
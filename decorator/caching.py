@@ -0,0 +1,269 @@
+# Bounded memoisation decorator, a companion to func_call_log in example.py
+# repeated pure calls with the same arguments (inverse normal of the same PD list, Cholesky factor of the same
+# correlation matrix, stopping times of numbers already seen) return the stored result instead of recomputing it
+# arguments are keyed by content: numpy arrays and pandas objects are hashed from their data, dtype and shape
+# instead of their identity, so an equal array made elsewhere is still a hit
+# the cache is bounded by number of entries and optionally by bytes, least recently used entries are evicted first,
+# and entries can expire after a time to live
+# an optional on-disk tier keeps pickled results in a directory so they survive across runs
+# cached numpy results are made read-only, since every hit returns the same array
+
+import collections
+import functools
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+import numpy
+
+
+def _update_hash(hasher, value):
+    """
+    feeds a value into a hash by content, recursing into containers
+    """
+    if isinstance(value, numpy.ndarray):
+        hasher.update(b"ndarray" + value.dtype.str.encode() + str(value.shape).encode())
+        hasher.update(numpy.ascontiguousarray(value).tobytes())
+    elif type(value).__module__.startswith("pandas") and hasattr(value, "to_numpy"):
+        import pandas
+        hasher.update(type(value).__name__.encode() + str(value.shape).encode())
+        hasher.update(pandas.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        if isinstance(value, pandas.DataFrame):
+            _update_hash(hasher, list(value.columns))
+            _update_hash(hasher, [str(dtype) for dtype in value.dtypes])
+        else:
+            _update_hash(hasher, (value.name, str(value.dtype)))
+    elif isinstance(value, (list, tuple)):
+        hasher.update(type(value).__name__.encode() + str(len(value)).encode())
+        for item in value:
+            _update_hash(hasher, item)
+    elif isinstance(value, dict):
+        hasher.update(b"dict" + str(len(value)).encode())
+        for item_key in sorted(value, key=repr):
+            _update_hash(hasher, item_key)
+            _update_hash(hasher, value[item_key])
+    elif isinstance(value, (str, bytes, int, float, complex, bool, type(None), numpy.generic)):
+        hasher.update(type(value).__name__.encode() + repr(value).encode())
+    else:
+        hasher.update(pickle.dumps(value))
+
+
+def make_key(args, kwargs):
+    """
+    content digest of a call's arguments
+    :param args: positional arguments
+    :param kwargs: keyword arguments
+    :return: hex digest string
+    """
+    hasher = hashlib.sha1()
+    _update_hash(hasher, args)
+    _update_hash(hasher, kwargs)
+    return hasher.hexdigest()
+
+
+def size_of(value):
+    """
+    approximate size in bytes of a cached value
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if type(value).__module__.startswith("pandas") and hasattr(value, "memory_usage"):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(size_of(item_key) + size_of(item) for item_key, item in value.items())
+    return sys.getsizeof(value)
+
+
+def _freeze(value):
+    # results are shared by every hit, numpy arrays are made read-only so a caller cannot change the cached copy
+    if isinstance(value, numpy.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, tuple):
+        for item in value:
+            _freeze(item)
+    return value
+
+
+class BoundedCache:
+    """
+    least recently used cache bounded by entries and bytes, with an optional time to live and on-disk tier
+    :param max_entries: maximum number of entries held in memory
+    :param max_bytes: maximum total size of the entries held in memory, None for no limit
+    :param ttl: seconds an entry stays valid, None for no expiry
+    :param disk_dir: directory of the on-disk tier, None to keep results in memory only
+    :param name: prefix of the on-disk file names
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None, ttl=None, disk_dir=None, name="cache"):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.name = name
+        self._entries = collections.OrderedDict()  # key -> (value, size in bytes, expiry time)
+        self._lock = threading.RLock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, self.name + "_" + key + ".pkl")
+
+    def get(self, key):
+        """
+        cached value of a key
+        :param key: key from make_key
+        :return: (True, value) on a hit, (False, None) on a miss
+        """
+        with self._lock:
+            if key in self._entries:
+                value, size, expires = self._entries[key]
+                if expires is None or time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                self._remove(key)
+
+        if self.disk_dir is not None:
+            found, value = self._read_disk(key)
+            if found:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._store(key, value)
+                return True, value
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        """
+        stores a value in memory, and on disk if the on-disk tier is used
+        """
+        value = _freeze(value)
+        with self._lock:
+            self._store(key, value)
+        if self.disk_dir is not None:
+            self._write_disk(key, value)
+
+    def _store(self, key, value):
+        size = size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # larger than the whole budget, not kept in memory
+        if key in self._entries:
+            self._remove(key)
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (value, size, expires)
+        self.current_bytes += size
+        while len(self._entries) > self.max_entries or \
+                (self.max_bytes is not None and self.current_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))  # least recently used
+            self.evictions += 1
+
+    def _remove(self, key):
+        value, size, expires = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) >= self.ttl:
+                return False, None
+            with open(path, "rb") as disk_file:
+                return True, _freeze(pickle.load(disk_file))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def _write_disk(self, key, value):
+        # written under a temporary name and renamed so a reader never loads a partial file
+        os.makedirs(self.disk_dir, exist_ok=True)
+        path = self._disk_path(key)
+        tmp_path = path + ".tmp" + str(os.getpid())
+        with open(tmp_path, "wb") as disk_file:
+            pickle.dump(value, disk_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def info(self):
+        """
+        hit and miss statistics and the current size of the memory tier
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "entries": len(self._entries), "bytes": self.current_bytes}
+
+    def clear(self, disk=False):
+        """
+        empties the memory tier and resets the statistics
+        :param disk: also delete this cache's files from the on-disk tier
+        """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = self.disk_hits = self.misses = self.evictions = 0
+        if disk and self.disk_dir is not None and os.path.isdir(self.disk_dir):
+            for file_name in os.listdir(self.disk_dir):
+                if file_name.startswith(self.name + "_") and file_name.endswith(".pkl"):
+                    os.remove(os.path.join(self.disk_dir, file_name))
+
+
+def memoize(func=None, max_entries=128, max_bytes=None, ttl=None, disk_dir=None):
+    """
+    decorator caching the results of a pure function by the content of its arguments, usable as @memoize or
+    @memoize(...). the wrapped function has cache_info() and cache_clear(), and the BoundedCache as .cache
+    :param func: function to wrap
+    :param max_entries: maximum number of results held in memory
+    :param max_bytes: maximum total size of the results held in memory, None for no limit
+    :param ttl: seconds a result stays valid, None for no expiry
+    :param disk_dir: directory to also keep pickled results in across runs, None for memory only
+    """
+    if func is None:
+        return functools.partial(memoize, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, disk_dir=disk_dir)
+
+    cache = BoundedCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, disk_dir=disk_dir,
+                         name=func.__module__ + "." + func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper_memoize(*args, **kwargs):
+        key = make_key(args, kwargs)
+        found, value = cache.get(key)
+        if found:
+            return value
+        value = func(*args, **kwargs)
+        cache.put(key, value)
+        return value
+
+    wrapper_memoize.cache = cache
+    wrapper_memoize.cache_info = cache.info
+    wrapper_memoize.cache_clear = cache.clear
+    return wrapper_memoize
+
+
+@memoize(max_entries=16, max_bytes=64 * 1024 * 1024)
+def cholesky_factor(correlation_matrix):
+    return numpy.linalg.cholesky(correlation_matrix)
+
+
+# main runtime chunk
+if __name__ == "__main__":
+    size = 1000
+    rands = numpy.random.normal(size=(size, 2 * size))
+    corr = numpy.corrcoef(rands)
+
+    start = time.perf_counter()
+    factor = cholesky_factor(corr)
+    print("first call " + str(time.perf_counter() - start) + " s")
+
+    start = time.perf_counter()
+    factor = cholesky_factor(corr.copy())  # a different array with the same content is a hit
+    print("second call " + str(time.perf_counter() - start) + " s")
+
+    print(cholesky_factor.cache_info())
@@ -0,0 +1,306 @@
+# Low overhead instrumentation decorators, companions to func_call_log in example.py
+# func_call_log prints and stringifies every call, which dominates the runtime of anything called often
+# these decorators instead record into an in-memory registry:
+#   count_calls - number of calls only
+#   profiled    - call counts, latencies with perf_counter_ns (total, min, max and percentiles from a bounded sample)
+#                 and optionally bytes allocated during the call with tracemalloc
+# a sample rate times only every n-th call, the others just count
+# when disabled with disable() a wrapper costs one attribute check per call, and with PROFILING_DISABLED=1 set in the
+# environment the decorators return the function unchanged at no cost at all
+# each process has its own registry (cleared in a forked child), snapshots from worker processes can be merged
+# into the parent's registry and the summary dumped to JSON
+
+import functools
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+import numpy
+
+
+class _FunctionStats:
+    """
+    statistics of one instrumented function, updated under the registry lock
+    """
+
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.counter = itertools.count()  # next() is atomic, so unsampled calls are counted without the lock
+        self.counts_read = 0  # values taken from the counter that were not calls
+        self.reset()
+
+    def reset(self):
+        """
+        zeroes the statistics in place, wrappers keep a reference to this object and its counter
+        """
+        self.counts_read = next(self.counter) + 1
+        self.merged_calls = 0  # calls merged in from other processes
+        self.sampled_calls = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.samples = list()  # reservoir of sampled latencies in ns
+        self.samples_seen = 0
+        self.alloc_calls = 0
+        self.alloc_total = 0
+        self.alloc_max = 0
+
+    def call_count(self):
+        """
+        number of calls so far, reading the count takes one value from the counter so it is subtracted again
+        """
+        calls = next(self.counter) - self.counts_read + self.merged_calls
+        self.counts_read += 1
+        return calls
+
+
+class ProfileRegistry:
+    """
+    thread-safe registry of instrumented function statistics for one process
+    :param max_samples: latencies kept per function for the percentiles, a uniform reservoir sample beyond that
+    """
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._stats = dict()
+        self.pid = os.getpid()
+
+    def _reset_after_fork(self):
+        # a forked child starts from zero so its calls are not mixed with the parent's
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+        self.clear()
+
+    def stats_for(self, name, sample_rate=1.0):
+        """
+        statistics entry of a function, made on first use
+        """
+        with self._lock:
+            if name not in self._stats:
+                self._stats[name] = _FunctionStats(sample_rate)
+            return self._stats[name]
+
+    def record(self, name, elapsed_ns, allocated=None):
+        """
+        adds one sampled call to the statistics of a function
+        :param name: function name
+        :param elapsed_ns: latency of the call in ns
+        :param allocated: peak bytes allocated during the call, None if not traced
+        """
+        with self._lock:
+            stats = self._stats[name]
+            stats.sampled_calls += 1
+            stats.total_ns += elapsed_ns
+            stats.min_ns = elapsed_ns if stats.min_ns is None else min(stats.min_ns, elapsed_ns)
+            stats.max_ns = max(stats.max_ns, elapsed_ns)
+            stats.samples_seen += 1
+            if len(stats.samples) < self.max_samples:
+                stats.samples.append(elapsed_ns)
+            else:
+                slot = random.randrange(stats.samples_seen)
+                if slot < self.max_samples:
+                    stats.samples[slot] = elapsed_ns
+            if allocated is not None:
+                stats.alloc_calls += 1
+                stats.alloc_total += allocated
+                stats.alloc_max = max(stats.alloc_max, allocated)
+
+    def snapshot(self):
+        """
+        raw statistics as plain types, e.g. to return from a worker process and merge into the parent's registry
+        :return: dict of function name to statistics
+        """
+        with self._lock:
+            return {name: {"sample_rate": stats.sample_rate, "calls": stats.call_count(),
+                           "sampled_calls": stats.sampled_calls, "total_ns": stats.total_ns, "min_ns": stats.min_ns,
+                           "max_ns": stats.max_ns, "samples": list(stats.samples),
+                           "samples_seen": stats.samples_seen, "alloc_calls": stats.alloc_calls,
+                           "alloc_total": stats.alloc_total, "alloc_max": stats.alloc_max}
+                    for name, stats in self._stats.items()}
+
+    def merge(self, snapshot):
+        """
+        adds a snapshot from another registry, e.g. from a worker process
+        latency samples are concatenated and cut back to max_samples at random if there are too many
+        :param snapshot: dict returned by snapshot()
+        """
+        with self._lock:
+            for name, other in snapshot.items():
+                if name not in self._stats:
+                    self._stats[name] = _FunctionStats(other["sample_rate"])
+                stats = self._stats[name]
+                stats.merged_calls += other["calls"]
+                stats.sampled_calls += other["sampled_calls"]
+                stats.total_ns += other["total_ns"]
+                if other["min_ns"] is not None:
+                    stats.min_ns = other["min_ns"] if stats.min_ns is None else min(stats.min_ns, other["min_ns"])
+                stats.max_ns = max(stats.max_ns, other["max_ns"])
+                stats.samples.extend(other["samples"])
+                stats.samples_seen += other["samples_seen"]
+                if len(stats.samples) > self.max_samples:
+                    stats.samples = random.sample(stats.samples, self.max_samples)
+                stats.alloc_calls += other["alloc_calls"]
+                stats.alloc_total += other["alloc_total"]
+                stats.alloc_max = max(stats.alloc_max, other["alloc_max"])
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        summary statistics per function, latencies in microseconds
+        total time is estimated from the sampled calls when a sample rate below 1 is used
+        :param percentiles: latency percentiles to report
+        :return: dict of function name to statistics
+        """
+        summary = dict()
+        for name, stats in self.snapshot().items():
+            entry = {"calls": stats["calls"], "sampled_calls": stats["sampled_calls"],
+                     "sample_rate": stats["sample_rate"]}
+            if stats["sampled_calls"] > 0:
+                mean_ns = stats["total_ns"] / stats["sampled_calls"]
+                entry["mean_us"] = mean_ns / 1e3
+                entry["est_total_ms"] = mean_ns * stats["calls"] / 1e6
+                entry["min_us"] = stats["min_ns"] / 1e3
+                entry["max_us"] = stats["max_ns"] / 1e3
+                for pctl, value in zip(percentiles, numpy.percentile(stats["samples"], percentiles)):
+                    entry["p" + str(pctl) + "_us"] = float(value) / 1e3
+            if stats["alloc_calls"] > 0:
+                entry["mean_alloc_bytes"] = stats["alloc_total"] / stats["alloc_calls"]
+                entry["max_alloc_bytes"] = stats["alloc_max"]
+            summary[name] = entry
+
+        return summary
+
+    def dump_json(self, path, percentiles=(50, 90, 99)):
+        """
+        writes the summary to a JSON file
+        :param path: output file path
+        :param percentiles: latency percentiles to report
+        """
+        with open(path, "w") as json_file:
+            json.dump({"pid": self.pid, "functions": self.summary(percentiles)}, json_file, indent=2)
+
+    def clear(self):
+        """
+        zeroes all recorded statistics
+        """
+        with self._lock:
+            for stats in self._stats.values():
+                stats.reset()
+
+
+# default registry of this process
+registry = ProfileRegistry()
+os.register_at_fork(after_in_child=registry._reset_after_fork)
+
+# decorators return functions unchanged when this is set in the environment at import
+_decorators_disabled = os.environ.get("PROFILING_DISABLED", "") not in ("", "0")
+_started_tracemalloc = False  # tracemalloc was started by a trace_memory decorator, stopped again by disable()
+
+
+def enable():
+    registry.enabled = True
+
+
+def disable():
+    # wrapped functions only check this flag and call straight through
+    global _started_tracemalloc
+    registry.enabled = False
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+
+def count_calls(func):
+    """
+    decorator counting the calls of a function, without timing them
+    """
+    if _decorators_disabled:
+        return func
+
+    name = func.__module__ + "." + func.__qualname__
+    stats = registry.stats_for(name)
+    counter = stats.counter
+
+    @functools.wraps(func)
+    def wrapper_count_calls(*args, **kwargs):
+        if registry.enabled:
+            next(counter)
+        return func(*args, **kwargs)
+
+    return wrapper_count_calls
+
+
+def profiled(func=None, name=None, sample_rate=1.0, trace_memory=False):
+    """
+    decorator recording call counts and latencies of a function, usable as @profiled or @profiled(...)
+    :param func: function to wrap
+    :param name: name in the registry, defaults to module.qualified_name
+    :param sample_rate: fraction of calls that are timed, every round(1 / sample_rate)-th call is timed
+    :param trace_memory: also record the peak bytes allocated during timed calls with tracemalloc
+                         (slow, starts tracemalloc if it is not running, nested traced calls share the peak)
+    """
+    if func is None:
+        return functools.partial(profiled, name=name, sample_rate=sample_rate, trace_memory=trace_memory)
+    if _decorators_disabled:
+        return func
+
+    if name is None:
+        name = func.__module__ + "." + func.__qualname__
+    sample_interval = max(1, int(round(1.0 / sample_rate)))
+    stats = registry.stats_for(name, sample_rate=1.0 / sample_interval)
+    counter = stats.counter
+    perf_counter_ns = time.perf_counter_ns
+
+    @functools.wraps(func)
+    def wrapper_profiled(*args, **kwargs):
+        global _started_tracemalloc
+        if not registry.enabled:
+            return func(*args, **kwargs)
+        if next(counter) % sample_interval:
+            return func(*args, **kwargs)
+
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _started_tracemalloc = True
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start_ns = perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_ns = perf_counter_ns() - start_ns
+            allocated = tracemalloc.get_traced_memory()[1] - start_bytes if trace_memory else None
+            registry.record(name, elapsed_ns, allocated)
+
+    return wrapper_profiled
+
+
+@profiled
+def add_two_numbers(a, b):
+    z = a + b
+    return z
+
+
+@profiled(sample_rate=0.1, trace_memory=True)
+def make_list(n):
+    return list(range(n))
+
+
+# main runtime chunk
+if __name__ == "__main__":
+    for i in range(10000):
+        add_two_numbers(i, i)
+        make_list(1000)
+
+    print(json.dumps(registry.summary(), indent=2))
+
+    disable()
+    disabled_start = time.perf_counter()
+    for i in range(10000):
+        add_two_numbers(i, i)
+    print("10000 calls while disabled: " + str(time.perf_counter() - disabled_start) + " s")
@@ -1,19 +1,21 @@
 
 # sample calculation to make the Markowitz efficient frontier
 
+import argparse
+import json
 import math
 import numpy as np
-import numpy.random
-import pandas as pd
-import matplotlib as mpl
-from matplotlib import pyplot as plt
 
 
-def calc_portfolio_weighted_avg(weights):
+def calc_portfolio_weighted_avg(weights, universe=None):
     """
     weighted average portfolio return. calculated as Sum (weight_i * return_i)
     :param weights: dataframe with asset_name as row key
+    :param universe: AssetUniverse to take the returns from, defaults to the script's asset_properties
     """
+    if universe is not None:
+        return universe.weights_array(weights) @ universe.avg_returns
+
     weighted_return = 0
     for asset_name in weights.keys():
         weighted_return += weights[asset_name] * asset_properties[asset_name]["avg_return"]
@@ -21,11 +23,16 @@ def calc_portfolio_weighted_avg(weights):
     return weighted_return
 
 
-def calc_portfolio_weighted_stddev(weights):
+def calc_portfolio_weighted_stddev(weights, universe=None):
     """
     weighted std dev of returns. calculated as SUM_i(SUM_j( w_i * w_j * stddev_i * stddev_j * Corr_ij))
     :param weights: dataframe with asset_name as row key
+    :param universe: AssetUniverse to take the covariance from, defaults to the script's asset_properties
     """
+    if universe is not None:
+        weights_array = universe.weights_array(weights)
+        return math.sqrt(weights_array @ universe.covariance() @ weights_array)
+
     weighted_risk = 0
     for asset_name_i in weights.keys():
         for asset_name_j in weights.keys():
@@ -38,58 +45,659 @@ def calc_portfolio_weighted_stddev(weights):
     return weighted_risk
 
 
-def calc_portfolio_risk_return(weights):
+def calc_portfolio_risk_return(weights, universe=None):
     """
     one function to call both risk and return calcs
     :param weights: dataframe with asset_name as row key
+    :param universe: AssetUniverse to use, defaults to the script's asset_properties
     :return:
     """
-    portfolio_risk = calc_portfolio_weighted_stddev(weights)
-    portfolio_return = calc_portfolio_weighted_avg(weights)
+    portfolio_risk = calc_portfolio_weighted_stddev(weights, universe)
+    portfolio_return = calc_portfolio_weighted_avg(weights, universe)
     sharpe_ratio = portfolio_return / portfolio_risk
 
     return portfolio_risk, portfolio_return, sharpe_ratio
 
 
-if __name__ == "__main__":
+def calc_covariance(std_devs, correlations):
+    """
+    covariance matrix from asset std devs and a symmetric correlation matrix. Cov_ij = stddev_i * stddev_j * Corr_ij
+    :param std_devs: array of asset std devs
+    :param correlations: (assets x assets) symmetric correlation matrix
+    :return: (assets x assets) covariance array
+    """
+    std_devs = np.asarray(std_devs, dtype=float)
+    return np.outer(std_devs, std_devs) * np.asarray(correlations, dtype=float)
+
+
+class FactorCovariance:
+    """
+    low rank factor covariance Cov = B F B' + D for large universes, never built as a dense assets x assets matrix
+    with E = B chol(F) the portfolio variance is ||E' w||^2 + SUM(D_i * w_i^2), O(assets x factors) per portfolio
+    :param loadings: (assets x factors) factor loadings B
+    :param factor_covariance: (factors x factors) factor covariance F
+    :param specific_variances: array of asset specific (diagonal) variances D
+    :param dtype: numpy float type to hold the arrays in, np.float32 halves memory and bandwidth
+    """
+
+    def __init__(self, loadings, factor_covariance, specific_variances, dtype=np.float64):
+        loadings = np.asarray(loadings, dtype=np.float64)
+        factor_cholesky = np.linalg.cholesky(np.asarray(factor_covariance, dtype=np.float64))
+        self.dtype = dtype
+        self.exposures = np.ascontiguousarray(loadings @ factor_cholesky, dtype=dtype)  # E = B chol(F)
+        self.specific_variances = np.asarray(specific_variances, dtype=dtype)
+
+    @classmethod
+    def from_returns(cls, returns, num_factors, dtype=np.float64):
+        """
+        statistical factor model from a returns panel, the factors are the top principal components
+        :param returns: (periods x assets) array of asset returns
+        :param num_factors: number of principal component factors to keep
+        :param dtype: numpy float type to hold the arrays in
+        :return: FactorCovariance
+        """
+        returns = np.asarray(returns, dtype=np.float64)
+        demeaned = returns - returns.mean(axis=0)
+        num_periods = returns.shape[0]
+        left_vectors, singular_values, right_vectors = np.linalg.svd(demeaned, full_matrices=False)
+        loadings = right_vectors[:num_factors].T
+        factor_variances = singular_values[:num_factors] ** 2 / (num_periods - 1)
+        # whatever the factors do not explain is the specific variance, kept positive so Cov stays invertible
+        total_variances = (demeaned ** 2).sum(axis=0) / (num_periods - 1)
+        specific_variances = total_variances - (loadings ** 2) @ factor_variances
+        specific_variances = np.maximum(specific_variances, 1e-6 * total_variances.mean())
+        return cls(loadings, np.diag(factor_variances), specific_variances, dtype=dtype)
+
+    def __len__(self):
+        return len(self.specific_variances)
+
+    def portfolio_variance(self, weights):
+        """
+        w' Cov w for each column of an (assets x portfolios) weights array
+        """
+        factor_exposure = self.exposures.T @ weights
+        return (factor_exposure ** 2).sum(axis=0) + self.specific_variances @ (weights ** 2)
+
+    def __matmul__(self, weights):
+        """
+        Cov @ w without building Cov
+        """
+        specific_variances = self.specific_variances if weights.ndim == 1 else self.specific_variances.reshape((-1, 1))
+        return self.exposures @ (self.exposures.T @ weights) + specific_variances * weights
+
+    def solve(self, values):
+        """
+        Cov^-1 @ values with the Woodbury identity, O(assets x factors^2)
+        D^-1 x - D^-1 E (I + E' D^-1 E)^-1 E' D^-1 x
+        """
+        exposures = self.exposures.astype(np.float64)
+        inv_specific = 1.0 / self.specific_variances.astype(np.float64)
+        scaled_values = inv_specific * values
+        capacitance = np.eye(exposures.shape[1]) + exposures.T @ (inv_specific.reshape((-1, 1)) * exposures)
+        return scaled_values - inv_specific * (exposures @ np.linalg.solve(capacitance, exposures.T @ scaled_values))
+
+    def solve_subset(self, index, values):
+        """
+        Cov_SS^-1 @ values for the sub-covariance of the assets in index, with the Woodbury identity on E_S E_S' + D_S
+        O(len(index) x factors^2), used by the long only frontier solve on its free assets
+        :param index: array of asset positions
+        :param values: (len(index),) or (len(index) x columns) array
+        :return: array like values
+        """
+        exposures = self.exposures[index].astype(np.float64)
+        inv_specific = 1.0 / self.specific_variances[index].astype(np.float64)
+        if np.ndim(values) == 2:
+            inv_specific = inv_specific.reshape((-1, 1))
+        scaled_values = inv_specific * values
+        capacitance = np.eye(exposures.shape[1]) + exposures.T @ (inv_specific.reshape((-1, 1)) * exposures)
+        return scaled_values - inv_specific * (exposures @ np.linalg.solve(capacitance, exposures.T @ scaled_values))
+
+    def to_dense(self):
+        """
+        dense (assets x assets) covariance, only for universes small enough to hold it
+        """
+        return self.exposures @ self.exposures.T + np.diag(self.specific_variances)
+
+
+def shrinkage_covariance(returns, dtype=np.float64):
+    """
+    Ledoit-Wolf covariance estimate from a returns panel, the sample covariance shrunk towards a scaled identity
+    stays well conditioned when there are more assets than periods, where the sample covariance is singular
+    :param returns: (periods x assets) array of asset returns
+    :param dtype: numpy float type of the returned matrix
+    :return: (assets x assets) covariance array, shrinkage intensity between 0 and 1
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    demeaned = returns - returns.mean(axis=0)
+    num_periods, num_assets = demeaned.shape
+    sample_covariance = demeaned.T @ demeaned / num_periods
+    target_scale = np.trace(sample_covariance) / num_assets
+
+    # distance of the sample covariance from the target and the estimation noise in it (Ledoit & Wolf 2004)
+    distance = ((sample_covariance - target_scale * np.eye(num_assets)) ** 2).sum()
+    squared_norms = (demeaned ** 2).sum(axis=1)
+    noise = ((squared_norms ** 2).sum() / num_periods - 2.0 * ((demeaned @ sample_covariance) * demeaned).sum() /
+             num_periods + (sample_covariance ** 2).sum()) / num_periods
+    shrinkage = min(1.0, max(0.0, noise / distance)) if distance > 0 else 1.0
+
+    covariance = (1.0 - shrinkage) * sample_covariance
+    covariance[np.diag_indices(num_assets)] += shrinkage * target_scale
+    return covariance.astype(dtype), shrinkage
+
+
+def _solve_covariance(covariance, values):
+    """
+    Cov^-1 @ values for a dense or factor covariance
+    """
+    if isinstance(covariance, FactorCovariance):
+        return covariance.solve(values)
+    return np.linalg.solve(covariance, values)
+
+
+def _covariance_diagonal(covariance):
+    """
+    asset variances of a dense or factor covariance
+    """
+    if isinstance(covariance, FactorCovariance):
+        return (covariance.exposures.astype(np.float64) ** 2).sum(axis=1) + covariance.specific_variances
+    return np.diag(covariance)
+
 
-    # manually make 6 assets and some correlations
-    asset_properties = {"asset_1": {"avg_return": 0.073, "std_dev": 0.05},
-                        "asset_2": {"avg_return": 0.035, "std_dev": 0.011},
-                        "asset_3": {"avg_return": 0.12, "std_dev": 0.09},
-                        "asset_4": {"avg_return": 0.05, "std_dev": 0.02},
-                        "asset_5": {"avg_return": 0.015, "std_dev": 0.02},
-                        "asset_6": {"avg_return": 0.11, "std_dev": 0.05}}
-
-    # make correlation matrix, upper triangular only
-    correlations = pd.DataFrame([[+1.00, -0.08, +0.32, -0.12, -0.30, -0.03],
-                                 [+0.00, +1.00, +0.02, +0.18, +0.45, -0.24],
-                                 [+0.00, +0.00, +1.00, +0.04, +0.02, -0.09],
-                                 [+0.00, +0.00, +0.00, +1.00, +0.13, +0.12],
-                                 [+0.00, +0.00, +0.00, +0.00, +1.00, +0.21],
-                                 [+0.00, +0.00, +0.00, +0.00, +0.00, +1.00],
-                                 ], index=asset_properties.keys(), columns=asset_properties.keys())
-    # make upper triangular matrix symmetric about diagonal for ease of lokup
-    corr_upper_tri = np.triu(correlations)
-    correlations = corr_upper_tri + corr_upper_tri.T - np.diag(np.diag(corr_upper_tri))
-    correlations = pd.DataFrame(correlations, index=asset_properties.keys(), columns=asset_properties.keys())
-
-    # make random asset weights for X simulations
-    simulations = 100000
-    weights = numpy.random.rand(len(asset_properties.keys()), simulations)  # columns are simulations, rows are assets
+def calc_portfolios_risk_return(weights, avg_returns, covariance, chunk_size=100000):
+    """
+    vectorised risk, return and sharpe ratio for many portfolios at once, portfolios are done in chunks of columns
+    return = w' mu and risk = sqrt(w' Cov w) for every column w of the weights matrix
+    :param weights: (assets x portfolios) array of weights, columns are portfolios
+    :param avg_returns: array of asset average returns
+    :param covariance: (assets x assets) covariance matrix or FactorCovariance
+    :param chunk_size: number of portfolios to evaluate at once
+    :return: arrays of portfolio risk, return and sharpe ratio, in the float type of weights (e.g. float32)
+    """
+    weights = np.asarray(weights)
+    avg_returns = np.asarray(avg_returns, dtype=weights.dtype)
+    if not isinstance(covariance, FactorCovariance):
+        covariance = np.asarray(covariance, dtype=weights.dtype)
+    num_portfolios = weights.shape[1]
+
+    portfolio_risk = np.empty(num_portfolios, dtype=weights.dtype)
+    portfolio_return = np.empty(num_portfolios, dtype=weights.dtype)
+    for chunk_start in range(0, num_portfolios, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, num_portfolios)
+        weights_chunk = weights[:, chunk_start:chunk_end]
+        portfolio_return[chunk_start:chunk_end] = avg_returns @ weights_chunk
+        # w' Cov w for each column, without building the portfolios x portfolios product
+        if isinstance(covariance, FactorCovariance):
+            portfolio_variance = covariance.portfolio_variance(weights_chunk)
+        else:
+            portfolio_variance = np.einsum("ij,ij->j", weights_chunk, covariance @ weights_chunk)
+        portfolio_risk[chunk_start:chunk_end] = np.sqrt(np.maximum(portfolio_variance, 0.0))
+
+    sharpe_ratio = portfolio_return / portfolio_risk
+
+    return portfolio_risk, portfolio_return, sharpe_ratio
+
+
+def min_variance_portfolio(covariance):
+    """
+    closed form minimum variance portfolio with weights summing to 1 and no bounds. w = Cov^-1 1 / (1' Cov^-1 1)
+    :param covariance: (assets x assets) covariance matrix or FactorCovariance
+    :return: array of asset weights
+    """
+    inv_cov_ones = _solve_covariance(covariance, np.ones(len(covariance)))
+    return inv_cov_ones / inv_cov_ones.sum()
+
+
+def tangency_portfolio(avg_returns, covariance, risk_free=0.0):
+    """
+    closed form maximum sharpe ratio portfolio with weights summing to 1 and no bounds
+    w = Cov^-1 (mu - rf) / (1' Cov^-1 (mu - rf))
+    :param avg_returns: array of asset average returns
+    :param covariance: (assets x assets) covariance matrix or FactorCovariance
+    :param risk_free: risk free rate
+    :return: array of asset weights
+    """
+    inv_cov_excess = _solve_covariance(covariance, np.asarray(avg_returns) - risk_free)
+    return inv_cov_excess / inv_cov_excess.sum()
+
+
+def _free_set_kkt(covariance, constraint_matrix, constraint_values, free_index):
+    """
+    solves the KKT system of min w' Cov w s.t. A w = b on the free assets: Cov_FF w_F - A_F' v = 0, A_F w_F = b
+    a FactorCovariance is solved through its factor structure as w_F = Cov_FF^-1 A_F' v with
+    (A_F Cov_FF^-1 A_F') v = b, so the cost is O(free assets x factors^2) instead of O(free assets^3)
+    :return: weights of the free assets, constraint multipliers v
+    """
+    free_constraints = constraint_matrix[:, free_index]
+    if isinstance(covariance, FactorCovariance):
+        inv_cov_constraints = covariance.solve_subset(free_index, free_constraints.T)
+        reduced_matrix = free_constraints @ inv_cov_constraints
+        try:
+            multipliers = np.linalg.solve(reduced_matrix, constraint_values)
+        except np.linalg.LinAlgError:
+            multipliers = np.linalg.lstsq(reduced_matrix, constraint_values, rcond=None)[0]  # rank deficient free set
+        return inv_cov_constraints @ multipliers, multipliers
+
+    num_free = len(free_index)
+    num_constraints = constraint_matrix.shape[0]
+    kkt_matrix = np.zeros((num_free + num_constraints, num_free + num_constraints))
+    kkt_matrix[:num_free, :num_free] = covariance[np.ix_(free_index, free_index)]
+    kkt_matrix[:num_free, num_free:] = -free_constraints.T
+    kkt_matrix[num_free:, :num_free] = free_constraints
+    kkt_rhs = np.concatenate((np.zeros(num_free), constraint_values))
+    try:
+        kkt_solution = np.linalg.solve(kkt_matrix, kkt_rhs)
+    except np.linalg.LinAlgError:
+        kkt_solution = np.linalg.lstsq(kkt_matrix, kkt_rhs, rcond=None)[0]  # rank deficient free set
+    return kkt_solution[:num_free], kkt_solution[num_free:]
+
+
+def _long_only_qp(covariance, constraint_matrix, constraint_values, start_weights, max_iter=10000, tol=1e-10):
+    """
+    primal active-set solve of min w' Cov w subject to A w = b and w >= 0, starting from a feasible w
+    each step solves the KKT system on the free assets only, so the cost depends on the number of assets held
+    :param covariance: (assets x assets) covariance matrix or FactorCovariance, never made dense
+    :param constraint_matrix: (constraints x assets) matrix A
+    :param constraint_values: array b
+    :param start_weights: feasible starting weights, assets at 0 start out fixed at 0
+    :param max_iter: maximum number of active set changes
+    :param tol: tolerance on weights and multipliers, relative to the largest covariance entry
+    :return: array of optimal asset weights
+    """
+    tol *= _covariance_diagonal(covariance).max()  # the largest entry of a covariance is on its diagonal
+    weights = np.array(start_weights, dtype=float)
+    is_free = weights > 0
+
+    for iteration in range(max_iter):
+        free_index = np.flatnonzero(is_free)
+        candidate, multipliers = _free_set_kkt(covariance, constraint_matrix, constraint_values, free_index)
+
+        if np.all(candidate >= -tol):
+            # optimal for this free set, check whether releasing a fixed asset lowers the variance
+            weights[:] = 0.0
+            weights[free_index] = np.maximum(candidate, 0.0)
+            bound_multipliers = covariance @ weights - constraint_matrix.T @ multipliers
+            bound_multipliers[is_free] = 0.0
+            release = np.argmin(bound_multipliers)
+            if bound_multipliers[release] >= -tol:
+                return weights
+            is_free[release] = True
+        else:
+            # move towards the candidate until the first free weight reaches 0, then fix it there
+            current = weights[free_index]
+            direction = candidate - current
+            is_blocking = direction < 0
+            step_sizes = current[is_blocking] / -direction[is_blocking]
+            blocking = np.argmin(step_sizes)
+            weights[free_index] = current + min(1.0, step_sizes[blocking]) * direction
+            fixed_asset = free_index[is_blocking][blocking]
+            weights[fixed_asset] = 0.0
+            is_free[fixed_asset] = False
+
+    raise RuntimeError("long only frontier solve did not converge in " + str(max_iter) + " iterations")
+
+
+def solve_frontier(avg_returns, covariance, num_points=50, long_only=True):
+    """
+    traces the efficient frontier directly instead of sampling random weights
+    without bounds every point is the closed form two-fund combination w = Cov^-1 (l 1 + g mu)
+    with long_only each point solves min w' Cov w s.t. sum(w) = 1, w' mu = target, w >= 0, warm started from the
+    previous point. targets run from the return of the minimum variance portfolio up to the highest asset return
+    :param avg_returns: array of asset average returns
+    :param covariance: (assets x assets) covariance matrix or FactorCovariance, a FactorCovariance is never made
+        dense, its long only solves go through the factor structure
+    :param num_points: number of target returns on the frontier
+    :param long_only: require weights >= 0
+    :return: array of frontier risks, array of frontier returns, (assets x points) array of weights
+    """
+    avg_returns = np.asarray(avg_returns, dtype=float)
+    num_assets = len(avg_returns)
+    ones = np.ones(num_assets)
+
+    if not long_only:
+        inv_cov_ones = _solve_covariance(covariance, ones)
+        inv_cov_returns = _solve_covariance(covariance, avg_returns)
+        a, b, c = ones @ inv_cov_ones, ones @ inv_cov_returns, avg_returns @ inv_cov_returns
+        targets = np.linspace(b / a, avg_returns.max(), num_points)
+        lambdas = (c - b * targets) / (a * c - b ** 2)
+        gammas = (a * targets - b) / (a * c - b ** 2)
+        frontier_weights = np.outer(inv_cov_ones, lambdas) + np.outer(inv_cov_returns, gammas)
+    else:
+        if not isinstance(covariance, FactorCovariance):
+            covariance = np.asarray(covariance, dtype=float)
+
+        # long only minimum variance portfolio, starting from the single lowest variance asset
+        start_weights = np.zeros(num_assets)
+        start_weights[np.argmin(_covariance_diagonal(covariance))] = 1.0
+        weights = _long_only_qp(covariance, ones.reshape((1, -1)), np.ones(1), start_weights)
+
+        max_asset = np.argmax(avg_returns)
+        targets = np.linspace(avg_returns @ weights, avg_returns[max_asset], num_points)
+        constraint_matrix = np.vstack((ones, avg_returns))
+        frontier_weights = np.empty((num_assets, num_points))
+        for point, target in enumerate(targets):
+            # mix the previous solution with the highest return asset to get a feasible start at the new target
+            current_return = avg_returns @ weights
+            if avg_returns[max_asset] > current_return:
+                mix = (target - current_return) / (avg_returns[max_asset] - current_return)
+                weights = (1.0 - mix) * weights
+                weights[max_asset] += mix
+            weights = _long_only_qp(covariance, constraint_matrix, np.array([1.0, target]), weights)
+            frontier_weights[:, point] = weights
+
+    frontier_risk, frontier_return, frontier_sharpe = calc_portfolios_risk_return(frontier_weights, avg_returns,
+                                                                                  covariance)
+    return frontier_risk, frontier_return, frontier_weights
+
+
+def symmetric_correlations(correlations):
+    """
+    full symmetric correlation matrix from an upper triangular (or already symmetric) one
+    :param correlations: (assets x assets) correlation matrix, only the upper triangle is read
+    :return: symmetric correlation array
+    """
+    corr_upper_tri = np.triu(np.asarray(correlations, dtype=float))
+    return corr_upper_tri + np.triu(corr_upper_tri, 1).T
+
+
+class AssetUniverse:
+    """
+    asset average returns, std devs and correlations held as contiguous arrays
+    the covariance and its Cholesky factor are cached, and changing one asset only updates that asset's row/column
+    the Cholesky factor of the covariance is diag(std devs) @ cholesky(correlations), so a std dev change only
+    rescales one row and only a correlation change needs a new factorisation
+    :param asset_names: list of asset names
+    :param avg_returns: list of asset average returns
+    :param std_devs: list of asset std devs
+    :param correlations: (assets x assets) correlation matrix, only the upper triangle is read
+    """
+
+    def __init__(self, asset_names, avg_returns, std_devs, correlations):
+        self.asset_names = list(asset_names)
+        self.asset_index = {asset_name: index for index, asset_name in enumerate(self.asset_names)}
+        self.avg_returns = np.array(avg_returns, dtype=float)
+        self.std_devs = np.array(std_devs, dtype=float)
+        self.correlations = np.ascontiguousarray(symmetric_correlations(correlations))
+        self._covariance = None
+        self._corr_cholesky = None
+        self._cov_cholesky = None
+
+    @classmethod
+    def from_asset_properties(cls, asset_properties, correlations):
+        """
+        builds a universe from the script's asset_properties dict and correlation matrix
+        :param asset_properties: dict of asset_name -> {"avg_return": x, "std_dev": y}
+        :param correlations: (assets x assets) correlation matrix in the same asset order
+        :return: AssetUniverse
+        """
+        asset_names = list(asset_properties.keys())
+        return cls(asset_names,
+                   [asset_properties[asset_name]["avg_return"] for asset_name in asset_names],
+                   [asset_properties[asset_name]["std_dev"] for asset_name in asset_names],
+                   correlations)
+
+    def covariance(self):
+        """
+        cached (assets x assets) covariance matrix
+        """
+        if self._covariance is None:
+            self._covariance = calc_covariance(self.std_devs, self.correlations)
+        return self._covariance
+
+    def cholesky(self):
+        """
+        cached lower triangular Cholesky factor L of the covariance, Cov = L L'
+        """
+        if self._corr_cholesky is None:
+            self._corr_cholesky = np.linalg.cholesky(self.correlations)
+            self._cov_cholesky = None
+        if self._cov_cholesky is None:
+            self._cov_cholesky = self.std_devs.reshape((-1, 1)) * self._corr_cholesky
+        return self._cov_cholesky
+
+    def update_asset(self, asset_name, avg_return=None, std_dev=None, correlations=None):
+        """
+        changes one asset's stats, keeping the cached matrices up to date by touching only that asset's row/column
+        :param asset_name: name of the asset to change
+        :param avg_return: new average return
+        :param std_dev: new std dev
+        :param correlations: new correlations of this asset with every asset, in universe order
+        """
+        index = self.asset_index[asset_name]
+        if avg_return is not None:
+            self.avg_returns[index] = avg_return
+
+        if correlations is not None:
+            correlations = np.asarray(correlations, dtype=float)
+            self.correlations[index, :] = correlations
+            self.correlations[:, index] = correlations
+            self.correlations[index, index] = 1.0
+            self._corr_cholesky = None  # a correlation change needs a new factorisation
+            self._cov_cholesky = None
+
+        if std_dev is not None:
+            self.std_devs[index] = std_dev
+            if self._cov_cholesky is not None:
+                self._cov_cholesky[index, :] = std_dev * self._corr_cholesky[index, :]
+
+        if self._covariance is not None and (std_dev is not None or correlations is not None):
+            covariance_row = self.std_devs[index] * self.std_devs * self.correlations[index, :]
+            self._covariance[index, :] = covariance_row
+            self._covariance[:, index] = covariance_row
+
+    def weights_array(self, weights):
+        """
+        weights as an array in universe order
+        :param weights: dict, Series or DataFrame with asset_name as row key, or an array already in universe order
+        :return: array of weights, (assets x portfolios) for a DataFrame
+        """
+        if hasattr(weights, "reindex") and getattr(weights, "ndim", 1) == 2:
+            # a DataFrame, checked without importing pandas
+            return weights.reindex(self.asset_names).fillna(0.0).to_numpy()
+        if hasattr(weights, "keys"):
+            weights_array = np.zeros(len(self.asset_names))
+            for asset_name in weights.keys():
+                weights_array[self.asset_index[asset_name]] = weights[asset_name]
+            return weights_array
+        return np.asarray(weights, dtype=float)
+
+    def portfolio_risk_return(self, weights, chunk_size=100000):
+        """
+        risk, return and sharpe ratio of many portfolios with the cached covariance
+        :param weights: (assets x portfolios) array or DataFrame of weights, columns are portfolios, or one portfolio
+            as a dict, Series or array
+        :param chunk_size: number of portfolios to evaluate at once
+        :return: arrays of portfolio risk, return and sharpe ratio
+        """
+        weights_array = self.weights_array(weights)
+        if weights_array.ndim == 1:
+            weights_array = weights_array.reshape((-1, 1))  # a single portfolio
+        return calc_portfolios_risk_return(weights_array, self.avg_returns, self.covariance(), chunk_size=chunk_size)
+
+    def frontier(self, num_points=50, long_only=True):
+        """
+        efficient frontier of the universe, see solve_frontier
+        :param num_points: number of target returns on the frontier
+        :param long_only: require weights >= 0
+        :return: array of frontier risks, array of frontier returns, (assets x points) array of weights
+        """
+        return solve_frontier(self.avg_returns, self.covariance(), num_points=num_points, long_only=long_only)
+
+
+def density_grid(x, y, values=None, bins=200, x_range=None, y_range=None):
+    """
+    bins points into a 2-D grid so a plot draws one image instead of one marker per point
+    the cost of drawing the grid does not depend on the number of points
+    :param x: array of x values (e.g. portfolio risk)
+    :param y: array of y values (e.g. portfolio return)
+    :param values: optional array of a value per point (e.g. sharpe ratio) to aggregate per cell
+    :param bins: number of cells along each axis, or (x bins, y bins)
+    :param x_range: (low, high) of the grid on x, defaults to the range of x
+    :param y_range: (low, high) of the grid on y, defaults to the range of y
+    :return: dict of counts, max and mean of values (nan in empty cells), x edges and y edges, grids are (y bins x x bins)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_bins, y_bins = (bins, bins) if np.isscalar(bins) else bins
+    if x_range is None:
+        x_range = (x.min(), x.max())
+    if y_range is None:
+        y_range = (y.min(), y.max())
+    x_edges = np.linspace(x_range[0], x_range[1], x_bins + 1)
+    y_edges = np.linspace(y_range[0], y_range[1], y_bins + 1)
+
+    # cell of each point, points on the top edge go in the last cell
+    x_index = np.clip(np.searchsorted(x_edges, x, side="right") - 1, 0, x_bins - 1)
+    y_index = np.clip(np.searchsorted(y_edges, y, side="right") - 1, 0, y_bins - 1)
+    inside = (x >= x_range[0]) & (x <= x_range[1]) & (y >= y_range[0]) & (y <= y_range[1])
+    cell_index = y_index[inside] * x_bins + x_index[inside]
+
+    grid = {"counts": np.bincount(cell_index, minlength=x_bins * y_bins).reshape((y_bins, x_bins)),
+            "x_edges": x_edges, "y_edges": y_edges}
+    if values is not None:
+        values = np.asarray(values, dtype=float)[inside]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            grid["mean"] = (np.bincount(cell_index, weights=values, minlength=x_bins * y_bins).reshape(
+                (y_bins, x_bins)) / grid["counts"])
+        cell_max = np.full(x_bins * y_bins, -np.inf)
+        np.maximum.at(cell_max, cell_index, values)
+        cell_max[np.isneginf(cell_max)] = np.nan
+        grid["max"] = cell_max.reshape((y_bins, x_bins))
+
+    return grid
+
+
+def upper_hull(x, y, efficient_only=True):
+    """
+    upper convex hull of a cloud of points, the envelope of the random portfolios drawn as a line
+    :param x: array of x values (e.g. portfolio risk)
+    :param y: array of y values (e.g. portfolio return)
+    :param efficient_only: keep only the part from the lowest x up to the highest y, the efficient side
+    :return: array of hull x values, array of hull y values, in increasing x
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    order = np.lexsort((y, x))
+    if efficient_only:
+        # only points higher than every point to their left can be on the efficient side, usually very few
+        running_max = np.maximum.accumulate(y[order])
+        order = order[np.concatenate([[True], y[order][1:] > running_max[:-1]])]
+    hull = list()
+    # Andrew's monotone chain, a point is dropped while the last turn is not clockwise
+    for index in order:
+        while len(hull) >= 2:
+            x1, y1 = x[hull[-2]], y[hull[-2]]
+            x2, y2 = x[hull[-1]], y[hull[-1]]
+            if (x2 - x1) * (y[index] - y1) - (y2 - y1) * (x[index] - x1) >= 0:
+                hull.pop()
+            else:
+                break
+        hull.append(index)
+
+    hull = np.array(hull)
+    if efficient_only:
+        hull = hull[:int(np.argmax(y[hull])) + 1]
+    return x[hull], y[hull]
+
+
+# manually make 6 assets and some correlations, the script's example universe
+asset_properties = {"asset_1": {"avg_return": 0.073, "std_dev": 0.05},
+                    "asset_2": {"avg_return": 0.035, "std_dev": 0.011},
+                    "asset_3": {"avg_return": 0.12, "std_dev": 0.09},
+                    "asset_4": {"avg_return": 0.05, "std_dev": 0.02},
+                    "asset_5": {"avg_return": 0.015, "std_dev": 0.02},
+                    "asset_6": {"avg_return": 0.11, "std_dev": 0.05}}
+
+# make correlation matrix, upper triangular only, in asset_properties order
+correlations_upper = [[+1.00, -0.08, +0.32, -0.12, -0.30, -0.03],
+                      [+0.00, +1.00, +0.02, +0.18, +0.45, -0.24],
+                      [+0.00, +0.00, +1.00, +0.04, +0.02, -0.09],
+                      [+0.00, +0.00, +0.00, +1.00, +0.13, +0.12],
+                      [+0.00, +0.00, +0.00, +0.00, +1.00, +0.21],
+                      [+0.00, +0.00, +0.00, +0.00, +0.00, +1.00],
+                      ]
+
+# make upper triangular matrix symmetric about diagonal, keyed by asset name for ease of lookup
+correlations = {asset_name_i: {asset_name_j: corr for asset_name_j, corr in zip(asset_properties, corr_row)}
+                for asset_name_i, corr_row in zip(asset_properties, symmetric_correlations(correlations_upper))}
+
+
+def random_portfolios(universe, simulations, seed=None):
+    """
+    random long only weights scored with the universe's cached covariance
+    :param universe: AssetUniverse
+    :param simulations: number of random portfolios
+    :param seed: seed of the random weights
+    :return: (assets x portfolios) weights, arrays of portfolio risk, return and sharpe ratio
+    """
+    weights = np.random.default_rng(seed).random((len(universe.asset_names), simulations))  # columns are portfolios
     weights = weights / np.sum(weights, axis=0, keepdims=True)
-    weights_df = pd.DataFrame(weights, index=asset_properties.keys())
+    stddevs, avgs, sharpe_ratio = universe.portfolio_risk_return(weights)
+    return weights, stddevs, avgs, sharpe_ratio
+
+
+def run_frontier(universe=None, simulations=100000, num_points=50, long_only=True, seed=None):
+    """
+    random portfolios and the solved efficient frontier of a universe, no plotting
+    :param universe: AssetUniverse, defaults to the script's example universe
+    :param simulations: number of random portfolios
+    :param num_points: number of points on the frontier
+    :param long_only: require frontier weights >= 0
+    :param seed: seed of the random weights
+    :return: dict of arrays
+    """
+    if universe is None:
+        universe = AssetUniverse.from_asset_properties(asset_properties, correlations_upper)
+    weights, stddevs, avgs, sharpe_ratio = random_portfolios(universe, simulations, seed=seed)
+    frontier_risk, frontier_return, frontier_weights = universe.frontier(num_points=num_points, long_only=long_only)
+    envelope_risk, envelope_return = upper_hull(stddevs, avgs)
+    return {"asset_names": universe.asset_names, "weights": weights, "risk": stddevs, "return": avgs,
+            "sharpe_ratio": sharpe_ratio, "frontier_risk": frontier_risk, "frontier_return": frontier_return,
+            "frontier_weights": frontier_weights, "envelope_risk": envelope_risk, "envelope_return": envelope_return}
 
-    # use list comprehension to get tuple of resuts as [ (risk_1, return_1, sharpe_1), (risk_2, return_2, sharpe_2), ...
-    combo_portfolio_risk_return_pairs = [calc_portfolio_risk_return(weights_df[index]) for index in weights_df.columns]
-    stddevs = [pair[0] for pair in combo_portfolio_risk_return_pairs]
-    avgs = [pair[1] for pair in combo_portfolio_risk_return_pairs]
-    sharpe_ratio = [pair[2] for pair in combo_portfolio_risk_return_pairs]
 
-    # scatter plot
+def frontier_summary(results):
+    """
+    JSON friendly summary of run_frontier results: the frontier and the best random portfolio by sharpe ratio
+    """
+    best = int(np.argmax(results["sharpe_ratio"]))
+    return {"asset_names": results["asset_names"],
+            "frontier": {"risk": results["frontier_risk"].tolist(), "return": results["frontier_return"].tolist(),
+                         "weights": results["frontier_weights"].T.tolist()},
+            "random_portfolios": {"count": len(results["risk"]),
+                                  "envelope": {"risk": results["envelope_risk"].tolist(),
+                                               "return": results["envelope_return"].tolist()},
+                                  "best_sharpe": {"risk": float(results["risk"][best]),
+                                                  "return": float(results["return"][best]),
+                                                  "sharpe_ratio": float(results["sharpe_ratio"][best]),
+                                                  "weights": results["weights"][:, best].tolist()}}}
+
+
+def plot_frontier(results, save_path=None, density=True, bins=200):
+    """
+    random portfolios coloured by sharpe ratio, with the frontier drawn over them
+    by default the portfolios are binned with density_grid and drawn as one image of the best sharpe ratio per cell,
+    with the envelope of the random portfolios as a line, so plot time and file size do not grow with the portfolios
+    matplotlib is only imported here, so headless runs never load it
+    :param results: dict from run_frontier
+    :param save_path: file to save the figure to, None to show it
+    :param density: draw the binned image, False for one scatter marker per portfolio
+    :param bins: number of grid cells along each axis of the binned image
+    """
+    import matplotlib as mpl
+    from matplotlib import pyplot as plt
+
     fig = plt.figure()
     plot1 = plt.subplot2grid((10, 10), (0, 0), rowspan=10, colspan=9)
-    plot1.scatter(stddevs, avgs, c=sharpe_ratio, cmap="viridis", s=5)
+    if density:
+        # max sharpe ratio per cell, empty cells are left blank
+        grid = density_grid(results["risk"], results["return"], results["sharpe_ratio"], bins=bins)
+        plot1.imshow(grid["max"], origin="lower", aspect="auto", cmap="viridis", interpolation="nearest",
+                     extent=(grid["x_edges"][0], grid["x_edges"][-1], grid["y_edges"][0], grid["y_edges"][-1]))
+        plot1.plot(results["envelope_risk"], results["envelope_return"], color="black", linewidth=1)
+    else:
+        # scatter plot
+        plot1.scatter(results["risk"], results["return"], c=results["sharpe_ratio"], cmap="viridis", s=5)
+    plot1.plot(results["frontier_risk"], results["frontier_return"], color="red")
     plot1.set_title("Efficient Frontier")
     plot1.set_xlabel("Risk")
     plot1.set_ylabel("Return")
@@ -97,6 +705,42 @@ if __name__ == "__main__":
     # color map
     plot2 = plt.subplot2grid((10, 10), (0, 9), rowspan=10, colspan=1)
     cmap = mpl.cm.viridis
-    norm = mpl.colors.Normalize(vmin=min(sharpe_ratio), vmax=max(sharpe_ratio))
+    norm = mpl.colors.Normalize(vmin=min(results["sharpe_ratio"]), vmax=max(results["sharpe_ratio"]))
     fig.colorbar(mpl.cm.ScalarMappable(norm=norm, cmap=cmap), cax=plot2, orientation='vertical', label='Sharpe Ratio')
-    plt.show()
+    if save_path is None:
+        plt.show()
+    else:
+        fig.savefig(save_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="random portfolios and the efficient frontier of the example assets")
+    parser.add_argument("--simulations", type=int, default=100000, help="number of random portfolios")
+    parser.add_argument("--points", type=int, default=50, help="number of points on the frontier")
+    parser.add_argument("--allow-short", action="store_true", help="solve the frontier without the long only limit")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random weights")
+    parser.add_argument("--headless", action="store_true", help="no plots, print the results as JSON")
+    parser.add_argument("--output", default=None, help="also write the results as JSON to this file")
+    parser.add_argument("--save", default=None, help="save the plot to this file instead of showing it")
+    parser.add_argument("--scatter", action="store_true", help="plot one marker per portfolio instead of a binned image")
+    parser.add_argument("--bins", type=int, default=200, help="grid cells along each axis of the binned image")
+    args = parser.parse_args(argv)
+
+    results = run_frontier(simulations=args.simulations, num_points=args.points, long_only=not args.allow_short,
+                           seed=args.seed)
+    summary = frontier_summary(results)
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump(summary, json_file, indent=2)
+
+    if args.headless:
+        if args.output is None:
+            print(json.dumps(summary))
+    else:
+        plot_frontier(results, save_path=args.save, density=not args.scatter, bins=args.bins)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
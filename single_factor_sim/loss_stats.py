@@ -0,0 +1,180 @@
+# Streaming statistics for simulated loss distributions
+# Losses are reduced block by block as the simulation produces them, so memory does not grow with the run count
+# Quantiles and expected shortfall come from a fine fixed-bin histogram (count and sum of losses per bin)
+# Two accumulators with the same bins merge exactly by adding their arrays, so results from chunks and worker
+# processes can be combined in any order. Quantile error is at most one fine bin width
+# Mean and variance are exact, merged with the parallel form of Welford's update (Chan et al.)
+
+# imports
+import numpy
+
+
+class LossDistributionStats:
+    """
+    mergeable accumulator of a loss distribution
+    :param value_range: (low, high) range of the fine histogram, update raises on values outside it
+    :param fine_bins: number of fine histogram bins used for quantiles and expected shortfall
+    """
+
+    def __init__(self, value_range=(0.0, 100.0), fine_bins=20000):
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.fine_bins = fine_bins
+        self.bin_edges = numpy.linspace(self.value_range[0], self.value_range[1], fine_bins + 1)
+        self.bin_counts = numpy.zeros(fine_bins, dtype=numpy.int64)
+        self.bin_sums = numpy.zeros(fine_bins)
+        self.count = 0
+        self.mean = 0.0
+        self.sum_sq_dev = 0.0  # sum of squared deviations from the mean
+        self.min = numpy.inf
+        self.max = -numpy.inf
+
+    def update(self, values):
+        """
+        adds a block of losses to the accumulator
+        values must lie inside value_range, e.g. % of balance losses for the default (0, 100), not $ losses
+        :param values: array of losses
+        """
+        values = numpy.asarray(values, dtype=float).ravel()
+        if len(values) == 0:
+            return
+
+        # values outside the range would land in the end bins and silently distort every quantile
+        tolerance = 1e-9 * (self.value_range[1] - self.value_range[0])  # rounding of e.g. a 100% loss
+        out_of_range = numpy.count_nonzero((values < self.value_range[0] - tolerance) |
+                                           (values > self.value_range[1] + tolerance))
+        if out_of_range:
+            raise ValueError(str(out_of_range) + " of " + str(len(values)) + " values are outside value_range " +
+                             str(self.value_range) + ", pass % losses or set value_range to cover the losses")
+
+        bin_width = (self.value_range[1] - self.value_range[0]) / self.fine_bins
+        bin_index = numpy.floor((values - self.value_range[0]) / bin_width).astype(numpy.int64)
+        bin_index = numpy.clip(bin_index, 0, self.fine_bins - 1)
+        self.bin_counts += numpy.bincount(bin_index, minlength=self.fine_bins)
+        self.bin_sums += numpy.bincount(bin_index, weights=values, minlength=self.fine_bins)
+
+        block_mean = values.mean()
+        self._merge_moments(len(values), block_mean, ((values - block_mean) ** 2).sum())
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def merge(self, other):
+        """
+        adds the contents of another accumulator with the same bins, e.g. one returned by a worker process
+        :param other: LossDistributionStats to merge into this one
+        """
+        if other.value_range != self.value_range or other.fine_bins != self.fine_bins:
+            raise ValueError("can only merge LossDistributionStats with the same value_range and fine_bins")
+        if other.count == 0:
+            return
+
+        self.bin_counts += other.bin_counts
+        self.bin_sums += other.bin_sums
+        self._merge_moments(other.count, other.mean, other.sum_sq_dev)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _merge_moments(self, count, mean, sum_sq_dev):
+        """
+        combines count, mean and sum of squared deviations of another sample into this one
+        """
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.sum_sq_dev += sum_sq_dev + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def variance(self):
+        """
+        sample variance of the losses
+        """
+        if self.count < 2:
+            return 0.0
+        return self.sum_sq_dev / (self.count - 1)
+
+    def std_dev(self):
+        """
+        sample standard deviation of the losses
+        """
+        return numpy.sqrt(self.variance())
+
+    def _order_statistics(self, ranks):
+        """
+        estimated k-th smallest losses (k from 0), the losses in a fine bin are taken as evenly spread across it and
+        a loss alone in its bin is known exactly from the bin sum
+        :param ranks: integer ranks between 0 and count - 1
+        :return: loss value(s) at the ranks
+        """
+        cumulative = numpy.cumsum(self.bin_counts)
+        bin_index = numpy.searchsorted(cumulative, ranks, side="right")
+        bin_index = numpy.minimum(bin_index, self.fine_bins - 1)
+        counts = numpy.maximum(self.bin_counts[bin_index], 1)
+        below = cumulative[bin_index] - self.bin_counts[bin_index]  # number of losses in the bins before
+        spread = self.bin_edges[bin_index] + (ranks - below + 0.5) / counts * (self.bin_edges[bin_index + 1] -
+                                                                              self.bin_edges[bin_index])
+        values = numpy.where(self.bin_counts[bin_index] == 1, self.bin_sums[bin_index] / counts, spread)
+        return numpy.clip(values, self.min, self.max)
+
+    def quantile(self, percentiles):
+        """
+        estimated loss at the given percentiles with the linear rank convention of numpy.percentile: the two order
+        statistics either side of the rank are interpolated. each order statistic is placed inside its fine bin, so
+        the error is at most one fine bin width, also where the bins are sparse such as the far tail
+        :param percentiles: percentile or list of percentiles between 0 and 100
+        :return: loss value(s) at the percentiles
+        """
+        if self.count == 0:
+            raise ValueError("no losses have been added")
+
+        ranks = numpy.asarray(percentiles, dtype=float) / 100.0 * (self.count - 1)
+        lower_ranks = numpy.floor(ranks)
+        lower = self._order_statistics(lower_ranks)
+        upper = self._order_statistics(numpy.minimum(lower_ranks + 1, self.count - 1))
+        return lower + (ranks - lower_ranks) * (upper - lower)
+
+    def expected_shortfall(self, percentile):
+        """
+        average loss in the tail beyond the given percentile
+        the bin holding the percentile contributes the part of its sum that lies in the tail
+        :param percentile: percentile between 0 and 100, e.g. 99.9
+        :return: expected shortfall
+        """
+        if self.count == 0:
+            raise ValueError("no losses have been added")
+
+        tail_count = self.count * (1.0 - percentile / 100.0)
+        if tail_count <= 0:
+            return self.max
+
+        tail_counts = numpy.cumsum(self.bin_counts[::-1])[::-1]  # number of losses in each bin and above
+        first_bin = max(int(numpy.searchsorted(-tail_counts, -tail_count, side="left")) - 1, 0)
+        tail_sum = self.bin_sums[first_bin + 1:].sum()
+        tail_in_bins_above = tail_counts[first_bin + 1] if first_bin + 1 < self.fine_bins else 0
+        if self.bin_counts[first_bin] > 0:
+            # take the needed share of the boundary bin at its average loss
+            needed = min(tail_count - tail_in_bins_above, self.bin_counts[first_bin])
+            tail_sum += needed * self.bin_sums[first_bin] / self.bin_counts[first_bin]
+
+        return tail_sum / tail_count
+
+    def histogram(self, bins=50, density=True):
+        """
+        coarse histogram between the observed min and max, built from the fine bins
+        :param bins: number of bins
+        :param density: normalise like numpy.histogram(density=True)
+        :return: histogram values, bin edges
+        """
+        fine_centres = (self.bin_edges[:-1] + self.bin_edges[1:]) / 2.0
+        fine_centres = numpy.clip(fine_centres, self.min, self.max)
+        return numpy.histogram(fine_centres, bins=bins, range=(self.min, self.max), weights=self.bin_counts,
+                               density=density)
+
+    def summary(self, percentiles=(50, 75, 90, 95, 99, 99.9)):
+        """
+        descriptive statistics of the loss distribution as a dict
+        :param percentiles: percentiles to report quantiles and expected shortfall for
+        :return: dict of statistics
+        """
+        quantiles = self.quantile(percentiles)
+        return {"count": self.count, "mean": self.mean, "std_dev": self.std_dev(), "min": self.min, "max": self.max,
+                "percentiles": {str(pctl): value for pctl, value in zip(percentiles, quantiles)},
+                "expected_shortfall": {str(pctl): self.expected_shortfall(pctl) for pctl in percentiles}}
@@ -11,35 +11,104 @@
 
 # imports
 import math
+import multiprocessing
 import numpy
-import pandas
+import os
+import sys
+import argparse
+import json
 import random
-import scipy.stats
+import scipy.special
+import time
 
-from matplotlib import pyplot
+import loss_stats
+import scenario_store
 
+# the multi-factor simulation takes its sector Cholesky factors from the correlated random generator, and cached
+# results use the content-keyed memoisation decorator
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "correlated_randoms"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decorator"))
+import caching  # noqa: E402
+import correlated_generator  # noqa: E402
 
-def get_vasicek_dist(pds, lgds, bals, corr):
+# standard normal constants, needed by the simulation functions whether the script is run or imported
+mu = 0.0  # for standard norm dist
+sigma = 1.0  # for standard norm dist
+
+
+# standard normal functions, for Vasicek equation calc
+# scipy.special gives the same values as scipy.stats.norm(mu, sigma) without importing scipy.stats, so the script and
+# every worker process start without that import cost
+def norm(x):
+    # cumulative standard normal
+    return scipy.special.ndtr((numpy.asarray(x, dtype=float) - mu) / sigma)
+
+
+def norm_inv(q):
+    # inverse cumulative standard normal
+    return mu + sigma * scipy.special.ndtri(q)
+
+
+@caching.memoize(max_entries=8)
+def _pd_norm_inv(pds_array):
+    # norm_inv(PD) for recently used pools, memoize keys it by the content of the PD array
+    return norm_inv(pds_array)
+
+
+def cached_pd_norm_inv(pds):
+    """
+    norm inverse of the loan level default probabilities, cached by the content of the PD list
+    analytic curves for the same pool are recomputed for every correlation and snapshot, the PDs rarely change
+    :param pds: list or array of default probabilities
+    :return: read-only array of norm_inv(PD)
+    """
+    return _pd_norm_inv(numpy.ascontiguousarray(pds, dtype=float))
+
+
+def vasicek_pctl_curve(pds, lgds, bals, correlations, alphas, mem_budget_mb=64):
+    """
+    evaluates the Vasicek loss percentile for a grid of correlations and percentiles in one broadcast per correlation
+    SUM_j( Weight_j * LGD_j * norm((norm_inv(PD_j) + (sqrt(corr) * norm_inv(alpha))) / sqrt(1.0 - corr)) )
+    the (loans x alphas) grid is done in blocks of loans for big pools
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param correlations: list of correlation values
+    :param alphas: list of percentiles as fractions, e.g. 0.999
+    :param mem_budget_mb: approximate memory in MB to use for one (loans x alphas) block
+    :return: (correlations x alphas) array of loss as a fraction of pool balance
+    """
+    bals_array = numpy.array(bals, dtype=float)
+    weighted_lgds = bals_array / bals_array.sum() * numpy.array(lgds, dtype=float)  # Weight_j * LGD_j
+    pds_norm_inv = cached_pd_norm_inv(pds).reshape((-1, 1))
+    alphas_norm_inv = norm_inv(numpy.array(alphas, dtype=float)).reshape((1, -1))
+    num_loans = len(weighted_lgds)
+
+    block_size = min(num_loans, loans_per_block(alphas_norm_inv.shape[1], mem_budget_mb, bytes_per_cell=16))
+    vas_loss_dist = numpy.zeros((len(correlations), alphas_norm_inv.shape[1]))
+    for corr_index, corr in enumerate(correlations):
+        systematic_vector = math.sqrt(corr) * alphas_norm_inv
+        for block_start in range(0, num_loans, block_size):
+            block_end = min(block_start + block_size, num_loans)
+            pctl_block = scipy.special.ndtr((pds_norm_inv[block_start:block_end] + systematic_vector) / math.sqrt(1.0 - corr))
+            vas_loss_dist[corr_index] += weighted_lgds[block_start:block_end] @ pctl_block
+
+    return vas_loss_dist
+
+
+def get_vasicek_dist(pds, lgds, bals, corr, pctls=None):
     """
     calculates the percentile of the loss distribution as given by the Vasicek equation
+    evaluated for every alpha in pctls at once with vasicek_pctl_curve
     :param pds: list of default probabilities
     :param lgds: list of loss given defaults
     :param bals: list of loan balances
+    :param pctls: list of percentiles (as fractions) to evaluate, defaults to 0.001 to 0.999 in steps of 0.001
     :return:
     """
-    # make DataFrame from input lists
-    pool = pandas.DataFrame([bals, pds, lgds], index=["Balance", "PD", "LGD"])
-    pool = pool.transpose()  # index 1,2,3..., columns Balance, PD, LGD
-    pool["Weight"] = pool["Balance"] / pool["Balance"].sum()  # Weight column is % of Balance for pool
-
-    # take each percentile and evaluate Vasicek equation
-    vas_loss_dist = list()
-    for alpha in pctls:
-        # for each alpha in list of percentiles, calculate the loss % by using the Vasicek equation
-        pool["pct_" + str(alpha)] = pool["Weight"] * \
-                                    pool["LGD"] * \
-                                    norm((norm_inv(pool["PD"]) + (math.sqrt(corr) * norm_inv(alpha))) / math.sqrt(1.0 - corr))
-        vas_loss_dist.append(pool["pct_" + str(alpha)].sum())
+    if pctls is None:
+        pctls = numpy.linspace(0.001, 1.00, 999, False)
+    vas_loss_dist = list(vasicek_pctl_curve(pds, lgds, bals, [corr], pctls)[0])
 
     return vas_loss_dist
 
@@ -62,7 +131,7 @@ def brute_force_sim(pds, lgds, bals, correlation, sim_runs):
         sim_run_loss = 0.0  # outstanding balance loss for each sim run
         Z_i = norm_inv(random.random())  # random draw on the systematic factor
 
-        for j in range(0, num_loans):
+        for j in range(0, len(pds)):
             epsilon_ij = norm_inv(random.random())  # random draw on the idiosyncratic factor
             R_ij = math.sqrt(correlation) * Z_i + math.sqrt(1.0 - correlation) * epsilon_ij  # calculate single factor asset return
 
@@ -95,6 +164,7 @@ def matrix_calc_sim(pds, lgds, bals, correlation, sim_runs, z_vec_in=None, epsil
     :param epsilon_mat_in: matrix of pre-drawn epsilon_ij values for the sim, to run calc on exact same random variables
     :return:
     """
+    num_loans = len(pds)
 
     if z_vec_in is None:
         # make new set of randoms for Z_i
@@ -126,60 +196,809 @@ def matrix_calc_sim(pds, lgds, bals, correlation, sim_runs, z_vec_in=None, epsil
     return sim_run_loss_list, sim_run_loss_pct_list
 
 
-if __name__ == "__main__":
+def loans_per_block(sim_runs, mem_budget_mb, bytes_per_cell=17):
+    """
+    number of loans that can be simulated at once for all sim runs while staying inside a memory budget
+    a block holds a float epsilon row, a boolean default mask and a float loss row for each loan -> 17 bytes per cell
+    :param sim_runs: number of simulation runs (columns) in each block
+    :param mem_budget_mb: memory budget in MB for the working arrays of one block
+    :param bytes_per_cell: bytes of working memory needed for one loan in one sim run
+    :return: number of loans per block, at least 1
+    """
+    budget_bytes = int(mem_budget_mb * 1024 * 1024)
+    return max(1, budget_bytes // (bytes_per_cell * sim_runs))
 
-    # constants
-    corr_list = numpy.linspace(0.01, 0.50, 50)
-    mu = 0.0  # for standard norm dist
-    sigma = 1.0  # for standard norm dist
-    pctls = numpy.linspace(0.001, 1.00, 999, False)  # list of percentiles for Vasicek calc
-    pctls_graph_series = ['50', '75', '90', '95', '99', '99.9']
-    num_loans = 1000  # number of loans in the pretend pool
-    num_runs = 100000  # number of simulation runs to do
-    loan_bal_min = 10000  # minimum loan balance 10,000
-    loan_bal_max = 10000000  # maximum loan balance 10,000,000
 
-    # pre-make the standard normal functions, for Vasicek equation calc
-    norm = scipy.stats.norm(mu, sigma).cdf  # cumulative standard normal
-    norm_inv = scipy.stats.norm(mu, sigma).ppf  # inverse cumulative standard normal
+def chunked_calc_sim(pds, lgds, bals, correlation, sim_runs, z_vec_in=None, epsilon_mat_in=None, mem_budget_mb=256,
+                     random_state=numpy.random):
+    """
+    performs the asset correlation simulation in blocks of loans so the loans x runs matrices are never built in full
+    epsilon rows are drawn block by block from the same global numpy.random stream as matrix_calc_sim, and each run's
+    loss is summed loan by loan in the same order, so per-run losses are bit-identical to the dense path for a seed
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param correlation: value to use for asset correlation
+    :param sim_runs: number of simulation runs to do
+    :param z_vec_in: array of pre-drawn Z_i value for the sim, to run calc on exact same random variables
+    :param epsilon_mat_in: matrix (or memory-mapped array) of pre-drawn epsilon_ij values, read one block of rows at a time
+    :param mem_budget_mb: approximate memory in MB to use for one block of loans
+    :param random_state: source of the normal draws, the global numpy.random by default or a numpy Generator
+    :return: array of $ loss per sim run, array of % of balance loss per sim run
+    """
+    num_loans = len(pds)
+
+    if z_vec_in is None:
+        # make new set of randoms for Z_i
+        z_vector = random_state.normal(loc=mu, scale=sigma, size=(1, sim_runs))  # vector of randoms for Z_i
+    else:
+        # use the set of randoms you were given
+        z_vector = z_vec_in
+
+    pds_vector = norm_inv(numpy.array(pds)).reshape((num_loans, 1))  # column vector of norm inverse loan level PDs
+    loan_loss_vector = (numpy.array(lgds) * numpy.array(bals)).reshape((num_loans, 1))
+    systematic_vector = math.sqrt(correlation) * z_vector  # systematic part of R_ij is shared by every loan
+    idiosyncratic_scale = math.sqrt(1.0 - correlation)
+
+    # row 0 of the loss block carries the running total of the loans already done
+    # summing down the columns then adds each loan's loss to the total in the same order as the dense path
+    block_size = min(num_loans, loans_per_block(sim_runs, mem_budget_mb))
+    loss_block = numpy.zeros((block_size + 1, sim_runs))
+    for block_start in range(0, num_loans, block_size):
+        block_end = min(block_start + block_size, num_loans)
+
+        if epsilon_mat_in is None:
+            # draw the next rows of epsilon_ij, the stream gives the same values as one dense draw
+            r_ij_block = random_state.normal(loc=mu, scale=sigma, size=(block_end - block_start, sim_runs))
+        else:
+            r_ij_block = numpy.array(epsilon_mat_in[block_start:block_end], dtype=float)
+
+        # R_ij = sqrt(rho) * Z_i + sqrt(1-rho) * epsilon_ij, done in place on the epsilon block
+        r_ij_block *= idiosyncratic_scale
+        r_ij_block += systematic_vector
+
+        is_defaulted_mask = r_ij_block < pds_vector[block_start:block_end]
+        block_rows = block_end - block_start + 1
+        numpy.multiply(loan_loss_vector[block_start:block_end], is_defaulted_mask, out=loss_block[1:block_rows])
+        loss_block[0] = loss_block[0:block_rows].sum(axis=0)
+
+    sim_run_loss = loss_block[0].copy()
+    sim_run_loss_pct = sim_run_loss / numpy.array(bals).sum() * 100
+    return sim_run_loss, sim_run_loss_pct
+
+
+def sweep_calc_sim(pds, lgds, bals, correlations, sim_runs, z_vec_in=None, epsilon_mat_in=None, mem_budget_mb=256):
+    """
+    performs the asset correlation simulation for a whole list of correlations in one pass over the random draws
+    per-loan quantities are computed once and each block of epsilon_ij rows is drawn (or read) once and then used for
+    every correlation. row i of the output is bit-identical to matrix_calc_sim run with correlations[i]
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param correlations: list of asset correlation values to run
+    :param sim_runs: number of simulation runs to do
+    :param z_vec_in: array of pre-drawn Z_i value for the sim, to run calc on exact same random variables
+    :param epsilon_mat_in: matrix (or memory-mapped array) of pre-drawn epsilon_ij values, read one block of rows at a time
+    :param mem_budget_mb: approximate memory in MB to use for one block of loans
+    :return: (correlations x runs) array of $ loss, (correlations x runs) array of % of balance loss
+    """
+    num_loans = len(pds)
+    num_corrs = len(correlations)
+
+    if z_vec_in is None:
+        # make new set of randoms for Z_i
+        z_vector = numpy.random.normal(loc=mu, scale=sigma, size=(1, sim_runs))  # vector of randoms for Z_i
+    else:
+        # use the set of randoms you were given
+        z_vector = z_vec_in
+
+    pds_vector = norm_inv(numpy.array(pds)).reshape((num_loans, 1))  # column vector of norm inverse loan level PDs
+    loan_loss_vector = (numpy.array(lgds) * numpy.array(bals)).reshape((num_loans, 1))
+    systematic_vectors = [math.sqrt(correlation) * z_vector for correlation in correlations]
+    idiosyncratic_scales = [math.sqrt(1.0 - correlation) for correlation in correlations]
+
+    # each block holds epsilon, R_ij, the default mask and the loss rows -> 25 bytes per cell
+    block_size = min(num_loans, loans_per_block(sim_runs, mem_budget_mb, bytes_per_cell=25))
+    sim_run_loss = numpy.zeros((num_corrs, sim_runs))
+    loss_block = numpy.zeros((block_size + 1, sim_runs))
+    r_ij_block = numpy.empty((block_size, sim_runs))
+    for block_start in range(0, num_loans, block_size):
+        block_end = min(block_start + block_size, num_loans)
+        block_loans = block_end - block_start
+
+        if epsilon_mat_in is None:
+            # draw the next rows of epsilon_ij, the global stream gives the same values as one dense draw
+            epsilon_block = numpy.random.normal(loc=mu, scale=sigma, size=(block_loans, sim_runs))
+        else:
+            epsilon_block = numpy.asarray(epsilon_mat_in[block_start:block_end])
+
+        for corr_index in range(num_corrs):
+            # R_ij = sqrt(rho) * Z_i + sqrt(1-rho) * epsilon_ij for this correlation, reusing the same epsilon block
+            numpy.multiply(epsilon_block, idiosyncratic_scales[corr_index], out=r_ij_block[0:block_loans])
+            r_ij_block[0:block_loans] += systematic_vectors[corr_index]
+
+            is_defaulted_mask = r_ij_block[0:block_loans] < pds_vector[block_start:block_end]
+            numpy.multiply(loan_loss_vector[block_start:block_end], is_defaulted_mask, out=loss_block[1:block_loans + 1])
+            loss_block[0] = sim_run_loss[corr_index]  # running total goes first to keep the dense summation order
+            sim_run_loss[corr_index] = loss_block[0:block_loans + 1].sum(axis=0)
+
+    sim_run_loss_pct = sim_run_loss / numpy.array(bals).sum() * 100
+    return sim_run_loss, sim_run_loss_pct
+
+
+def multi_factor_calc_sim(pds, lgds, bals, sectors, sector_correlation, correlation, sim_runs, factor_mat_in=None,
+                          mem_budget_mb=256, random_state=numpy.random):
+    """
+    performs the asset correlation simulation with K correlated sector factors instead of one systematic factor
+    R_ij = sqrt(rho_j) * Z_i,s(j) + sqrt(1-rho_j) * epsilon_ij where s(j) is the sector of loan j
+    the K x runs sector factors are drawn once as L @ (independent normals) with L the Cholesky factor of the sector
+    correlation from correlated_generator.cached_cholesky (cached by content, a matrix that is not positive definite
+    is repaired to the nearest correlation matrix first), then each block of loans gathers its sectors' factor rows,
+    so only one block of loans x runs is ever in memory and there is no loans x factors matmul
+    with one sector and a 1 x 1 sector correlation the draws and per-run losses are the same as chunked_calc_sim
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param sectors: list of sector index (0 to K-1) of each loan
+    :param sector_correlation: K x K correlation matrix of the sector factors, repaired if not positive definite
+    :param correlation: asset correlation with the loan's sector factor, one value or a list with one value per loan
+    :param sim_runs: number of simulation runs to do
+    :param factor_mat_in: K x runs matrix of pre-drawn correlated sector factors, to run calc on exact same randoms
+    :param mem_budget_mb: approximate memory in MB to use for one block of loans
+    :param random_state: source of the normal draws, the global numpy.random by default or a numpy Generator
+    :return: array of $ loss per sim run, array of % of balance loss per sim run
+    """
+    num_loans = len(pds)
+    sectors_array = numpy.asarray(sectors, dtype=numpy.intp)
+    num_sectors = len(sector_correlation)
+    if sectors_array.min() < 0 or sectors_array.max() >= num_sectors:
+        raise ValueError("sectors must be between 0 and " + str(num_sectors - 1))
+
+    if factor_mat_in is None:
+        # correlated sector factors, one row per sector
+        factor_matrix = correlated_generator.cached_cholesky(sector_correlation) @ \
+            random_state.normal(loc=mu, scale=sigma, size=(num_sectors, sim_runs))
+    else:
+        # use the set of randoms you were given
+        factor_matrix = numpy.asarray(factor_mat_in, dtype=float)
+
+    correlation_array = numpy.broadcast_to(numpy.asarray(correlation, dtype=float), (num_loans,))
+    pds_vector = norm_inv(numpy.array(pds)).reshape((num_loans, 1))  # column vector of norm inverse loan level PDs
+    loan_loss_vector = (numpy.array(lgds) * numpy.array(bals)).reshape((num_loans, 1))
+    systematic_scale = numpy.sqrt(correlation_array).reshape((num_loans, 1))
+    idiosyncratic_scale = numpy.sqrt(1.0 - correlation_array).reshape((num_loans, 1))
+
+    # a block holds the epsilon rows, the gathered factor rows, the default mask and the loss rows -> 25 bytes per cell
+    # row 0 of the loss block carries the running total, as in chunked_calc_sim
+    block_size = min(num_loans, loans_per_block(sim_runs, mem_budget_mb, bytes_per_cell=25))
+    loss_block = numpy.zeros((block_size + 1, sim_runs))
+    factor_block = numpy.empty((block_size, sim_runs))
+    for block_start in range(0, num_loans, block_size):
+        block_end = min(block_start + block_size, num_loans)
+        block_loans = block_end - block_start
+
+        r_ij_block = random_state.normal(loc=mu, scale=sigma, size=(block_loans, sim_runs))
+        # gather each loan's sector factor row, then R_ij built in place on the epsilon block
+        numpy.take(factor_matrix, sectors_array[block_start:block_end], axis=0, out=factor_block[:block_loans])
+        factor_block[:block_loans] *= systematic_scale[block_start:block_end]
+        r_ij_block *= idiosyncratic_scale[block_start:block_end]
+        r_ij_block += factor_block[:block_loans]
+
+        is_defaulted_mask = r_ij_block < pds_vector[block_start:block_end]
+        numpy.multiply(loan_loss_vector[block_start:block_end], is_defaulted_mask, out=loss_block[1:block_loans + 1])
+        loss_block[0] = loss_block[0:block_loans + 1].sum(axis=0)
+
+    sim_run_loss = loss_block[0].copy()
+    sim_run_loss_pct = sim_run_loss / numpy.array(bals).sum() * 100
+    return sim_run_loss, sim_run_loss_pct
+
+
+def conditional_calc_sim(pds, lgds, bals, correlation, sim_runs, z_vec_in=None, method="large_pool", mem_budget_mb=256,
+                         z_grid_points=4096):
+    """
+    performs the simulation using conditional independence: given Z_i the loans default independently with
+    conditional probability p_ij = norm((norm_inv(PD_j) - sqrt(rho) * Z_i) / sqrt(1-rho)), so no epsilon matrix is drawn
+    methods:
+        "bernoulli"  - exact, draws one uniform per loan per run block by block and defaults if u_ij < p_ij
+        "large_pool" - Vasicek large pool limit, loss for run i is the conditional expected loss SUM(lgd * bal * p_ij)
+        "normal"     - conditional loss approximated by a normal with the conditional mean and variance, one draw per run
+    the conditional mean and variance are smooth monotone functions of Z, so the large pool and normal methods
+    evaluate them on an even grid of Z values between the smallest and largest draw and interpolate for each run,
+    costing O(loans x grid + runs) instead of O(loans x runs). loans sharing a PD are also grouped
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param correlation: value to use for asset correlation
+    :param sim_runs: number of simulation runs to do
+    :param z_vec_in: array of pre-drawn Z_i value for the sim, to run calc on exact same random variables
+    :param method: one of "bernoulli", "large_pool" or "normal"
+    :param mem_budget_mb: approximate memory in MB to use for one block of loans
+    :param z_grid_points: number of Z grid points for the large pool and normal methods, with no more runs than this
+        the moments are evaluated at every run's Z instead
+    :return: array of $ loss per sim run, array of % of balance loss per sim run
+    """
+    if method not in ("bernoulli", "large_pool", "normal"):
+        raise ValueError("method must be one of 'bernoulli', 'large_pool' or 'normal', got " + str(method))
+
+    if z_vec_in is None:
+        # make new set of randoms for Z_i
+        z_vector = numpy.random.normal(loc=mu, scale=sigma, size=(1, sim_runs))  # vector of randoms for Z_i
+    else:
+        # use the set of randoms you were given
+        z_vector = z_vec_in
+    z_vector = numpy.asarray(z_vector).reshape((1, sim_runs))
+
+    loan_loss_array = numpy.array(lgds) * numpy.array(bals)
+    if method == "bernoulli":
+        # every loan needs its own draw, so no grouping
+        pd_groups = numpy.array(pds)
+        group_loss = loan_loss_array
+        group_loss_sq = None
+    else:
+        # loans with the same PD have the same conditional PD, so only their summed losses matter
+        pd_groups, group_index = numpy.unique(numpy.array(pds), return_inverse=True)
+        group_loss = numpy.bincount(group_index, weights=loan_loss_array)
+        group_loss_sq = numpy.bincount(group_index, weights=loan_loss_array ** 2)
+
+    if method != "bernoulli" and sim_runs > z_grid_points:
+        # moments on a grid of Z values, interpolated for each run below
+        z_points = numpy.linspace(z_vector.min(), z_vector.max(), z_grid_points).reshape((1, z_grid_points))
+    else:
+        z_points = z_vector
+    num_points = z_points.shape[1]
+
+    num_groups = len(pd_groups)
+    pds_vector = norm_inv(pd_groups).reshape((num_groups, 1))
+    systematic_vector = math.sqrt(correlation) * z_points
+    idiosyncratic_scale = math.sqrt(1.0 - correlation)
+
+    # each block holds the conditional PDs plus one more float array of the same size -> 16 bytes per cell
+    block_size = min(num_groups, loans_per_block(num_points, mem_budget_mb, bytes_per_cell=16))
+    cond_mean = numpy.zeros(num_points)
+    cond_var = numpy.zeros(num_points)
+    for block_start in range(0, num_groups, block_size):
+        block_end = min(block_start + block_size, num_groups)
+        # scipy.special.ndtr is the same standard normal cdf as norm without the frozen distribution overhead
+        cond_pd_block = scipy.special.ndtr((pds_vector[block_start:block_end] - systematic_vector) / idiosyncratic_scale)
+
+        if method == "bernoulli":
+            is_defaulted_mask = numpy.random.random(size=cond_pd_block.shape) < cond_pd_block
+            cond_mean += group_loss[block_start:block_end] @ is_defaulted_mask
+        else:
+            cond_mean += group_loss[block_start:block_end] @ cond_pd_block
+            if method == "normal":
+                # variance of a sum of independent bernoullis: SUM(loss^2 * p * (1-p)), per loan not per group
+                cond_var += group_loss_sq[block_start:block_end] @ (cond_pd_block * (1.0 - cond_pd_block))
+
+    if z_points is not z_vector:
+        cond_mean = numpy.interp(z_vector[0], z_points[0], cond_mean)
+        cond_var = numpy.interp(z_vector[0], z_points[0], cond_var)
+
+    if method == "normal":
+        sim_run_loss = numpy.maximum(cond_mean + numpy.sqrt(cond_var) * numpy.random.normal(size=sim_runs), 0.0)
+    else:
+        sim_run_loss = cond_mean
+
+    sim_run_loss_pct = sim_run_loss / numpy.array(bals).sum() * 100
+    return sim_run_loss, sim_run_loss_pct
+
 
-    # generate a pool of loans that have random PDs, LGDs and Balances
-    loan_pds = [random.random() for i in range(0, num_loans)]  # loan level default probs
-    loan_lgds = [random.random() for i in range(0, num_loans)]  # loan level loss given defaults
-    loan_bals = [float(random.randrange(loan_bal_min, loan_bal_max, 1000)) for i in range(0, num_loans)]  # balances
+def engine_accuracy_report(pds, lgds, bals, correlation, sim_runs, percentiles=(50, 75, 90, 95, 99, 99.9),
+                           methods=("bernoulli", "large_pool", "normal")):
+    """
+    compares the loss percentiles of the conditional independence engines with the brute force matrix engine
+    every engine runs on the same Z_i draws so the differences come from the method and not the systematic draws
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param correlation: value to use for asset correlation
+    :param sim_runs: number of simulation runs to do
+    :param percentiles: percentiles (0-100) of the % loss distribution to compare
+    :param methods: conditional_calc_sim methods to compare
+    :return: dict of method -> {"runtime": seconds, "percentiles": {pctl: {"value", "reference", "abs_diff"}}}
+    """
+    z_vector = numpy.random.normal(loc=mu, scale=sigma, size=(1, sim_runs))
+
+    start = time.perf_counter()
+    reference_pct = chunked_calc_sim(pds, lgds, bals, correlation, sim_runs, z_vec_in=z_vector)[1]
+    report = {"brute_force": {"runtime": time.perf_counter() - start, "percentiles": dict()}}
+    reference_values = numpy.percentile(reference_pct, percentiles)
+    for percentile, reference in zip(percentiles, reference_values):
+        report["brute_force"]["percentiles"][percentile] = {"value": reference, "reference": reference, "abs_diff": 0.0}
+
+    for method in methods:
+        start = time.perf_counter()
+        method_pct = conditional_calc_sim(pds, lgds, bals, correlation, sim_runs, z_vec_in=z_vector, method=method)[1]
+        report[method] = {"runtime": time.perf_counter() - start, "percentiles": dict()}
+        method_values = numpy.percentile(method_pct, percentiles)
+        for percentile, value, reference in zip(percentiles, method_values, reference_values):
+            report[method]["percentiles"][percentile] = {"value": value, "reference": reference,
+                                                         "abs_diff": abs(value - reference)}
+
+    return report
+
+
+class _AntitheticNormals:
+    """
+    normal draw source for chunked_calc_sim that returns antithetic pairs
+    each request draws half the columns and appends their negatives, so run i and run i + runs/2 are a pair
+    """
+
+    def __init__(self, random_state):
+        self.random_state = random_state
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        rows, cols = size
+        half_draws = self.random_state.normal(loc=0.0, scale=1.0, size=(rows, cols // 2))
+        return loc + scale * numpy.hstack((half_draws, -half_draws))
+
+
+def weighted_percentile(values, weights, percentiles):
+    """
+    percentiles of a likelihood ratio weighted sample with the unnormalised tail estimator: the smallest value L with
+    SUM(weights of values > L) / N <= 1 - alpha. the weights are not divided by their noisy total, so an importance
+    sampling shift towards the tail does not spread that noise over every percentile
+    with equal weights of 1 this is the order statistic numpy.percentile(values, percentiles, method="inverted_cdf"),
+    not the default linear interpolation of numpy.percentile (used by engine_accuracy_report and loss_stats), which
+    can be up to the gap between neighbouring order statistics higher
+    :param values: array of sampled values
+    :param weights: array of likelihood ratio weights, same length as values
+    :param percentiles: list of percentiles between 0 and 100
+    :return: array of values at the percentiles
+    """
+    values = numpy.asarray(values)
+    order = numpy.argsort(values)
+    sorted_values = values[order]
+    # weight strictly above each sorted value, ties share the weight above their last copy
+    weight_above = numpy.cumsum(numpy.asarray(weights, dtype=float)[order][::-1])[::-1]
+    weight_above = numpy.append(weight_above[1:], 0.0)
+    weight_above = weight_above[numpy.searchsorted(sorted_values, sorted_values, side="right") - 1]
+
+    # weight_above only falls with the position, the tolerance keeps 1 - alpha rounding from moving a whole run
+    tail_limits = (1.0 - numpy.asarray(percentiles, dtype=float) / 100.0) * len(values) * (1.0 + 1e-9)
+    positions = numpy.searchsorted(-weight_above, -tail_limits, side="left")
+    return sorted_values[numpy.minimum(positions, len(values) - 1)]
+
+
+def variance_reduced_calc_sim(pds, lgds, bals, correlation, sim_runs, scheme="antithetic",
+                              percentiles=(50, 75, 90, 95, 99, 99.9), num_batches=20, z_shift=None, seed=None,
+                              mem_budget_mb=256, num_bootstrap=200):
+    """
+    performs the asset correlation simulation with a variance reduction scheme and reports standard errors
+    schemes:
+        "plain"      - plain pseudo-random draws, the baseline to compare against
+        "antithetic" - every (Z_i, epsilon_ij) draw is paired with (-Z_i, -epsilon_ij)
+        "importance" - Z_i is drawn from N(z_shift, 1) and each run is weighted by the likelihood ratio
+                       exp(-z_shift * Z_i + z_shift^2 / 2), pushing runs into the loss tail
+        "sobol"      - Z_i from a scrambled Sobol sequence (randomised quasi-Monte Carlo), epsilon_ij pseudo-random,
+                       the balance properties of the sequence need a power of 2 points, so the runs per batch are
+                       rounded to the nearest power of 2 and the total can differ from sim_runs
+    the runs are split into num_batches independent batches (a fresh scramble per batch for sobol). the standard error
+    of the mean is the standard deviation of the batch means / sqrt(num_batches). a batch holds too few tail runs for
+    its own tail percentiles, so the percentile standard errors come from bootstrapping the full sample estimator over
+    its independent units: runs for plain and importance, antithetic pairs, and whole batches for sobol
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param correlation: value to use for asset correlation
+    :param sim_runs: number of simulation runs to do, split evenly over the batches (rounded for sobol)
+    :param scheme: one of "plain", "antithetic", "importance" or "sobol"
+    :param percentiles: percentiles (0-100) of the % loss distribution to estimate
+    :param num_batches: number of independent batches used for the standard errors
+    :param z_shift: mean of Z_i for importance sampling, defaults to half of norm_inv of the highest tail probability
+                    (the full shift moves most runs past the target and the weights become very uneven)
+    :param seed: seed for the numpy Generator
+    :param mem_budget_mb: approximate memory in MB to use for one block of loans
+    :param num_bootstrap: number of bootstrap resamples for the percentile standard errors
+    :return: dict with the per-run % losses and weights, and estimate / std_error of the mean and each percentile
+    """
+    if scheme not in ("plain", "antithetic", "importance", "sobol"):
+        raise ValueError("scheme must be one of 'plain', 'antithetic', 'importance' or 'sobol', got " + str(scheme))
 
-    # pre-make random draws for Z and epsilon. can be re-used to run calculation on exact same set of random draws
-    z_vector_static = numpy.random.normal(loc=mu, scale=sigma, size=(1, num_runs))  # vector of randoms for Z_i
-    epsilon_matrix_static = numpy.random.normal(loc=mu, scale=sigma, size=(num_loans, num_runs))  # randoms for e_ij
+    batch_runs = sim_runs // num_batches
+    if scheme == "antithetic" and batch_runs % 2 == 1:
+        batch_runs -= 1  # runs come in pairs
+    if scheme == "sobol" and batch_runs >= 2:
+        batch_runs = 2 ** int(round(math.log2(batch_runs)))
+    if batch_runs < 2:
+        raise ValueError("sim_runs is too small for " + str(num_batches) + " batches")
+    if z_shift is None:
+        z_shift = norm_inv(1.0 - max(percentiles) / 100.0) / 2.0
+
+    random_state = numpy.random.default_rng(seed)
+    batch_loss_pcts = list()
+    batch_weights = list()
+    for batch in range(num_batches):
+        draw_source = random_state
+        z_vector = None
+        weights = numpy.ones(batch_runs)
+        if scheme == "antithetic":
+            draw_source = _AntitheticNormals(random_state)
+        elif scheme == "importance":
+            z_vector = random_state.normal(loc=z_shift, scale=sigma, size=(1, batch_runs))
+            weights = numpy.exp(-z_shift * z_vector[0] + z_shift ** 2 / 2.0)
+        elif scheme == "sobol":
+            import scipy.stats.qmc  # only the sobol scheme needs scipy.stats
+            sobol = scipy.stats.qmc.Sobol(d=1, scramble=True, seed=random_state)
+            z_vector = norm_inv(sobol.random_base2(int(math.log2(batch_runs)))).reshape((1, batch_runs))
+
+        batch_loss_pct = chunked_calc_sim(pds, lgds, bals, correlation, batch_runs, z_vec_in=z_vector,
+                                          mem_budget_mb=mem_budget_mb, random_state=draw_source)[1]
+        batch_loss_pcts.append(batch_loss_pct)
+        batch_weights.append(weights)
+
+    # estimates from all runs, the standard error of the mean from the spread of the batch means
+    batch_means = numpy.array([numpy.average(loss_pct, weights=weights)
+                               for loss_pct, weights in zip(batch_loss_pcts, batch_weights)])
+    loss_pct = numpy.concatenate(batch_loss_pcts)
+    weights = numpy.concatenate(batch_weights)
+    pctl_estimates = weighted_percentile(loss_pct, weights, percentiles)
+
+    # rows of run indices that were drawn independently of each other
+    if scheme == "sobol":
+        bootstrap_units = numpy.arange(len(loss_pct)).reshape((num_batches, batch_runs))
+    elif scheme == "antithetic":
+        half_runs = batch_runs // 2
+        pair_starts = (numpy.arange(num_batches).reshape((-1, 1)) * batch_runs + numpy.arange(half_runs)).ravel()
+        bootstrap_units = numpy.column_stack((pair_starts, pair_starts + half_runs))
+    else:
+        bootstrap_units = numpy.arange(len(loss_pct)).reshape((-1, 1))
+    bootstrap_pctls = numpy.empty((num_bootstrap, len(percentiles)))
+    for resample in range(num_bootstrap):
+        picked = bootstrap_units[random_state.integers(0, len(bootstrap_units), len(bootstrap_units))].ravel()
+        bootstrap_pctls[resample] = weighted_percentile(loss_pct[picked], weights[picked], percentiles)
+    pctl_std_errors = bootstrap_pctls.std(axis=0, ddof=1)
+
+    results = {"scheme": scheme, "loss_pct": loss_pct, "weights": weights,
+               "mean": {"estimate": numpy.average(loss_pct, weights=weights),
+                        "std_error": batch_means.std(ddof=1) / math.sqrt(num_batches)},
+               "percentiles": dict()}
+    for percentile, estimate, std_error in zip(percentiles, pctl_estimates, pctl_std_errors):
+        results["percentiles"][percentile] = {"estimate": estimate, "std_error": std_error}
+
+    return results
+
+
+# pool data held by each worker process, set once by _init_sim_worker instead of pickled with every task
+_sim_worker_data = dict()
+
+
+def _init_sim_worker(pds, lgds, bals, correlation, mem_budget_mb, scenario_dir=None, scenario_key=None):
+    """
+    process pool initializer, stores the loan pool in the worker so tasks only carry their run range and seed
+    when a scenario store is used the worker attaches to its memory maps once here
+    """
+    _sim_worker_data.update(pds=pds, lgds=lgds, bals=bals, correlation=correlation, mem_budget_mb=mem_budget_mb,
+                            scenarios=None)
+    if scenario_dir is not None:
+        _sim_worker_data["scenarios"] = scenario_store.load_scenarios(scenario_dir, *scenario_key, create=False)
+
+
+def _simulate_run_block(task):
+    """
+    worker task, simulates one block of runs with its own generator
+    :param task: tuple of (first run index, number of runs, numpy.random.SeedSequence for the block)
+    :return: first run index, array of $ loss for the block
+    """
+    block_start, block_runs, seed_seq = task
+    z_vec_in, epsilon_mat_in = None, None
+    if _sim_worker_data["scenarios"] is not None:
+        # zero-copy column views of the stored draws for this block of runs
+        z_vector, epsilon_matrix = _sim_worker_data["scenarios"]
+        z_vec_in = z_vector[:, block_start:block_start + block_runs]
+        epsilon_mat_in = epsilon_matrix[:, block_start:block_start + block_runs]
+
+    block_loss, block_loss_pct = chunked_calc_sim(pds=_sim_worker_data["pds"], lgds=_sim_worker_data["lgds"],
+                                                  bals=_sim_worker_data["bals"],
+                                                  correlation=_sim_worker_data["correlation"], sim_runs=block_runs,
+                                                  z_vec_in=z_vec_in, epsilon_mat_in=epsilon_mat_in,
+                                                  mem_budget_mb=_sim_worker_data["mem_budget_mb"],
+                                                  random_state=numpy.random.default_rng(seed_seq))
+    return block_start, block_loss
+
+
+def parallel_calc_sim(pds, lgds, bals, correlation, sim_runs, seed, workers=None, runs_per_task=10000,
+                      mem_budget_mb=256, scenario_dir=None):
+    """
+    performs the asset correlation simulation with the runs split across a process pool
+    the runs are cut into fixed blocks of runs_per_task and block k draws from the k-th child of
+    numpy.random.SeedSequence(seed), so the result depends on seed and runs_per_task but not on the number of workers
+    with a scenario_dir the workers instead read their runs from the stored scenario set for seed, and the result is
+    the same as chunked_calc_sim over that whole set
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param correlation: value to use for asset correlation
+    :param sim_runs: number of simulation runs to do
+    :param seed: root seed for the simulation
+    :param workers: number of worker processes, None for all cores, 1 to run in this process
+    :param runs_per_task: number of runs in each block, keep fixed to reproduce a result
+    :param mem_budget_mb: approximate memory in MB each worker uses for one block of loans
+    :param scenario_dir: directory of a scenario_store to take the draws from, None to draw per block
+    :return: array of $ loss per sim run, array of % of balance loss per sim run
+    """
+    block_seeds = numpy.random.SeedSequence(seed).spawn(int(math.ceil(sim_runs / runs_per_task)))
+    tasks = [(block_start, min(runs_per_task, sim_runs - block_start), block_seed)
+             for block_start, block_seed in zip(range(0, sim_runs, runs_per_task), block_seeds)]
+    init_args = (pds, lgds, bals, correlation, mem_budget_mb)
+    if scenario_dir is not None:
+        # make sure the scenario set exists before the workers try to attach to it
+        scenario_key = (seed, len(pds), sim_runs)
+        scenario_store.load_scenarios(scenario_dir, *scenario_key)
+        init_args += (scenario_dir, scenario_key)
+
+    if workers == 1:
+        _init_sim_worker(*init_args)
+        block_results = [_simulate_run_block(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_sim_worker, initargs=init_args) as proc_pool:
+            block_results = list(proc_pool.imap_unordered(_simulate_run_block, tasks))
 
-    # make data container for percentiles of distribution for each correlation run
+    # merge the blocks back into run order
+    sim_run_loss = numpy.empty(sim_runs)
+    for block_start, block_loss in block_results:
+        sim_run_loss[block_start:block_start + len(block_loss)] = block_loss
+
+    sim_run_loss_pct = sim_run_loss / numpy.array(bals).sum() * 100
+    return sim_run_loss, sim_run_loss_pct
+
+
+class SimulationState:
+    """
+    simulated loan pool that is kept between pool changes, so adding, removing or re-rating loans only recomputes
+    the rows of the loans that changed instead of re-running every loan
+    the run loss is a sum over loans of lgd * bal * default mask, so a change is applied as a delta to the run loss
+    each loan draws its epsilon row from its own generator numpy.random.default_rng([seed, 1, loan_id]), so a loan's
+    draws do not depend on which other loans are in the pool, and Z comes from numpy.random.default_rng([seed, 0])
+    default masks are kept as packed bits (sim_runs / 8 bytes per loan), removing a loan or changing its lgd or
+    balance needs no new draws, and only a PD change re-draws the loan's epsilon row
+    :param correlation: value to use for asset correlation
+    :param sim_runs: number of simulation runs
+    :param seed: root seed of the state
+    :param z_vec_in: array of pre-drawn Z_i values to use instead of drawing them from the seed
+    :param mem_budget_mb: approximate memory in MB to use for one block of loans when adding many at once
+    """
+
+    def __init__(self, correlation, sim_runs, seed, z_vec_in=None, mem_budget_mb=256):
+        self.correlation = correlation
+        self.sim_runs = sim_runs
+        self.seed = seed
+        self.mem_budget_mb = mem_budget_mb
+        if z_vec_in is None:
+            z_vec_in = numpy.random.default_rng([seed, 0]).normal(loc=mu, scale=sigma, size=sim_runs)
+        self.systematic_vector = math.sqrt(correlation) * numpy.asarray(z_vec_in, dtype=float).reshape(sim_runs)
+        self.idiosyncratic_scale = math.sqrt(1.0 - correlation)
+
+        self.run_loss = numpy.zeros(sim_runs)  # $ loss per sim run
+        self.total_bal = 0.0
+        self.loans = dict()  # loan_id -> (pd, lgd, bal)
+        self._row_of = dict()  # loan_id -> row of the packed default masks
+        self._free_rows = list()
+        self._mask_bits = numpy.zeros((0, (sim_runs + 7) // 8), dtype=numpy.uint8)
+
+    def __len__(self):
+        return len(self.loans)
+
+    def _default_masks(self, loan_ids, pds):
+        # default masks of a block of loans, each loan drawn from its own generator
+        pd_thresholds = norm_inv(numpy.asarray(pds, dtype=float)).reshape((len(loan_ids), 1))
+        epsilon_block = numpy.empty((len(loan_ids), self.sim_runs))
+        for row, loan_id in enumerate(loan_ids):
+            epsilon_block[row] = numpy.random.default_rng([self.seed, 1, loan_id]).normal(loc=mu, scale=sigma,
+                                                                                            size=self.sim_runs)
+        r_ij_block = self.systematic_vector + self.idiosyncratic_scale * epsilon_block
+        return r_ij_block < pd_thresholds
+
+    def _mask(self, loan_id):
+        # unpacked default mask of one loan
+        return numpy.unpackbits(self._mask_bits[self._row_of[loan_id]], count=self.sim_runs).astype(bool)
+
+    def _store_mask(self, loan_id, packed_mask):
+        if not self._free_rows:
+            # grow the packed mask array by doubling so adds are amortised
+            old_rows = len(self._mask_bits)
+            new_rows = max(16, 2 * old_rows)
+            self._mask_bits = numpy.concatenate([self._mask_bits, numpy.zeros((new_rows - old_rows,
+                                                                               self._mask_bits.shape[1]),
+                                                                              dtype=numpy.uint8)])
+            self._free_rows.extend(range(new_rows - 1, old_rows - 1, -1))
+        row = self._free_rows.pop()
+        self._mask_bits[row] = packed_mask
+        self._row_of[loan_id] = row
+
+    def add_loans(self, loan_ids, pds, lgds, bals):
+        """
+        adds loans to the pool, drawing them block by block
+        :param loan_ids: list of unique non-negative integer loan ids
+        :param pds: list of default probabilities
+        :param lgds: list of loss given defaults
+        :param bals: list of loan balances
+        """
+        loan_ids = [int(loan_id) for loan_id in loan_ids]
+        for loan_id in loan_ids:
+            if loan_id in self.loans:
+                raise ValueError("loan " + str(loan_id) + " is already in the pool")
+        if len(set(loan_ids)) != len(loan_ids):
+            raise ValueError("loan ids must be unique")
+
+        block_size = loans_per_block(self.sim_runs, self.mem_budget_mb)
+        for block_start in range(0, len(loan_ids), block_size):
+            block_end = min(block_start + block_size, len(loan_ids))
+            block_ids = loan_ids[block_start:block_end]
+            is_defaulted_mask = self._default_masks(block_ids, pds[block_start:block_end])
+            loan_loss = numpy.array(lgds[block_start:block_end], dtype=float) * \
+                numpy.array(bals[block_start:block_end], dtype=float)
+            self.run_loss += loan_loss @ is_defaulted_mask
+            packed_masks = numpy.packbits(is_defaulted_mask, axis=1)
+            for row, loan_id in enumerate(block_ids):
+                self._store_mask(loan_id, packed_masks[row])
+                self.loans[loan_id] = (pds[block_start + row], lgds[block_start + row], bals[block_start + row])
+                self.total_bal += bals[block_start + row]
+
+    def add_loan(self, loan_id, pd, lgd, bal):
+        """
+        adds one loan to the pool
+        """
+        self.add_loans([loan_id], [pd], [lgd], [bal])
+
+    def remove_loan(self, loan_id):
+        """
+        removes one loan from the pool, no draws are needed
+        """
+        pd, lgd, bal = self.loans.pop(loan_id)
+        self.run_loss -= lgd * bal * self._mask(loan_id)
+        self.total_bal -= bal
+        self._free_rows.append(self._row_of.pop(loan_id))
+
+    def update_loan(self, loan_id, pd=None, lgd=None, bal=None):
+        """
+        re-rates or resizes one loan, only a PD change re-draws the loan's row
+        :param loan_id: id of a loan in the pool
+        :param pd: new default probability, None to keep
+        :param lgd: new loss given default, None to keep
+        :param bal: new balance, None to keep
+        """
+        old_pd, old_lgd, old_bal = self.loans[loan_id]
+        new_pd = old_pd if pd is None else pd
+        new_lgd = old_lgd if lgd is None else lgd
+        new_bal = old_bal if bal is None else bal
+
+        old_mask = self._mask(loan_id)
+        if new_pd == old_pd:
+            self.run_loss += (new_lgd * new_bal - old_lgd * old_bal) * old_mask
+        else:
+            new_mask = self._default_masks([loan_id], [new_pd])[0]
+            self.run_loss += new_lgd * new_bal * new_mask - old_lgd * old_bal * old_mask
+            self._mask_bits[self._row_of[loan_id]] = numpy.packbits(new_mask)
+        self.loans[loan_id] = (new_pd, new_lgd, new_bal)
+        self.total_bal += new_bal - old_bal
+
+    def losses(self):
+        """
+        loss distribution of the current pool
+        :return: array of $ loss per sim run, array of % of balance loss per sim run
+        """
+        return self.run_loss.copy(), self.run_loss / self.total_bal * 100
+
+    def resync(self):
+        """
+        rebuilds the run loss from the stored default masks, clearing rounding drift after many delta updates
+        """
+        loan_ids = list(self.loans)
+        self.run_loss = numpy.zeros(self.sim_runs)
+        block_size = loans_per_block(self.sim_runs, self.mem_budget_mb, bytes_per_cell=1)
+        for block_start in range(0, len(loan_ids), block_size):
+            block_ids = loan_ids[block_start:block_start + block_size]
+            rows = [self._row_of[loan_id] for loan_id in block_ids]
+            is_defaulted_mask = numpy.unpackbits(self._mask_bits[rows], axis=1, count=self.sim_runs)
+            loan_loss = numpy.array([self.loans[loan_id][1] * self.loans[loan_id][2] for loan_id in block_ids])
+            self.run_loss += loan_loss @ is_defaulted_mask
+
+    def tail_contributions(self, percentile=99.0):
+        """
+        marginal contribution of each loan to the expected shortfall: its average loss over the sim runs in the tail
+        at or above the percentile of the pool loss, the contributions add up to the expected shortfall in $
+        :param percentile: tail percentile between 0 and 100
+        :return: array of loan ids, array of $ contributions, expected shortfall in $
+        """
+        tail_runs = numpy.flatnonzero(self.run_loss >= numpy.percentile(self.run_loss, percentile))
+        loan_ids = numpy.array(list(self.loans), dtype=numpy.int64)
+        contributions = numpy.empty(len(loan_ids))
+        block_size = loans_per_block(self.sim_runs, self.mem_budget_mb, bytes_per_cell=1)
+        for block_start in range(0, len(loan_ids), block_size):
+            block_ids = loan_ids[block_start:block_start + block_size]
+            rows = [self._row_of[loan_id] for loan_id in block_ids]
+            tail_masks = numpy.unpackbits(self._mask_bits[rows], axis=1, count=self.sim_runs)[:, tail_runs]
+            loan_loss = numpy.array([self.loans[loan_id][1] * self.loans[loan_id][2] for loan_id in block_ids])
+            contributions[block_start:block_start + len(block_ids)] = loan_loss * tail_masks.mean(axis=1)
+
+        return loan_ids, contributions, self.run_loss[tail_runs].mean()
+
+
+def make_loan_pool(num_loans, loan_bal_min=10000, loan_bal_max=10000000, seed=None):
+    """
+    generates a pool of loans that have random PDs, LGDs and balances
+    :param num_loans: number of loans in the pretend pool
+    :param loan_bal_min: minimum loan balance
+    :param loan_bal_max: maximum loan balance
+    :param seed: seed of the pool, None for a new pool every time
+    :return: list of PDs, list of LGDs, list of balances
+    """
+    random_state = random.Random(seed)
+    loan_pds = [random_state.random() for i in range(0, num_loans)]  # loan level default probs
+    loan_lgds = [random_state.random() for i in range(0, num_loans)]  # loan level loss given defaults
+    loan_bals = [float(random_state.randrange(loan_bal_min, loan_bal_max, 1000)) for i in range(0, num_loans)]
+    return loan_pds, loan_lgds, loan_bals
+
+
+def correlation_sweep_stats(pds, lgds, bals, corr_list, num_runs, scenario_dir="scenarios", scenario_seed=1234,
+                            runs_per_block=10000, verbose=True):
+    """
+    loss distribution statistics for every correlation in one pass over the shared random draws
+    runs are done in blocks and reduced into streaming statistics, so memory does not grow with num_runs
+    the draws come from a memory-mapped scenario store, so later runs attach to the same draws instead of re-generating
+    :param pds: list of default probabilities
+    :param lgds: list of loss given defaults
+    :param bals: list of loan balances
+    :param corr_list: list of correlations, rounded to 2 decimals
+    :param num_runs: number of simulation runs to do
+    :param scenario_dir: directory of the memory-mapped random draws
+    :param scenario_seed: seed of the random draws in the scenario store
+    :param runs_per_block: number of runs simulated and reduced into the loss statistics at once
+    :param verbose: print progress
+    :return: dict of str(correlation) -> loss_stats.LossDistributionStats of the % of balance losses
+    """
+    z_vector_static, epsilon_matrix_static = scenario_store.load_scenarios(scenario_dir, scenario_seed, len(pds),
+                                                                           num_runs)
+    sim_stats_dict = dict()
+    for correlation in corr_list:
+        sim_stats_dict[str(correlation)] = loss_stats.LossDistributionStats()
+
+    for run_start in range(0, num_runs, runs_per_block):
+        run_end = min(run_start + runs_per_block, num_runs)
+        if verbose:
+            print("Running Calculation for " + str(len(corr_list)) + " correlations, runs " + str(run_start) + "-" +
+                  str(run_end))
+        sweep_loss, sweep_loss_pct = sweep_calc_sim(pds=pds, lgds=lgds, bals=bals,
+                                                    correlations=corr_list, sim_runs=run_end - run_start,
+                                                    z_vec_in=z_vector_static[:, run_start:run_end],
+                                                    epsilon_mat_in=epsilon_matrix_static[:, run_start:run_end])
+        for corr_index, correlation in enumerate(corr_list):
+            sim_stats_dict[str(correlation)].update(sweep_loss_pct[corr_index])
+
+    return sim_stats_dict
+
+
+def percentile_curves(corr_list, sim_stats_dict, pctls_graph_series):
+    """
+    for each correlation run, the values of the distribution for a fixed set of percentiles
+    :return: dict of percentile string -> list of loss values in corr_list order
+    """
     pctl_graph_data = dict()
     for percentile in pctls_graph_series:
         pctl_graph_data[percentile] = list()
 
-    # perform calculation using matrix multiplication
-    sim_results_dict = dict()
     for correlation in corr_list:
-        correlation = round(correlation, 2)
-        print("Running Calculation for correlation = " + str(correlation))
-        sim_results = matrix_calc_sim(pds=loan_pds, lgds=loan_lgds, bals=loan_bals,
-                                      correlation=correlation, sim_runs=num_runs,
-                                      z_vec_in=z_vector_static, epsilon_mat_in=epsilon_matrix_static)
-
-        sim_run_loss_list, sim_run_loss_pct_list = sim_results[0], sim_results[1]
-        sim_results_dict[str(correlation)] = {'dollar': sim_run_loss_list, 'percent': sim_run_loss_pct_list}
-
-        # for each correlation run, the values of the distribution for a fixed set of percentiles
-        for percentile in pctls_graph_series:
-            pctl_graph_data[percentile].append(numpy.percentile(numpy.array(sim_run_loss_pct_list), float(percentile)))
-
-    # PLOTTING
-    # make histogram for corr=0.05, corr=0.15, and corr=0.25
-    correlation_graphs = ['0.05', '0.1', '0.15', '0.25']
+        pctl_values = sim_stats_dict[str(correlation)].quantile([float(percentile) for percentile in pctls_graph_series])
+        for percentile, pctl_value in zip(pctls_graph_series, pctl_values):
+            pctl_graph_data[percentile].append(float(pctl_value))
+
+    return pctl_graph_data
+
+
+def plot_sweep(corr_list, sim_stats_dict, pctl_graph_data, correlation_graphs=('0.05', '0.1', '0.15', '0.25')):
+    """
+    saves the loss distribution histograms and the percentile curves as png files
+    matplotlib is only imported here, so headless runs never load it
+    """
+    from matplotlib import pyplot
+
+    # make histogram for each correlation in correlation_graphs
+    correlation_graphs = [entry for entry in correlation_graphs if entry in sim_stats_dict]
     fig1 = pyplot.figure()
     ax1 = fig1.add_subplot(111)
     for entry in correlation_graphs:
-        hist, bins = numpy.histogram(sim_results_dict[entry]['percent'], bins=50, density=True)
+        hist, bins = sim_stats_dict[entry].histogram(bins=50, density=True)
         ax1.plot(bins[0:-1], hist)
     ax1.grid()
     ax1.set_xlabel('Loss (% of Balance)')
@@ -188,15 +1007,59 @@ if __name__ == "__main__":
 
     fig2 = pyplot.figure()
     ax2 = fig2.add_subplot(111)
-    for percentile in pctls_graph_series:
+    for percentile in pctl_graph_data:
         ax2.plot(corr_list, pctl_graph_data[percentile])
     ax2.grid()
     ax2.set_xlabel('Correlation')
     ax2.set_ylabel('Loss (% of Balance) at Percentile')
-    ax2.legend(pctls_graph_series)
+    ax2.legend(list(pctl_graph_data))
 
     fig1.savefig("Portfolio Loss Distribution.png")
     fig2.savefig("Distribution Percentile Curves")
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="single factor asset correlation simulation over a range of "
+                                                 "correlations")
+    parser.add_argument("--loans", type=int, default=1000, help="number of loans in the pretend pool")
+    parser.add_argument("--runs", type=int, default=100000, help="number of simulation runs to do")
+    parser.add_argument("--corr-min", type=float, default=0.01, help="lowest correlation")
+    parser.add_argument("--corr-max", type=float, default=0.50, help="highest correlation")
+    parser.add_argument("--corr-steps", type=int, default=50, help="number of correlations")
+    parser.add_argument("--pool-seed", type=int, default=None, help="seed of the random loan pool")
+    parser.add_argument("--scenario-dir", default="scenarios", help="directory of the memory-mapped random draws")
+    parser.add_argument("--scenario-seed", type=int, default=1234, help="seed of the random draws")
+    parser.add_argument("--runs-per-block", type=int, default=10000, help="runs simulated at once")
+    parser.add_argument("--headless", action="store_true", help="no plots, print the results as JSON")
+    parser.add_argument("--output", default=None, help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    # constants
+    corr_list = numpy.round(numpy.linspace(args.corr_min, args.corr_max, args.corr_steps), 2)
+    pctls_graph_series = ['50', '75', '90', '95', '99', '99.9']
+
+    loan_pds, loan_lgds, loan_bals = make_loan_pool(args.loans, seed=args.pool_seed)
+    sim_stats_dict = correlation_sweep_stats(loan_pds, loan_lgds, loan_bals, corr_list, args.runs,
+                                             scenario_dir=args.scenario_dir, scenario_seed=args.scenario_seed,
+                                             runs_per_block=args.runs_per_block, verbose=not args.headless)
+    pctl_graph_data = percentile_curves(corr_list, sim_stats_dict, pctls_graph_series)
+
+    results = {"correlations": [float(correlation) for correlation in corr_list],
+               "percentile_curves": pctl_graph_data,
+               "summaries": {str(correlation): sim_stats_dict[str(correlation)].summary(
+                   [float(percentile) for percentile in pctls_graph_series]) for correlation in corr_list}}
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if args.headless:
+        if args.output is None:
+            print(json.dumps(results))
+    else:
+        plot_sweep(corr_list, sim_stats_dict, pctl_graph_data)
 
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Memory-mapped store of pre-drawn random scenarios for the single factor simulation
+# The Z_i vector and the epsilon_ij matrix are written once to .npy files keyed by seed and shape
+# Later runs, and every worker process, re-open them read-only with numpy.load(mmap_mode="r")
+# so the draws are not re-generated and the pages are shared by the OS instead of copied into each process
+# The draws come from numpy.random.RandomState(seed) in the same order as the script's own dense draws:
+# numpy.random.seed(seed); z = normal(size=(1, runs)); epsilon = normal(size=(loans, runs))
+
+# imports
+import os
+import numpy
+from numpy.lib.format import open_memmap
+
+
+def scenario_paths(store_dir, seed, num_loans, num_runs):
+    """
+    file paths of the Z vector and epsilon matrix for one scenario set
+    :param store_dir: directory holding the scenario files
+    :param seed: seed the scenarios were drawn with
+    :param num_loans: number of loans (rows of epsilon)
+    :param num_runs: number of simulation runs (columns of Z and epsilon)
+    :return: path to Z vector file, path to epsilon matrix file
+    """
+    key = "seed" + str(seed) + "_" + str(num_loans) + "x" + str(num_runs)
+    return os.path.join(store_dir, "z_" + key + ".npy"), os.path.join(store_dir, "epsilon_" + key + ".npy")
+
+
+def write_scenarios(store_dir, seed, num_loans, num_runs, block_loans=1000):
+    """
+    draws a scenario set and writes it to memory-mapped .npy files, epsilon is drawn one block of loan rows at a time
+    files are written under a temporary name and renamed at the end so a reader never attaches to a partial file
+    :param store_dir: directory holding the scenario files
+    :param seed: seed to draw the scenarios with
+    :param num_loans: number of loans (rows of epsilon)
+    :param num_runs: number of simulation runs (columns of Z and epsilon)
+    :param block_loans: number of epsilon rows drawn and written at once
+    :return: path to Z vector file, path to epsilon matrix file
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    z_path, epsilon_path = scenario_paths(store_dir, seed, num_loans, num_runs)
+    random_state = numpy.random.RandomState(seed)
+
+    # temporary names carry the process id so concurrent writers of the same set do not collide
+    tmp_suffix = ".tmp" + str(os.getpid()) + ".npy"
+    z_tmp_path = z_path[:-len(".npy")] + tmp_suffix
+    numpy.save(z_tmp_path, random_state.normal(loc=0.0, scale=1.0, size=(1, num_runs)))
+
+    epsilon_tmp_path = epsilon_path[:-len(".npy")] + tmp_suffix
+    epsilon_matrix = open_memmap(epsilon_tmp_path, mode="w+", dtype=numpy.float64, shape=(num_loans, num_runs))
+    for block_start in range(0, num_loans, block_loans):
+        block_end = min(block_start + block_loans, num_loans)
+        epsilon_matrix[block_start:block_end] = random_state.normal(loc=0.0, scale=1.0,
+                                                                    size=(block_end - block_start, num_runs))
+    epsilon_matrix.flush()
+    del epsilon_matrix
+
+    os.replace(z_tmp_path, z_path)
+    os.replace(epsilon_tmp_path, epsilon_path)
+    return z_path, epsilon_path
+
+
+def load_scenarios(store_dir, seed, num_loans, num_runs, create=True):
+    """
+    attaches to a stored scenario set as read-only memory maps, drawing and writing it first if it does not exist
+    the returned arrays can be passed straight to the z_vec_in / epsilon_mat_in parameters of the simulation functions
+    :param store_dir: directory holding the scenario files
+    :param seed: seed the scenarios were drawn with
+    :param num_loans: number of loans (rows of epsilon)
+    :param num_runs: number of simulation runs (columns of Z and epsilon)
+    :param create: write the scenario set if it is not in the store yet
+    :return: (1 x runs) Z vector memmap, (loans x runs) epsilon matrix memmap
+    """
+    z_path, epsilon_path = scenario_paths(store_dir, seed, num_loans, num_runs)
+    if not (os.path.exists(z_path) and os.path.exists(epsilon_path)):
+        if not create:
+            raise FileNotFoundError("no scenario set for seed " + str(seed) + " and shape " +
+                                    str((num_loans, num_runs)) + " in " + str(store_dir))
+        write_scenarios(store_dir, seed, num_loans, num_runs)
+
+    z_vector = numpy.load(z_path, mmap_mode="r")
+    epsilon_matrix = numpy.load(epsilon_path, mmap_mode="r")
+    return z_vector, epsilon_matrix
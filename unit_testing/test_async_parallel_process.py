@@ -0,0 +1,31 @@
+import os
+import sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "async_parallel_process"))
+import async_paralell_process  # noqa: E402
+
+
+class TestRowBlockExecutor(unittest.TestCase):
+
+    def test_rows_in_order(self):
+        array = numpy.random.default_rng(0).standard_normal((103, 17))
+        expected = [async_paralell_process.take_average(row) for row in array]
+        with async_paralell_process.RowBlockExecutor(processes=2) as executor:
+            for rows_per_chunk in (None, 1, 10, 500):
+                self.assertEqual(executor.map_rows(async_paralell_process.take_average, array,
+                                                   rows_per_chunk=rows_per_chunk), expected)
+            # the same pool is reused for a second array of another shape
+            other = numpy.arange(12.0).reshape((4, 3))
+            self.assertEqual(executor.map_rows(async_paralell_process.take_average, other), [1.0, 4.0, 7.0, 10.0])
+
+    def test_run_parallel_matches_brute_force(self):
+        array = numpy.random.default_rng(1).standard_normal((40, 25))
+        with async_paralell_process.RowBlockExecutor(processes=2, rows_per_chunk=7) as executor:
+            parallel_averages = async_paralell_process.run_parallel(array, executor=executor)[0]
+        self.assertEqual(parallel_averages, async_paralell_process.run_brute_force(array)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "collatz_conjecture"))
+import run_collatz  # noqa: E402
+
+
+def reference_results(start_num, stop_num):
+    series = [run_collatz.collatz_whileloop(num) for num in range(start_num, stop_num)]
+    return [len(sequence) - 1 for sequence in series], [max(sequence) for sequence in series]
+
+
+class TestCollatzEngines(unittest.TestCase):
+
+    def test_exact_batch_matches_whileloop(self):
+        stopping_times, peaks = run_collatz.collatz_exact_batch(1, 3000)
+        self.assertEqual((stopping_times, peaks), reference_results(1, 3000))
+
+    def test_exact_batch_small_memo(self):
+        # values above memo_limit are walked again instead of stored
+        stopping_times, peaks = run_collatz.collatz_exact_batch(500, 1500, memo_limit=100)
+        self.assertEqual((stopping_times, peaks), reference_results(500, 1500))
+
+    def test_vectorised_matches_whileloop(self):
+        expected_times, expected_peaks = reference_results(1, 3000)
+        for block_size, memo_limit in ((65536, 10000000), (97, 10000000), (256, 500)):
+            start_nums, stopping_times, peaks = run_collatz.collatz_vectorised(1, 3000, block_size=block_size,
+                                                                             memo_limit=memo_limit)
+            self.assertTrue(numpy.array_equal(start_nums, numpy.arange(1, 3000)))
+            self.assertEqual(list(stopping_times), expected_times)
+            self.assertEqual([int(peak) for peak in peaks], expected_peaks)
+
+    def test_vectorised_offset_range(self):
+        start_nums, stopping_times, peaks = run_collatz.collatz_vectorised(10000, 11000, block_size=128)
+        expected_times, expected_peaks = reference_results(10000, 11000)
+        self.assertEqual(list(stopping_times), expected_times)
+        self.assertEqual([int(peak) for peak in peaks], expected_peaks)
+
+
+class TestCollatzStore(unittest.TestCase):
+
+    def test_store_round_trip(self):
+        expected_times, expected_peaks = reference_results(20, 600)
+        with tempfile.TemporaryDirectory() as save_dir:
+            run_collatz.write_collatz_store(save_dir, 20, 600, block_size=100)
+            store = run_collatz.load_collatz_store(save_dir)
+            self.assertEqual(store["stopping_times"].dtype, numpy.int32)
+            self.assertEqual(list(store["stopping_times"]), expected_times)
+            self.assertEqual([int(peak) for peak in store["peaks"]], expected_peaks)
+            for num in (20, 27, 97, 599):
+                self.assertEqual([int(value) for value in run_collatz.load_trajectory(store, num)],
+                                 run_collatz.collatz_whileloop(num))
+            with self.assertRaises(KeyError):
+                run_collatz.load_trajectory(store, 600)
+            del store  # release the memmaps before the directory is removed
+
+    def test_store_without_trajectories(self):
+        with tempfile.TemporaryDirectory() as save_dir:
+            run_collatz.write_collatz_store(save_dir, 1, 100, with_trajectories=False)
+            store = run_collatz.load_collatz_store(save_dir)
+            self.assertEqual(list(store["stopping_times"]), reference_results(1, 100)[0])
+            with self.assertRaises(KeyError):
+                run_collatz.load_trajectory(store, 27)
+            del store
+
+
+class TestCollatzScanner(unittest.TestCase):
+
+    def check_records(self, records, start_num, stop_num):
+        stopping_times, peaks = run_collatz.collatz_exact_batch(start_num, stop_num)
+        longest, highest = int(numpy.argmax(stopping_times)), int(numpy.argmax(peaks))
+        self.assertEqual(records["longest"], [start_num + longest, stopping_times[longest]])
+        self.assertEqual(records["highest"], [start_num + highest, peaks[highest]])
+
+    def test_block_records_exact_above_2_53(self):
+        # peaks above 2^53 are rounded if any step goes through float64
+        run_collatz._init_scan_worker(1000)
+        for block_start in (2 ** 53 + 1, 2 ** 55 + 3, 2 ** 60 + 1):
+            started, stopped, records = run_collatz._scan_block((block_start, block_start + 64))
+            self.assertEqual((started, stopped), (block_start, block_start + 64))
+            self.check_records(records, block_start, block_start + 64)
+
+    def test_scan_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint_file = os.path.join(checkpoint_dir, "scan.json")
+            first = run_collatz.scan_collatz_range(2 ** 60 + 1, 2 ** 60 + 401, block_size=100, workers=2,
+                                                   checkpoint_file=checkpoint_file, memo_table_size=1000,
+                                                   verbose=False)
+            self.assertEqual(first["numbers_scanned"], 400)
+            self.check_records(first, 2 ** 60 + 1, 2 ** 60 + 401)
+
+            resumed = run_collatz.scan_collatz_range(2 ** 60 + 1, 2 ** 60 + 401, block_size=100, workers=2,
+                                                     checkpoint_file=checkpoint_file, memo_table_size=1000,
+                                                     verbose=False)
+            self.assertEqual(resumed["numbers_scanned"], 0)
+            self.assertEqual((resumed["longest"], resumed["highest"]), (first["longest"], first["highest"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
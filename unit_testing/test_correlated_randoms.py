@@ -0,0 +1,107 @@
+import os
+import sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "correlated_randoms"))
+import correlated_generator  # noqa: E402
+import correlated_randoms_with_cholesky  # noqa: E402
+
+
+class TestCorrelatedNormalGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.target_matrix = numpy.array([[1.0, 0.6, -0.3],
+                                          [0.6, 1.0, 0.2],
+                                          [-0.3, 0.2, 1.0]])
+
+    def test_cholesky_cached_by_content(self):
+        factor = correlated_generator.cached_cholesky(self.target_matrix)
+        self.assertTrue(numpy.allclose(factor @ factor.T, self.target_matrix))
+        self.assertIs(correlated_generator.cached_cholesky(self.target_matrix.tolist()), factor)
+        self.assertGreaterEqual(correlated_generator._cholesky_factor.cache_info()["hits"], 1)
+        self.assertFalse(factor.flags.writeable)
+        self.assertEqual(correlated_generator.cached_cholesky(self.target_matrix, dtype=numpy.float32).dtype,
+                         numpy.float32)
+
+    def test_repairs_matrix_that_is_not_positive_definite(self):
+        broken_matrix = numpy.array([[1.0, 0.9, -0.9],
+                                     [0.9, 1.0, 0.9],
+                                     [-0.9, 0.9, 1.0]])
+        with self.assertRaises(numpy.linalg.LinAlgError):
+            correlated_generator.cached_cholesky(broken_matrix, repair=False)
+        factor = correlated_generator.cached_cholesky(broken_matrix)
+        repaired = factor @ factor.T
+        self.assertTrue(numpy.allclose(numpy.diag(repaired), 1.0))
+        self.assertGreater(numpy.linalg.eigvalsh(repaired).min(), 0.0)
+
+    def test_draws_have_target_correlation(self):
+        generator = correlated_generator.CorrelatedNormalGenerator(self.target_matrix, seed=1)
+        deviation, where = correlated_generator.validate_generator(generator, self.target_matrix, 200000,
+                                                                   block_size=30000)
+        self.assertLess(deviation, 0.01)
+
+    def test_seeded_blocks_repeat(self):
+        out = numpy.empty((3, 1000))
+        first = [block.copy() for block in
+                 correlated_generator.CorrelatedNormalGenerator(self.target_matrix, seed=2).blocks(2500, 1000, out=out)]
+        second = list(correlated_generator.CorrelatedNormalGenerator(self.target_matrix, seed=2).blocks(2500, 1000))
+        self.assertEqual([block.shape[1] for block in first], [1000, 1000, 500])
+        for first_block, second_block in zip(first, second):
+            self.assertTrue(numpy.array_equal(first_block, second_block))
+
+
+class TestStreamingCorrelation(unittest.TestCase):
+
+    def test_blocks_match_corrcoef(self):
+        random_state = numpy.random.default_rng(3)
+        draws = numpy.tril(numpy.ones((4, 4))) @ random_state.normal(loc=5.0, size=(4, 9000))  # offset, correlated
+        validator = correlated_generator.StreamingCorrelation(4)
+        for block_start in range(0, 9000, 2000):
+            validator.update(draws[:, block_start:block_start + 2000])
+        self.assertEqual(validator.count, 9000)
+        self.assertTrue(numpy.allclose(validator.correlation(), numpy.corrcoef(draws), rtol=0.0, atol=1e-12))
+        self.assertTrue(numpy.allclose(correlated_generator.sample_correlation(draws), numpy.corrcoef(draws),
+                                       rtol=0.0, atol=1e-12))
+
+    def test_max_abs_deviation(self):
+        draws = numpy.random.default_rng(4).standard_normal((3, 5000))
+        target_matrix = numpy.corrcoef(draws)
+        target_matrix[0, 2] = target_matrix[2, 0] = target_matrix[0, 2] + 0.5
+        validator = correlated_generator.StreamingCorrelation(3)
+        validator.update(draws)
+        deviation, where = validator.max_abs_deviation(target_matrix)
+        self.assertAlmostEqual(deviation, 0.5)
+        self.assertIn(where, [(0, 2), (2, 0)])
+
+
+class RecordingAxes:
+    # stands in for matplotlib axes, keeps the arguments of imshow
+
+    def imshow(self, image, **kwargs):
+        self.image = image
+        self.kwargs = kwargs
+
+
+class TestCorrelatedPairs(unittest.TestCase):
+
+    def test_pairs_have_target_correlations(self):
+        results = correlated_randoms_with_cholesky.correlated_pairs((0.3, 0.95), rand_draws=50000, seed=7)
+        self.assertEqual(results["rands"].shape, (2, 50000))
+        for target_correlation in (0.3, 0.95):
+            self.assertAlmostEqual(results["correlated_corr_coeff"][target_correlation], target_correlation, delta=0.01)
+            self.assertTrue(numpy.array_equal(results["correlated"][target_correlation][0], results["rands"][0]))
+
+    def test_density_image_counts_every_draw(self):
+        draws = correlated_randoms_with_cholesky.correlated_pairs((0.5,), rand_draws=20000, seed=8)["correlated"][0.5]
+        axes = RecordingAxes()
+        correlated_randoms_with_cholesky.density_image(axes, draws, bins=40)
+        self.assertEqual(axes.image.shape, (40, 40))
+        self.assertEqual(numpy.nansum(axes.image), 20000)
+        self.assertFalse(numpy.any(axes.image == 0))  # empty cells are blank
+        self.assertEqual(axes.kwargs["extent"], (draws[0].min(), draws[0].max(), draws[1].min(), draws[1].max()))
+        self.assertEqual(axes.kwargs["origin"], "lower")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decorator"))
+import caching  # noqa: E402
+import profiling  # noqa: E402
+
+
+@profiling.count_calls
+def counted(value):
+    return value + 1
+
+
+@profiling.profiled(name="test_decorator.sampled", sample_rate=0.25)
+def sampled(value):
+    return value * 2
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        profiling.enable()
+        profiling.registry.clear()
+
+    def tearDown(self):
+        profiling.enable()
+
+    def test_counts_and_sampled_latencies(self):
+        for value in range(100):
+            self.assertEqual(counted(value), value + 1)
+            self.assertEqual(sampled(value), value * 2)
+
+        summary = profiling.registry.summary()
+        self.assertEqual(summary[counted.__module__ + ".counted"]["calls"], 100)
+        self.assertEqual(summary["test_decorator.sampled"]["calls"], 100)
+        self.assertEqual(summary["test_decorator.sampled"]["sampled_calls"], 25)
+        self.assertLessEqual(summary["test_decorator.sampled"]["min_us"], summary["test_decorator.sampled"]["p50_us"])
+        self.assertLessEqual(summary["test_decorator.sampled"]["p50_us"], summary["test_decorator.sampled"]["max_us"])
+
+    def test_disabled_calls_are_not_counted(self):
+        profiling.disable()
+        for value in range(10):
+            counted(value)
+        profiling.enable()
+        counted(0)
+        self.assertEqual(profiling.registry.summary()[counted.__module__ + ".counted"]["calls"], 1)
+
+    def test_merge_snapshot(self):
+        for value in range(8):
+            sampled(value)
+        other_registry = profiling.ProfileRegistry()
+        other_registry.merge(profiling.registry.snapshot())
+        other_registry.merge(profiling.registry.snapshot())
+
+        merged = other_registry.summary()["test_decorator.sampled"]
+        self.assertEqual(merged["calls"], 16)
+        self.assertEqual(merged["sampled_calls"], 4)
+        # reading the counts does not count as calls
+        self.assertEqual(profiling.registry.summary()["test_decorator.sampled"]["calls"], 8)
+
+
+class TestCaching(unittest.TestCase):
+
+    def test_hits_by_content_and_read_only_results(self):
+        calls = []
+
+        @caching.memoize(max_entries=4)
+        def doubled(values):
+            calls.append(1)
+            return values * 2.0
+
+        first = doubled(numpy.arange(5.0))
+        self.assertIs(doubled(numpy.arange(5.0)), first)  # a different array with the same content
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(first.flags.writeable)
+        doubled(numpy.arange(5, dtype=numpy.float32))  # same values, different dtype
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(doubled.cache_info()["hits"], 1)
+        self.assertEqual(doubled.cache_info()["misses"], 2)
+
+    def test_least_recently_used_eviction(self):
+        @caching.memoize(max_entries=2)
+        def squared(value):
+            return value * value
+
+        squared(1)
+        squared(2)
+        squared(1)  # 2 is now the least recently used
+        squared(3)
+        self.assertEqual(squared.cache_info()["evictions"], 1)
+        squared(1)
+        self.assertEqual(squared.cache_info()["hits"], 2)
+        squared(2)
+        self.assertEqual(squared.cache_info()["misses"], 4)
+
+    def test_byte_budget(self):
+        cache = caching.BoundedCache(max_entries=100, max_bytes=3 * 8000)
+        for key in range(4):
+            cache.put(str(key), numpy.zeros(1000))
+        self.assertEqual(cache.info()["entries"], 3)
+        self.assertLessEqual(cache.info()["bytes"], 3 * 8000)
+        self.assertFalse(cache.get("0")[0])
+        cache.put("large", numpy.zeros(4000))  # larger than the whole budget
+        self.assertFalse(cache.get("large")[0])
+        self.assertEqual(cache.info()["entries"], 3)
+
+    def test_time_to_live(self):
+        cache = caching.BoundedCache(ttl=0.05)
+        cache.put("key", 1)
+        self.assertEqual(cache.get("key"), (True, 1))
+        time.sleep(0.1)
+        self.assertEqual(cache.get("key"), (False, None))
+
+    def test_disk_tier_across_caches(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            first = caching.BoundedCache(disk_dir=disk_dir, name="test")
+            first.put("key", numpy.arange(3.0))
+            second = caching.BoundedCache(disk_dir=disk_dir, name="test")
+            found, value = second.get("key")
+            self.assertTrue(found)
+            self.assertTrue(numpy.array_equal(value, numpy.arange(3.0)))
+            self.assertFalse(value.flags.writeable)
+            self.assertEqual(second.info()["disk_hits"], 1)
+            second.clear(disk=True)
+            self.assertEqual(os.listdir(disk_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import os
+import sys
+import unittest
+import numpy as np
+from scipy.optimize import minimize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "efficient_frontier",
+                                "efficient_frontier"))
+import efficient_frontier  # noqa: E402
+
+
+def reference_qp(covariance, constraint_matrix, constraint_values):
+    # same problem solved with scipy's general purpose SLSQP
+    num_assets = covariance.shape[0]
+    result = minimize(lambda weights: weights @ covariance @ weights, np.full(num_assets, 1.0 / num_assets),
+                      jac=lambda weights: 2.0 * covariance @ weights, method="SLSQP",
+                      bounds=[(0.0, None)] * num_assets,
+                      constraints=[{"type": "eq", "fun": lambda weights: constraint_matrix @ weights - constraint_values,
+                                    "jac": lambda weights: constraint_matrix}],
+                      options={"ftol": 1e-14, "maxiter": 1000})
+    return result.x
+
+
+class TestLongOnlyQP(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.default_rng(1)
+        factors = random_state.normal(size=(8, 40))
+        self.covariance = np.cov(factors) * 0.01
+        self.avg_returns = random_state.uniform(0.02, 0.12, 8)
+        self.num_assets = 8
+
+    def check_against_reference(self, constraint_matrix, constraint_values, start_weights):
+        weights = efficient_frontier._long_only_qp(self.covariance, constraint_matrix, constraint_values,
+                                                   start_weights)
+        reference = reference_qp(self.covariance, constraint_matrix, constraint_values)
+
+        self.assertTrue(np.all(weights >= 0.0))
+        self.assertTrue(np.allclose(constraint_matrix @ weights, constraint_values, atol=1e-10))
+        self.assertLessEqual(weights @ self.covariance @ weights, reference @ self.covariance @ reference + 1e-12)
+        self.assertTrue(np.allclose(weights, reference, atol=1e-4))
+
+    def test_min_variance(self):
+        self.check_against_reference(np.ones((1, self.num_assets)), np.ones(1),
+                                     np.full(self.num_assets, 1.0 / self.num_assets))
+
+    def test_target_return(self):
+        constraint_matrix = np.vstack((np.ones(self.num_assets), self.avg_returns))
+        max_asset = np.argmax(self.avg_returns)
+        for target in np.linspace(self.avg_returns.mean(), self.avg_returns[max_asset], 5)[:-1]:
+            # feasible start: mix of equal weights and the highest return asset hitting the target
+            equal_weights = np.full(self.num_assets, 1.0 / self.num_assets)
+            mix = (target - self.avg_returns.mean()) / (self.avg_returns[max_asset] - self.avg_returns.mean())
+            start_weights = (1.0 - mix) * equal_weights
+            start_weights[max_asset] += mix
+            self.check_against_reference(constraint_matrix, np.array([1.0, target]), start_weights)
+
+
+class TestSolveFrontier(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.default_rng(2)
+        self.covariance = np.cov(random_state.normal(size=(6, 30))) * 0.01
+        self.avg_returns = random_state.uniform(0.02, 0.12, 6)
+        self.constraint_matrix = np.vstack((np.ones(6), self.avg_returns))
+
+    def test_unbounded_matches_kkt_solution(self):
+        risks, returns, weights = efficient_frontier.solve_frontier(self.avg_returns, self.covariance, num_points=10,
+                                                                    long_only=False)
+        kkt_matrix = np.block([[2.0 * self.covariance, self.constraint_matrix.T],
+                               [self.constraint_matrix, np.zeros((2, 2))]])
+        for point in range(10):
+            kkt_values = np.concatenate((np.zeros(6), [1.0, returns[point]]))
+            self.assertTrue(np.allclose(weights[:, point], np.linalg.solve(kkt_matrix, kkt_values)[:6], atol=1e-9))
+
+    def test_long_only_matches_reference(self):
+        risks, returns, weights = efficient_frontier.solve_frontier(self.avg_returns, self.covariance, num_points=10,
+                                                                    long_only=True)
+        self.assertTrue(np.all(weights >= 0.0))
+        self.assertTrue(np.all(np.diff(returns) > 0.0))
+        for point in range(10):
+            reference = reference_qp(self.covariance, self.constraint_matrix, np.array([1.0, returns[point]]))
+            self.assertTrue(np.allclose(weights[:, point], reference, atol=1e-4))
+            self.assertLessEqual(risks[point], np.sqrt(reference @ self.covariance @ reference) + 1e-9)
+
+
+class TestFactorCovariance(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.default_rng(4)
+        self.num_assets = 80
+        self.factor_covariance = efficient_frontier.FactorCovariance(random_state.normal(size=(80, 4)) * 0.1,
+                                                                     np.eye(4), random_state.uniform(0.01, 0.05, 80))
+        self.dense_covariance = self.factor_covariance.to_dense()
+        self.avg_returns = random_state.uniform(0.01, 0.15, 80)
+
+    def test_solves_match_dense(self):
+        values = np.random.default_rng(5).normal(size=(80, 2))
+        self.assertTrue(np.allclose(self.factor_covariance.solve(values[:, 0]),
+                                    np.linalg.solve(self.dense_covariance, values[:, 0])))
+        subset = np.arange(3, 80, 3)
+        self.assertTrue(np.allclose(self.factor_covariance.solve_subset(subset, values[subset]),
+                                    np.linalg.solve(self.dense_covariance[np.ix_(subset, subset)], values[subset])))
+
+    def test_long_only_frontier_matches_dense(self):
+        factor_risks, factor_returns, factor_weights = efficient_frontier.solve_frontier(
+            self.avg_returns, self.factor_covariance, num_points=20)
+        dense_risks, dense_returns, dense_weights = efficient_frontier.solve_frontier(
+            self.avg_returns, self.dense_covariance, num_points=20)
+        self.assertTrue(np.allclose(factor_weights, dense_weights, atol=1e-8))
+        self.assertTrue(np.allclose(factor_risks, dense_risks, rtol=1e-9))
+        self.assertTrue(np.all(factor_weights >= 0.0))
+
+
+class TestAssetUniverse(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.default_rng(3)
+        self.asset_names = ["asset_" + str(index) for index in range(5)]
+        self.avg_returns = random_state.uniform(0.02, 0.12, 5)
+        self.std_devs = random_state.uniform(0.05, 0.3, 5)
+        self.correlations = np.corrcoef(random_state.normal(size=(5, 50)))
+
+    def test_updates_match_fresh_universe(self):
+        universe = efficient_frontier.AssetUniverse(self.asset_names, self.avg_returns, self.std_devs,
+                                                    self.correlations)
+        universe.covariance()
+        universe.cholesky()  # cached before the updates, so the updates have to patch them
+
+        new_correlations = self.correlations.copy()
+        new_correlations[2, :] = new_correlations[:, 2] = new_correlations[2, :] * 0.5
+        new_correlations[2, 2] = 1.0
+        new_std_devs = self.std_devs.copy()
+        new_std_devs[[1, 2]] = [0.4, 0.15]
+        new_returns = self.avg_returns.copy()
+        new_returns[4] = 0.2
+        universe.update_asset("asset_1", std_dev=0.4)
+        universe.update_asset("asset_2", std_dev=0.15, correlations=new_correlations[2])
+        universe.update_asset("asset_4", avg_return=0.2)
+
+        fresh = efficient_frontier.AssetUniverse(self.asset_names, new_returns, new_std_devs, new_correlations)
+        self.assertTrue(np.allclose(universe.covariance(), fresh.covariance(), rtol=1e-12, atol=0.0))
+        self.assertTrue(np.allclose(universe.cholesky(), fresh.cholesky(), rtol=1e-12, atol=1e-15))
+        self.assertTrue(np.allclose(universe.cholesky() @ universe.cholesky().T, fresh.covariance()))
+        self.assertTrue(np.array_equal(universe.avg_returns, new_returns))
+
+    def test_weights_by_name(self):
+        universe = efficient_frontier.AssetUniverse(self.asset_names, self.avg_returns, self.std_devs,
+                                                    self.correlations)
+        weights = {"asset_3": 0.25, "asset_0": 0.75}
+        weights_array = np.array([0.75, 0.0, 0.0, 0.25, 0.0])
+        risk, avg_return, sharpe = universe.portfolio_risk_return(weights)
+        self.assertAlmostEqual(float(np.ravel(avg_return)[0]), weights_array @ self.avg_returns)
+        self.assertAlmostEqual(float(np.ravel(risk)[0]),
+                               np.sqrt(weights_array @ universe.covariance() @ weights_array))
+
+
+class TestFrontierPlotData(unittest.TestCase):
+
+    def test_density_grid_matches_histogram2d(self):
+        random_state = np.random.default_rng(5)
+        x, y = random_state.random(5000), random_state.random(5000)
+        values = random_state.normal(size=5000)
+        grid = efficient_frontier.density_grid(x, y, values=values, bins=(8, 6))
+
+        counts, x_edges, y_edges = np.histogram2d(x, y, bins=(grid["x_edges"], grid["y_edges"]))
+        self.assertTrue(np.array_equal(grid["counts"], counts.T))
+        value_sums = np.histogram2d(x, y, bins=(x_edges, y_edges), weights=values)[0]
+        self.assertTrue(np.allclose(grid["mean"], value_sums.T / counts.T))
+        first_cell = (x < x_edges[1]) & (y < y_edges[1])
+        self.assertEqual(grid["max"][0, 0], values[first_cell].max())
+
+    def test_density_grid_empty_cells_and_range(self):
+        grid = efficient_frontier.density_grid([0.1, 0.9, 2.0], [0.1, 0.9, 0.5], values=[1.0, 2.0, 3.0], bins=2,
+                                               x_range=(0.0, 1.0), y_range=(0.0, 1.0))
+        self.assertTrue(np.array_equal(grid["counts"], [[1, 0], [0, 1]]))  # the point outside x_range is dropped
+        self.assertTrue(np.isnan(grid["max"][0, 1]))
+        self.assertTrue(np.isnan(grid["mean"][1, 0]))
+        self.assertEqual(grid["max"][1, 1], 2.0)
+
+    def test_upper_hull_envelopes_the_points(self):
+        random_state = np.random.default_rng(6)
+        x, y = random_state.random(2000), random_state.random(2000)
+        hull_x, hull_y = efficient_frontier.upper_hull(x, y, efficient_only=False)
+        self.assertEqual(hull_x[0], x.min())
+        self.assertEqual(hull_x[-1], x.max())
+        self.assertTrue(np.all(np.diff(np.diff(hull_y) / np.diff(hull_x)) < 0))  # concave
+        self.assertTrue(np.all(y <= np.interp(x, hull_x, hull_y) + 1e-12))
+
+        efficient_x, efficient_y = efficient_frontier.upper_hull(x, y)
+        self.assertEqual(efficient_y[-1], y.max())
+        self.assertTrue(np.array_equal(efficient_x, hull_x[:len(efficient_x)]))
+
+    def test_upper_hull_small_case(self):
+        hull_x, hull_y = efficient_frontier.upper_hull([0.0, 1.0, 2.0, 3.0, 1.0], [0.0, 2.0, 2.5, 1.0, 1.0])
+        self.assertEqual(hull_x.tolist(), [0.0, 1.0, 2.0])
+        self.assertEqual(hull_y.tolist(), [0.0, 2.0, 2.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+import math
+import os
+import sys
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "single_factor_sim"))
+import loss_stats  # noqa: E402
+import run_single_factor_sim  # noqa: E402
+import scenario_store  # noqa: E402
+
+
+def make_pool(num_loans, seed=0):
+    random_state = numpy.random.default_rng(seed)
+    pds = random_state.uniform(0.002, 0.05, num_loans)
+    lgds = random_state.uniform(0.2, 0.8, num_loans)
+    bals = random_state.uniform(1e4, 1e6, num_loans)
+    return pds, lgds, bals
+
+
+class TestStreamingEngines(unittest.TestCase):
+
+    def setUp(self):
+        self.pds, self.lgds, self.bals = make_pool(300)
+        self.sim_runs = 2000
+        self.mem_budget_mb = 0.5  # a few loans per block, so the loss is carried across many blocks
+
+    def test_chunked_matches_matrix(self):
+        numpy.random.seed(42)
+        dense_loss, dense_loss_pct = run_single_factor_sim.matrix_calc_sim(self.pds, self.lgds, self.bals, 0.2,
+                                                                             self.sim_runs)
+        numpy.random.seed(42)
+        chunked_loss, chunked_loss_pct = run_single_factor_sim.chunked_calc_sim(self.pds, self.lgds, self.bals, 0.2,
+                                                                                self.sim_runs,
+                                                                                mem_budget_mb=self.mem_budget_mb)
+        self.assertTrue(numpy.array_equal(numpy.array(dense_loss), chunked_loss))
+        self.assertTrue(numpy.array_equal(numpy.array(dense_loss_pct), chunked_loss_pct))
+
+    def test_chunked_reads_given_draws(self):
+        random_state = numpy.random.default_rng(1)
+        z_vector = random_state.standard_normal((1, self.sim_runs))
+        epsilon_matrix = random_state.standard_normal((len(self.pds), self.sim_runs))
+        dense_loss, dense_loss_pct = run_single_factor_sim.matrix_calc_sim(self.pds, self.lgds, self.bals, 0.3,
+                                                                             self.sim_runs, z_vec_in=z_vector,
+                                                                             epsilon_mat_in=epsilon_matrix)
+        chunked_loss, chunked_loss_pct = run_single_factor_sim.chunked_calc_sim(self.pds, self.lgds, self.bals, 0.3,
+                                                                                self.sim_runs, z_vec_in=z_vector,
+                                                                                epsilon_mat_in=epsilon_matrix,
+                                                                                mem_budget_mb=self.mem_budget_mb)
+        self.assertTrue(numpy.array_equal(numpy.array(dense_loss), chunked_loss))
+
+    def test_sweep_matches_matrix(self):
+        correlations = [0.05, 0.2, 0.5]
+        numpy.random.seed(7)
+        sweep_loss, sweep_loss_pct = run_single_factor_sim.sweep_calc_sim(self.pds, self.lgds, self.bals,
+                                                                          correlations, self.sim_runs,
+                                                                          mem_budget_mb=self.mem_budget_mb)
+        for corr_index, correlation in enumerate(correlations):
+            numpy.random.seed(7)
+            dense_loss, dense_loss_pct = run_single_factor_sim.matrix_calc_sim(self.pds, self.lgds, self.bals,
+                                                                                 correlation, self.sim_runs)
+            self.assertTrue(numpy.array_equal(numpy.array(dense_loss), sweep_loss[corr_index]))
+            self.assertTrue(numpy.array_equal(numpy.array(dense_loss_pct), sweep_loss_pct[corr_index]))
+
+
+    def test_parallel_independent_of_workers(self):
+        single_loss, single_loss_pct = run_single_factor_sim.parallel_calc_sim(self.pds, self.lgds, self.bals, 0.2,
+                                                                               self.sim_runs, seed=11, workers=1,
+                                                                               runs_per_task=500)
+        for workers in (2, 3):
+            pool_loss, pool_loss_pct = run_single_factor_sim.parallel_calc_sim(self.pds, self.lgds, self.bals, 0.2,
+                                                                               self.sim_runs, seed=11,
+                                                                               workers=workers, runs_per_task=500)
+            self.assertTrue(numpy.array_equal(single_loss, pool_loss))
+            self.assertTrue(numpy.array_equal(single_loss_pct, pool_loss_pct))
+
+        other_seed_loss = run_single_factor_sim.parallel_calc_sim(self.pds, self.lgds, self.bals, 0.2, self.sim_runs,
+                                                                  seed=12, workers=1, runs_per_task=500)[0]
+        self.assertFalse(numpy.array_equal(single_loss, other_seed_loss))
+
+
+class TestLossDistributionStats(unittest.TestCase):
+
+    def setUp(self):
+        self.percentiles = [0, 1, 50, 90, 99, 99.9, 100]
+
+    def check_quantiles(self, losses, stats):
+        bin_width = (stats.value_range[1] - stats.value_range[0]) / stats.fine_bins
+        self.assertLessEqual(numpy.abs(stats.quantile(self.percentiles) -
+                                       numpy.percentile(losses, self.percentiles)).max(), bin_width)
+
+    def test_merged_blocks_match_numpy(self):
+        losses = numpy.random.default_rng(0).gamma(2.0, 3.0, 50000)
+        stats = loss_stats.LossDistributionStats()
+        other = loss_stats.LossDistributionStats()
+        stats.update(losses[:20000])
+        other.update(losses[20000:])
+        stats.merge(other)
+
+        self.assertEqual(stats.count, len(losses))
+        self.assertAlmostEqual(stats.mean, losses.mean(), places=10)
+        self.assertAlmostEqual(stats.std_dev(), losses.std(ddof=1), places=10)
+        self.check_quantiles(losses, stats)
+        tail = numpy.sort(losses)[-50:]  # 99.9% of 50000 leaves exactly 50 losses in the tail
+        self.assertAlmostEqual(stats.expected_shortfall(99.9), tail.mean(), places=6)
+
+    def test_sparse_bins_match_numpy(self):
+        # one loss per occupied bin with many empty bins between, like the far tail
+        losses = numpy.arange(100) / 2.0
+        stats = loss_stats.LossDistributionStats()
+        stats.update(losses)
+        self.check_quantiles(losses, stats)
+        self.assertAlmostEqual(float(stats.quantile(50)), 24.75)
+
+    def test_out_of_range_raises(self):
+        stats = loss_stats.LossDistributionStats()
+        stats.update([0.0, 100.0])
+        with self.assertRaises(ValueError):
+            stats.update([50.0, 150.0])  # e.g. $ losses passed instead of % losses
+        self.assertEqual(stats.count, 2)
+
+
+class TestVarianceReduction(unittest.TestCase):
+
+    def setUp(self):
+        self.pds, self.lgds, self.bals = make_pool(100, seed=10)
+
+    def test_equal_weights_are_inverted_cdf(self):
+        values = numpy.random.default_rng(0).standard_normal(1001)
+        percentiles = [0, 1, 50, 98, 99.9, 100]
+        self.assertTrue(numpy.array_equal(run_single_factor_sim.weighted_percentile(values, numpy.ones(1001),
+                                                                                    percentiles),
+                                          numpy.percentile(values, percentiles, method="inverted_cdf")))
+
+    def test_unnormalised_tail_estimator(self):
+        # half the weight total of a plain sample: the tail holds twice the values for the same weight
+        values = numpy.arange(100.0)
+        self.assertEqual(run_single_factor_sim.weighted_percentile(values, numpy.full(100, 0.5), [90])[0], 79.0)
+
+    def test_sobol_batches_are_powers_of_two(self):
+        results = run_single_factor_sim.variance_reduced_calc_sim(self.pds, self.lgds, self.bals, 0.2, 20000,
+                                                                  scheme="sobol", num_batches=20, seed=1)
+        self.assertEqual(len(results["loss_pct"]), 20 * 1024)
+
+    def test_schemes_agree_within_standard_errors(self):
+        estimates = dict()
+        for scheme in ("plain", "antithetic", "importance", "sobol"):
+            results = run_single_factor_sim.variance_reduced_calc_sim(self.pds, self.lgds, self.bals, 0.2, 8192,
+                                                                      scheme=scheme, percentiles=(50, 99),
+                                                                      num_batches=8, seed=2, num_bootstrap=50)
+            self.assertEqual(len(results["loss_pct"]), len(results["weights"]))
+            for percentile in (50, 99):
+                self.assertGreater(results["percentiles"][percentile]["std_error"], 0.0)
+            estimates[scheme] = results
+
+        for scheme, results in estimates.items():
+            for percentile in (50, 99):
+                difference = results["percentiles"][percentile]["estimate"] - \
+                    estimates["plain"]["percentiles"][percentile]["estimate"]
+                std_error = math.hypot(results["percentiles"][percentile]["std_error"],
+                                       estimates["plain"]["percentiles"][percentile]["std_error"])
+                self.assertLess(abs(difference), 5.0 * std_error + 1e-9)
+
+
+class TestConditionalEngines(unittest.TestCase):
+
+    def setUp(self):
+        self.pds, self.lgds, self.bals = make_pool(2000, seed=2)
+
+    def test_grid_matches_exact_moments(self):
+        z_vector = numpy.random.default_rng(4).standard_normal((1, 20000))
+        for method in ("large_pool", "normal"):
+            numpy.random.seed(9)
+            grid_loss_pct = run_single_factor_sim.conditional_calc_sim(self.pds, self.lgds, self.bals, 0.2, 20000,
+                                                                       z_vec_in=z_vector, method=method,
+                                                                       z_grid_points=2048)[1]
+            numpy.random.seed(9)
+            exact_loss_pct = run_single_factor_sim.conditional_calc_sim(self.pds, self.lgds, self.bals, 0.2, 20000,
+                                                                        z_vec_in=z_vector, method=method,
+                                                                        z_grid_points=20000)[1]
+            self.assertLess(numpy.abs(grid_loss_pct - exact_loss_pct).max(), 1e-4)
+
+    def test_engine_accuracy_report(self):
+        numpy.random.seed(3)
+        percentiles = (50, 90, 99)
+        report = run_single_factor_sim.engine_accuracy_report(self.pds, self.lgds, self.bals, 0.15, 5000,
+                                                              percentiles=percentiles)
+        self.assertEqual(set(report), {"brute_force", "bernoulli", "large_pool", "normal"})
+        for method, entry in report.items():
+            self.assertGreaterEqual(entry["runtime"], 0.0)
+            self.assertEqual(set(entry["percentiles"]), set(percentiles))
+            for percentile, values in entry["percentiles"].items():
+                self.assertEqual(values["reference"], report["brute_force"]["percentiles"][percentile]["value"])
+                self.assertAlmostEqual(values["abs_diff"], abs(values["value"] - values["reference"]))
+                # every engine runs on the same Z draws, so with 2000 loans they agree to a fraction of a percent
+                self.assertLess(values["abs_diff"], 0.5)
+
+
+class TestVasicekCurve(unittest.TestCase):
+
+    def test_curve_matches_formula(self):
+        from scipy.stats import norm
+        pds, lgds, bals = make_pool(50, seed=5)
+        correlations = [0.05, 0.3]
+        alphas = [0.5, 0.9, 0.999]
+        curve = run_single_factor_sim.vasicek_pctl_curve(pds, lgds, bals, correlations, alphas,
+                                                         mem_budget_mb=0.0001)  # one loan per block
+        for corr_index, corr in enumerate(correlations):
+            for alpha_index, alpha in enumerate(alphas):
+                expected = sum(bal / sum(bals) * lgd * norm.cdf((norm.ppf(pd) + corr ** 0.5 * norm.ppf(alpha)) /
+                                                                (1.0 - corr) ** 0.5)
+                               for pd, lgd, bal in zip(pds, lgds, bals))
+                self.assertAlmostEqual(curve[corr_index, alpha_index], expected, places=12)
+
+        vasicek_dist = run_single_factor_sim.get_vasicek_dist(pds, lgds, bals, 0.3, pctls=alphas)
+        self.assertTrue(numpy.allclose(vasicek_dist, curve[1], rtol=0.0, atol=1e-15))
+
+    def test_pd_norm_inv_cached_by_content(self):
+        pds = make_pool(20, seed=6)[0]
+        pds_norm_inv = run_single_factor_sim.cached_pd_norm_inv(pds)
+        self.assertIs(run_single_factor_sim.cached_pd_norm_inv(list(pds)), pds_norm_inv)
+        self.assertFalse(pds_norm_inv.flags.writeable)
+        self.assertTrue(numpy.array_equal(pds_norm_inv, run_single_factor_sim.norm_inv(pds)))
+
+
+class TestScenarioStore(unittest.TestCase):
+
+    def test_stored_draws_match_dense_draws(self):
+        num_loans, num_runs, seed = 250, 400, 1234
+        numpy.random.seed(seed)
+        dense_z = numpy.random.normal(loc=run_single_factor_sim.mu, scale=run_single_factor_sim.sigma,
+                                      size=(1, num_runs))
+        dense_epsilon = numpy.random.normal(loc=run_single_factor_sim.mu, scale=run_single_factor_sim.sigma,
+                                            size=(num_loans, num_runs))
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            scenario_store.write_scenarios(store_dir, seed, num_loans, num_runs, block_loans=64)
+            z_vector, epsilon_matrix = scenario_store.load_scenarios(store_dir, seed, num_loans, num_runs,
+                                                                     create=False)
+            self.assertTrue(numpy.array_equal(dense_z, z_vector))
+            self.assertTrue(numpy.array_equal(dense_epsilon, epsilon_matrix))
+            del z_vector, epsilon_matrix  # release the memmaps before the directory is removed
+
+    def test_parallel_runs_on_stored_draws(self):
+        pds, lgds, bals = make_pool(120, seed=8)
+        num_runs, seed = 1500, 77
+        with tempfile.TemporaryDirectory() as store_dir:
+            pool_loss = run_single_factor_sim.parallel_calc_sim(pds, lgds, bals, 0.2, num_runs, seed, workers=2,
+                                                                runs_per_task=400, scenario_dir=store_dir)[0]
+            z_vector, epsilon_matrix = scenario_store.load_scenarios(store_dir, seed, len(pds), num_runs,
+                                                                     create=False)
+            chunked_loss = run_single_factor_sim.chunked_calc_sim(pds, lgds, bals, 0.2, num_runs, z_vec_in=z_vector,
+                                                                  epsilon_mat_in=epsilon_matrix)[0]
+            del z_vector, epsilon_matrix
+        self.assertTrue(numpy.array_equal(pool_loss, chunked_loss))
+
+
+class TestMultiFactorSim(unittest.TestCase):
+
+    def setUp(self):
+        self.pds, self.lgds, self.bals = make_pool(200, seed=12)
+
+    def test_one_sector_matches_chunked(self):
+        numpy.random.seed(21)
+        chunked_loss = run_single_factor_sim.chunked_calc_sim(self.pds, self.lgds, self.bals, 0.25, 1000,
+                                                              mem_budget_mb=0.5)[0]
+        numpy.random.seed(21)
+        sector_loss = run_single_factor_sim.multi_factor_calc_sim(self.pds, self.lgds, self.bals, numpy.zeros(200),
+                                                                  [[1.0]], 0.25, 1000, mem_budget_mb=0.5)[0]
+        self.assertTrue(numpy.array_equal(chunked_loss, sector_loss))
+
+    def test_uses_repaired_generator_factor(self):
+        # not positive definite, numpy.linalg.cholesky alone would reject it
+        sector_correlation = numpy.array([[1.0, 0.9, -0.9],
+                                          [0.9, 1.0, 0.9],
+                                          [-0.9, 0.9, 1.0]])
+        sectors = numpy.arange(200) % 3
+        random_state = numpy.random.default_rng(13)
+        sector_loss = run_single_factor_sim.multi_factor_calc_sim(self.pds, self.lgds, self.bals, sectors,
+                                                                  sector_correlation, 0.3, 500,
+                                                                  random_state=random_state)[0]
+        self.assertEqual(len(sector_loss), 500)
+
+        # the same draws with the factor matrix built from the generator's cached factor give the same losses
+        random_state = numpy.random.default_rng(13)
+        factor_matrix = run_single_factor_sim.correlated_generator.cached_cholesky(sector_correlation) @ \
+            random_state.normal(size=(3, 500))
+        given_loss = run_single_factor_sim.multi_factor_calc_sim(self.pds, self.lgds, self.bals, sectors,
+                                                                 sector_correlation, 0.3, 500,
+                                                                 factor_mat_in=factor_matrix,
+                                                                 random_state=random_state)[0]
+        self.assertTrue(numpy.array_equal(sector_loss, given_loss))
+
+    def test_rejects_unknown_sector(self):
+        with self.assertRaises(ValueError):
+            run_single_factor_sim.multi_factor_calc_sim(self.pds, self.lgds, self.bals, numpy.full(200, 2),
+                                                        numpy.eye(2), 0.3, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()